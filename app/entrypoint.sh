@@ -5,7 +5,21 @@ if ! [ -z ${PROOF_CLEAN_START+x} ]; then
     rm db.sqlite3
     rm celery*
     rm -r label/masks
+    rm -r label/accumulators
+    rm -r label/ingest
+    rm -r label/quarantine
+    rm -r label/staging
+    rm -r label/renders
+    rm -r label/tiles
+    rm -r label/variants
+    rm -r label/consensus
+    rm -r predict/predictions
+    rm -r label/metric_snapshots
+    rm -r label/profiles
+    rm -r label/task_results
     rm label/static/micrographs/*.png
+    rm label/static/micrographs/.manifest.json
+    rm label/static/micrographs/.registered
     find . -path "label/migrations/*.py" -not -name "__init__.py" -delete
     find . -path "label/migrations/*.pyc" -delete
 fi
@@ -15,14 +29,13 @@ python label/scripts/pre_process_micrographs.py
 
 python manage.py makemigrations
 python manage.py migrate --run-syncdb
-python label/scripts/create_micrograph_data.py
-python manage.py loaddata label/fixtures/micrographs.json
+python manage.py register_micrographs
 
 # Run labelling app in "local" mode.
 if ! [ -z ${PROOF_LOCAL+x} ]; then
-    PROOF_LOCAL=${PROOF_LOCAL} python manage.py runserver 0.0.0.0:8000
+    PROOF_LOCAL=${PROOF_LOCAL} uvicorn proof.asgi:application --host 0.0.0.0 --port 8000
 else
-    python manage.py runserver 0.0.0.0:8000
+    uvicorn proof.asgi:application --host 0.0.0.0 --port 8000
 fi
 
 exec "$@"
@@ -0,0 +1,262 @@
+"""
+Memory-mapped storage for the running sum of the label masks for each
+micrograph.
+
+Each micrograph has a single NumPy ``.npy`` file holding, for every pixel,
+the number of uploaded labels that marked the pixel as filament. Files are
+updated in place via a memory map, so only the pages touched by a label are
+read and written. The exception is when the counts are promoted to a wider
+data type, or replaced outright, in which case the whole file is rewritten
+to a temporary file that is then moved into place, so that readers never see
+a partially written accumulator. Writers must hold the micrograph's lock while updating the
+accumulator and the corresponding ``Micrograph`` record.
+"""
+
+from contextlib import contextmanager
+
+import fcntl
+import numpy as np
+import os
+
+# The directory in which the accumulators are stored.
+ACCUMULATOR_DIR = "label/accumulators"
+
+# The default data type of the label counts. This is promoted to a wider type
+# if a micrograph ever receives more labels than it can hold.
+ACCUMULATOR_DTYPE = np.uint16
+
+def accumulator_path(name):
+    """
+    Return the path to the accumulator for a micrograph.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the accumulator file.
+    """
+    return f"{ACCUMULATOR_DIR}/{name}.npy"
+
+@contextmanager
+def lock(name):
+    """
+    Context manager that holds an exclusive, inter-process lock on the
+    accumulator for a micrograph.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+    """
+
+    # Create the accumulator directory if it doesn't already exist.
+    os.makedirs(ACCUMULATOR_DIR, exist_ok=True)
+
+    # Use a separate lock file, since the accumulator itself may be replaced
+    # when its data type is promoted.
+    with open(f"{ACCUMULATOR_DIR}/{name}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def load_accumulator(name):
+    """
+    Return a read-only memory map of the label counts for a micrograph.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+
+    Returns
+    -------
+
+    counts : numpy.memmap, None
+        The number of labels marking each pixel as filament, or None if no
+        labels have been accumulated.
+    """
+    path = accumulator_path(name)
+
+    if not os.path.exists(path):
+        return None
+
+    return np.load(path, mmap_mode="r")
+
+def add_to_accumulator(name, mask):
+    """
+    Add a mask, or the sum of a batch of masks, to the label counts for a
+    micrograph in place. If the counts need promoting to a wider data type
+    the file is first rewritten atomically. The caller must hold the
+    micrograph's lock.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    mask : numpy.ndarray
+        A boolean or non-negative integer array of filament counts.
+
+
+    Returns
+    -------
+
+    delta_sum : int
+        The change in the sum of the counts over all pixels.
+
+    delta_sum_squares : int
+        The change in the sum of the squared counts over all pixels.
+    """
+    path = accumulator_path(name)
+
+    # Create a zeroed accumulator if this is the first label.
+    if not os.path.exists(path):
+        os.makedirs(ACCUMULATOR_DIR, exist_ok=True)
+        counts = np.lib.format.open_memmap(path, mode="w+",
+                                           dtype=ACCUMULATOR_DTYPE,
+                                           shape=mask.shape)
+    else:
+        counts = np.load(path, mmap_mode="r+")
+
+    if counts.shape != mask.shape:
+        raise ValueError(f"Mask shape {mask.shape} doesn't match the "
+                         f"accumulator shape {counts.shape} for '{name}'")
+
+    # Only the pixels marked by the batch change, so read just those. The
+    # rest of the memory map is never paged in.
+    mask = mask.ravel()
+    marked = np.flatnonzero(mask)
+    delta = mask[marked].astype(np.int64)
+    current = counts.reshape(-1)[marked].astype(np.int64)
+    updated = current + delta
+
+    # Promote the counts to a wider data type if they would overflow. The
+    # promoted counts are written to a temporary file, then moved into place,
+    # so that a crash or a concurrent reader never sees a truncated file.
+    if int(updated.max(initial=0)) > np.iinfo(counts.dtype).max:
+        promoted = counts.astype(np.uint32)
+        del counts
+        np.save(path + ".tmp.npy", promoted)
+        os.replace(path + ".tmp.npy", path)
+        counts = np.load(path, mmap_mode="r+")
+
+    # Work out how the sums of the counts, and of their squares, change. The
+    # unmarked pixels contribute nothing.
+    delta_sum = int(delta.sum())
+    delta_sum_squares = int(np.dot(updated, updated)) - int(np.dot(current, current))
+
+    # Accumulate in place and write the modified pages back to disk.
+    counts.reshape(-1)[marked] = updated
+    counts.flush()
+
+    return delta_sum, delta_sum_squares
+
+def subtract_from_accumulator(name, mask):
+    """
+    Remove a mask, or the sum of a batch of masks, from the label counts for
+    a micrograph in place. This is used to roll back an accumulation when the
+    corresponding database update fails. The caller must hold the
+    micrograph's lock.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    mask : numpy.ndarray
+        A boolean or non-negative integer array of filament counts.
+    """
+    counts = np.load(accumulator_path(name), mmap_mode="r+")
+
+    # Only touch the pixels marked by the batch.
+    mask = mask.ravel()
+    marked = np.flatnonzero(mask)
+    flat = counts.reshape(-1)
+    flat[marked] = flat[marked].astype(np.int64) - mask[marked]
+    counts.flush()
+
+def replace_accumulator(name, counts):
+    """
+    Replace the label counts for a micrograph, e.g. when rebuilding them from
+    the masks on disk. The caller must hold the micrograph's lock.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    counts : numpy.ndarray
+        The number of labels marking each pixel as filament.
+    """
+    os.makedirs(ACCUMULATOR_DIR, exist_ok=True)
+
+    # Use the default data type unless the counts won't fit.
+    if counts.max(initial=0) > np.iinfo(ACCUMULATOR_DTYPE).max:
+        dtype = np.uint32
+    else:
+        dtype = ACCUMULATOR_DTYPE
+
+    # Write to a temporary file, then move it into place, so readers never
+    # see a partially written accumulator.
+    path = accumulator_path(name)
+    np.save(path + ".tmp.npy", counts.astype(dtype))
+    os.replace(path + ".tmp.npy", path)
+
+def label_variance(num_labels, label_sum, label_sum_squares, num_pixels):
+    """
+    Return the variance of the labels for a micrograph, i.e. the variance
+    over labels at each pixel, averaged over all pixels.
+
+    Since each label is binary, the sum of the squared labels at a pixel is
+    equal to the count S, so the variance at the pixel is S/n - (S/n)^2. The
+    average over pixels then only depends on the sums of S and S^2, which
+    are kept up to date as labels are accumulated, so this is O(1).
+
+
+    Parameters
+    ----------
+
+    num_labels : int
+        The number of labels for the micrograph.
+
+    label_sum : int
+        The sum of the counts over all pixels.
+
+    label_sum_squares : int
+        The sum of the squared counts over all pixels.
+
+    num_pixels : int
+        The number of pixels in the micrograph.
+
+
+    Returns
+    -------
+
+    variance : float
+        The variance of the labels.
+    """
+    if num_labels == 0 or num_pixels == 0:
+        return 0.0
+
+    return (label_sum / num_labels - label_sum_squares / num_labels**2) / num_pixels
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class LabelConfig(AppConfig):
     name = 'label'
+
+    def ready(self):
+        # Register and bind the Celery tasks up front. Otherwise each task
+        # is bound the first time it is used, and a thread that uses it at
+        # the same time can get it unbound.
+        from . import tasks
+        from proof.celery import app
+        app.finalize()
@@ -0,0 +1,534 @@
+"""
+In-process benchmarks for the labelling app.
+
+The benchmarks run against a scratch copy of the app's working directories
+and a throwaway database, with Celery in eager mode, so that tasks run in the
+calling thread and no broker is needed. They are made up of:
+
+    A load test, in which a number of concurrent labellers cycle through the
+    /label/micrograph, /label/upload, and /label/average endpoints for a set
+    of synthetic micrographs.
+
+    Micro-benchmarks of the tasks that do the heavy lifting:
+    process_micrograph_mask, create_average_mask, compute_mask_variance, and
+    the pre-processing of a raw micrograph.
+
+The throughput and latency percentiles are reported for each, and can be
+saved as a baseline against which later runs are compared.
+"""
+
+from contextlib import contextmanager
+from io import BytesIO
+from PIL import Image
+from threading import Thread
+
+import base64
+import importlib.util
+import json
+import mrcfile
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, \
+                             teardown_databases, teardown_test_environment
+from proof.celery import app
+
+from . import registration, renders, staging
+
+# The width and height of the synthetic micrographs and masks.
+SIZE = 800
+
+# The latency percentiles that are reported.
+PERCENTILES = (50, 95, 99)
+
+# The default fractional slowdown allowed before a result counts as a regression.
+TOLERANCE = 0.25
+
+def summarise(latencies, elapsed):
+    """
+    Summarise a set of timings.
+
+
+    Parameters
+    ----------
+
+    latencies : [float]
+        The time taken by each operation, in seconds.
+
+    elapsed : float
+        The wall-clock time over which the operations ran, in seconds.
+
+
+    Returns
+    -------
+
+    summary : dict
+        The number of operations, the throughput in operations per second,
+        and the mean and percentile latencies in milliseconds.
+    """
+    latencies = np.asarray(latencies, dtype=float) * 1000
+    summary = {
+                "count" : len(latencies),
+                "throughput" : len(latencies) / elapsed if elapsed > 0 else 0.0,
+                "mean" : float(latencies.mean()) if len(latencies) else 0.0,
+              }
+    for p in PERCENTILES:
+        summary[f"p{p}"] = float(np.percentile(latencies, p)) if len(latencies) else 0.0
+
+    return summary
+
+@contextmanager
+def environment():
+    """
+    Context manager that runs the enclosed benchmarks in a scratch working
+    directory, against a throwaway database, with Celery tasks run eagerly.
+    """
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="proof-benchmark-")
+
+    # Run tasks in the calling thread, with a local stand-in for the broker.
+    conf = {key: app.conf[key] for key in
+            ("task_always_eager", "task_eager_propagates", "broker_url")}
+    app.conf.update(task_always_eager=True, task_eager_propagates=True,
+                    broker_url="memory://localhost/")
+
+    # Create the test database in the scratch directory, directly from the
+    # models, so that it is shared by the labeller threads and doesn't depend
+    # on the migrations.
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    previous = dict(test_settings)
+    test_settings.update(NAME=f"{directory}/benchmark.sqlite3", MIGRATE=False)
+
+    os.chdir(directory)
+    os.makedirs(registration.MICROGRAPH_DIR, exist_ok=True)
+
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+
+    try:
+        yield directory
+
+    finally:
+        teardown_databases(databases, verbosity=0)
+        teardown_test_environment()
+        test_settings.clear()
+        test_settings.update(previous)
+        app.conf.update(conf)
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+def create_micrographs(num_micrographs, seed=0):
+    """
+    Write and register a set of synthetic micrographs.
+
+
+    Parameters
+    ----------
+
+    num_micrographs : int
+        The number of micrographs.
+
+    seed : int
+        The seed for the random number generator.
+
+
+    Returns
+    -------
+
+    indices : [int]
+        The indices of the micrographs in the Django database.
+    """
+    from .models import Micrograph
+
+    rng = np.random.default_rng(seed)
+    for i in range(num_micrographs):
+        image = rng.integers(0, 256, (SIZE, SIZE), dtype=np.uint8)
+        Image.fromarray(image).save(f"{registration.MICROGRAPH_DIR}/benchmark_{i:06d}.png")
+
+    registration.register_micrographs()
+
+    return list(Micrograph.objects.order_by("id").values_list("id", flat=True))
+
+def create_mask(rng, num_filaments=8, width=6):
+    """
+    Create a synthetic label mask made up of straight filaments.
+
+
+    Parameters
+    ----------
+
+    rng : numpy.random.Generator
+        The random number generator.
+
+    num_filaments : int
+        The number of filaments.
+
+    width : int
+        The width of each filament, in pixels.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+    y, x = np.mgrid[:SIZE, :SIZE]
+    mask = np.zeros((SIZE, SIZE), dtype=bool)
+
+    for _ in range(num_filaments):
+        angle = rng.uniform(0, np.pi)
+        offset = rng.uniform(-SIZE / 2, SIZE / 2)
+        distance = (x - SIZE / 2) * np.sin(angle) - (y - SIZE / 2) * np.cos(angle) - offset
+        mask |= np.abs(distance) < width / 2
+
+    return mask
+
+def encode_mask(mask):
+    """
+    Encode a mask as PNG image bytes, as drawn on the labeller canvas.
+
+
+    Parameters
+    ----------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+
+
+    Returns
+    -------
+
+    data : bytes
+        The PNG encoded mask.
+    """
+    rgba = np.zeros(mask.shape + (4,), dtype=np.uint8)
+    rgba[mask] = (255, 0, 0, 255)
+
+    buffer = BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buffer, "PNG")
+
+    return buffer.getvalue()
+
+def run_load_test(num_labellers, num_cycles, num_micrographs, seed=0):
+    """
+    Simulate concurrent labellers, each repeatedly fetching a micrograph,
+    uploading a label, and fetching the average labels.
+
+
+    Parameters
+    ----------
+
+    num_labellers : int
+        The number of concurrent labellers, each with its own IP address.
+
+    num_cycles : int
+        The number of micrographs that each labeller labels.
+
+    num_micrographs : int
+        The number of synthetic micrographs.
+
+    seed : int
+        The seed for the random number generator.
+
+
+    Returns
+    -------
+
+    results : dict
+        The summary of the timings for each endpoint, and for a whole
+        labelling cycle.
+    """
+    from .views import wait_for_uploads
+
+    create_micrographs(num_micrographs, seed)
+
+    # Pre-encode the masks, so that only the requests are timed.
+    rng = np.random.default_rng(seed)
+    data_urls = ["data:image/png;base64," + base64.b64encode(encode_mask(create_mask(rng))).decode()
+                 for _ in range(min(16, num_labellers * num_cycles))]
+
+    endpoints = ("micrograph", "upload", "average", "cycle")
+    latencies = {endpoint: [] for endpoint in endpoints}
+    errors = []
+
+    def labeller(number):
+        client = Client(REMOTE_ADDR=f"10.0.{number // 256}.{number % 256}")
+        timings = {endpoint: [] for endpoint in endpoints}
+
+        try:
+            for cycle in range(num_cycles):
+                start = time.perf_counter()
+
+                index = _timed(timings["micrograph"], client.get, "/label/micrograph")["index"]
+
+                # Labelling is complete for this labeller.
+                if index < 0:
+                    break
+
+                _timed(timings["upload"], client.post, "/label/upload",
+                       {"index" : index,
+                        "dataUrl" : data_urls[(number + cycle) % len(data_urls)]})
+
+                _timed(timings["average"], client.get, "/label/average", {"index" : index})
+
+                timings["cycle"].append(time.perf_counter() - start)
+
+        except Exception as e:
+            errors.append(e)
+
+        finally:
+            connections.close_all()
+
+        for endpoint in endpoints:
+            latencies[endpoint].extend(timings[endpoint])
+
+    threads = [Thread(target=labeller, args=(number,)) for number in range(num_labellers)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Include the uploads still being processed in the background, when
+    # running locally.
+    wait_for_uploads()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    return {f"load/{endpoint}": summarise(latencies[endpoint], elapsed)
+            for endpoint in endpoints}
+
+def run_micro_benchmarks(repeat, seed=0):
+    """
+    Time the labelling tasks and the pre-processing of a raw micrograph.
+
+
+    Parameters
+    ----------
+
+    repeat : int
+        The number of times that each benchmark is run.
+
+    seed : int
+        The seed for the random number generator.
+
+
+    Returns
+    -------
+
+    results : dict
+        The summary of the timings for each benchmark.
+    """
+    from .tasks import compute_mask_variance, create_average_mask, process_micrograph_mask
+
+    rng = np.random.default_rng(seed)
+    index = create_micrographs(1, seed)[0]
+    data = [encode_mask(create_mask(rng)) for _ in range(repeat)]
+
+    results = {}
+
+    # Decode, spool, and ingest an upload. The upload is staged beforehand.
+    latencies = []
+    for i in range(repeat):
+        reference = staging.stage_upload(data[i], "png")
+        latencies.append(_time(process_micrograph_mask, "10.1.0.0", index, reference))
+    results["process_micrograph_mask"] = _summarise_serial(latencies)
+
+    # Render the average labels, removing the cached render each time.
+    latencies = []
+    for i in range(repeat):
+        shutil.rmtree(renders.RENDER_DIR, ignore_errors=True)
+        latencies.append(_time(create_average_mask, index))
+    results["create_average_mask"] = _summarise_serial(latencies)
+
+    # Rebuild the label statistics from the masks on disk.
+    latencies = [_time(compute_mask_variance, True) for _ in range(repeat)]
+    results["compute_mask_variance"] = _summarise_serial(latencies)
+
+    # Pre-process a raw micrograph, including its tile pyramid and compressed
+    # variants.
+    script = _load_pre_processing_script()
+    os.makedirs("raw", exist_ok=True)
+    with mrcfile.new("raw/benchmark.mrc", overwrite=True) as mrc:
+        mrc.set_data(rng.normal(size=(2 * SIZE, 2 * SIZE)).astype(np.float32))
+    latencies = [_time(script.process_micrograph, "raw/benchmark.mrc", "raw/benchmark.png",
+                       SIZE, script.tiles.TILE_SIZE) for _ in range(repeat)]
+    results["pre_process_micrograph"] = _summarise_serial(latencies)
+
+    return results
+
+def run(num_labellers=8, num_cycles=10, num_micrographs=50, repeat=5, seed=0):
+    """
+    Run all of the benchmarks.
+
+
+    Parameters
+    ----------
+
+    num_labellers : int
+        The number of concurrent labellers in the load test.
+
+    num_cycles : int
+        The number of micrographs that each labeller labels.
+
+    num_micrographs : int
+        The number of synthetic micrographs in the load test.
+
+    repeat : int
+        The number of times that each micro-benchmark is run.
+
+    seed : int
+        The seed for the random number generator.
+
+
+    Returns
+    -------
+
+    results : dict
+        The summary of the timings for each benchmark.
+    """
+    results = {}
+
+    # Each part of the suite gets a fresh environment, so that the load test
+    # doesn't affect the micro-benchmarks.
+    with environment():
+        results.update(run_load_test(num_labellers, num_cycles, num_micrographs, seed))
+
+    with environment():
+        results.update(run_micro_benchmarks(repeat, seed))
+
+    return results
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare a set of results with a baseline.
+
+
+    Parameters
+    ----------
+
+    results : dict
+        The benchmark results.
+
+    baseline : dict
+        The baseline results.
+
+    tolerance : float
+        The fractional increase in the p95 latency, or decrease in the
+        throughput, that is allowed.
+
+
+    Returns
+    -------
+
+    regressions : [str]
+        A description of each regression.
+    """
+    regressions = []
+
+    for name, expected in baseline.items():
+        if name not in results:
+            continue
+        actual = results[name]
+
+        if actual["p95"] > expected["p95"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 latency {actual['p95']:.1f} ms, "
+                               f"baseline {expected['p95']:.1f} ms")
+
+        if actual["throughput"] < expected["throughput"] / (1 + tolerance):
+            regressions.append(f"{name}: throughput {actual['throughput']:.1f}/s, "
+                               f"baseline {expected['throughput']:.1f}/s")
+
+    return regressions
+
+def load_baseline(path):
+    """
+    Load a baseline from file.
+
+
+    Parameters
+    ----------
+
+    path : str
+        The path to the baseline JSON file.
+
+
+    Returns
+    -------
+
+    baseline : dict
+        The baseline results.
+    """
+    with open(path) as f:
+        return json.load(f)["results"]
+
+def save_baseline(results, path, parameters=None):
+    """
+    Save a set of results as a baseline.
+
+
+    Parameters
+    ----------
+
+    results : dict
+        The benchmark results.
+
+    path : str
+        The path to the baseline JSON file.
+
+    parameters : dict
+        The parameters that the benchmarks were run with.
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump({"parameters" : parameters or {}, "results" : results}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def _timed(latencies, request, *args):
+    """
+    Helper function to time a request and decode its JSON response.
+    """
+    start = time.perf_counter()
+    response = request(*args)
+    latencies.append(time.perf_counter() - start)
+
+    if response.status_code != 200:
+        raise RuntimeError(f"Request to '{args[0]}' failed with status {response.status_code}")
+
+    return response.json()
+
+def _time(function, *args):
+    """
+    Helper function to time a function call.
+    """
+    start = time.perf_counter()
+    function(*args)
+
+    return time.perf_counter() - start
+
+def _summarise_serial(latencies):
+    """
+    Helper function to summarise timings for operations run one after the other.
+    """
+    return summarise(latencies, sum(latencies))
+
+def _load_pre_processing_script():
+    """
+    Helper function to import the pre-processing script, which isn't part of
+    a package.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "scripts", "pre_process_micrographs.py")
+    spec = importlib.util.spec_from_file_location("pre_process_micrographs", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
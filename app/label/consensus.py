@@ -0,0 +1,206 @@
+"""
+Binary consensus masks built from the running label counts.
+
+A pixel is marked as filament in the consensus mask at a given agreement
+threshold if at least that fraction of the labels for the micrograph mark it
+as filament. The masks for all of the requested thresholds are computed from
+the counts in a single vectorised comparison. They are cached as 1-bit PNGs,
+keyed by the number of labels that they were computed from, so they are only
+rebuilt once new labels arrive:
+
+    label/consensus/<name>/<num_labels>/<threshold>.png
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+import glob
+import numpy as np
+import os
+import shutil
+import uuid
+
+from django.db import connections
+
+from . import accumulator, masks, metrics
+from .models import Micrograph
+
+# The directory in which the consensus masks are stored.
+CONSENSUS_DIR = "label/consensus"
+
+def consensus_path(name, num_labels, threshold):
+    """
+    Return the path to a consensus mask, without extension.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    num_labels : int
+        The number of labels that the mask was computed from.
+
+    threshold : float
+        The agreement threshold.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the consensus mask, without extension.
+    """
+    return f"{CONSENSUS_DIR}/{name}/{num_labels}/{threshold:.3f}"
+
+def consensus_masks(counts, num_labels, thresholds):
+    """
+    Compute the consensus masks for a set of agreement thresholds.
+
+
+    Parameters
+    ----------
+
+    counts : numpy.ndarray
+        The number of labels marking each pixel as filament.
+
+    num_labels : int
+        The number of labels.
+
+    thresholds : [float]
+        The fractions of the labels that must agree for a pixel to be marked
+        as filament.
+
+
+    Returns
+    -------
+
+    masks : numpy.ndarray
+        A boolean array of shape (len(thresholds),) + counts.shape that is
+        True for consensus filament pixels.
+    """
+
+    # Convert each threshold to the minimum number of agreeing labels, so
+    # that the comparison is done on the integer counts. At least one label
+    # must mark a pixel for it to be filament.
+    thresholds = np.asarray(thresholds, dtype=float)
+    minimum = np.maximum(1, np.ceil(thresholds * num_labels - 1e-9)).astype(np.int64)
+
+    return counts[np.newaxis] >= minimum.reshape((-1,) + (1,) * counts.ndim)
+
+def get_consensus(micrograph, thresholds):
+    """
+    Return the paths to the consensus masks for a micrograph, building any
+    that aren't already cached.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    thresholds : [float]
+        The agreement thresholds.
+
+
+    Returns
+    -------
+
+    paths : dict
+        The path to the consensus mask for each threshold, without extension,
+        or None if the micrograph has no labels.
+    """
+    name = micrograph.name
+
+    # Read the number of labels, and the counts if they are needed, while
+    # holding the micrograph's lock, so that they are consistent. The masks
+    # are keyed by the number of labels that was read, rather than that of
+    # the caller's record, which may be stale.
+    with accumulator.lock(name):
+        micrograph.refresh_from_db(fields=["num_labels"])
+        num_labels = micrograph.num_labels
+
+        paths = {t: consensus_path(name, num_labels, t) for t in thresholds}
+
+        # Cache hit.
+        if num_labels > 0 and all(os.path.exists(p + ".png") for p in paths.values()):
+            metrics.cache_requests.labels("consensus", "hit").inc()
+            return paths
+
+        metrics.cache_requests.labels("consensus", "miss").inc()
+
+        counts = accumulator.load_accumulator(name)
+        if counts is None or num_labels == 0:
+            return None
+        counts = np.array(counts)
+
+    for path, mask in zip(paths.values(), consensus_masks(counts, num_labels, thresholds)):
+        _write_mask(mask, path)
+
+    # Remove the masks computed from fewer labels. Those computed from more
+    # labels, e.g. by another worker, are kept.
+    for directory in glob.glob(f"{CONSENSUS_DIR}/{name}/*"):
+        if int(os.path.basename(directory)) < num_labels:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return paths
+
+def build_consensus(indices, thresholds, num_workers=None):
+    """
+    Build the consensus masks for a set of micrographs using a pool of local
+    processes.
+
+
+    Parameters
+    ----------
+
+    indices : [int]
+        The indices of the micrographs in the Django database.
+
+    thresholds : [float]
+        The agreement thresholds.
+
+    num_workers : int
+        The number of processes. Defaults to the number of CPUs.
+
+
+    Returns
+    -------
+
+    paths : dict
+        The paths to the consensus masks for each micrograph index, as
+        returned by get_consensus.
+    """
+    if len(indices) == 0:
+        return {}
+
+    # Close the database connections so that they aren't shared with the
+    # worker processes, which open their own.
+    connections.close_all()
+
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=django.setup) as pool:
+        results = pool.map(_build_consensus, indices,
+                           [thresholds] * len(indices), chunksize=16)
+
+        return dict(zip(indices, results))
+
+def _build_consensus(index, thresholds):
+    """
+    Helper function to build the consensus masks for a micrograph in a
+    worker process.
+    """
+    micrograph = Micrograph.objects.only("path", "num_labels").get(pk=index)
+    return get_consensus(micrograph, thresholds)
+
+def _write_mask(mask, path):
+    """
+    Helper function to write a consensus mask so that it is never seen
+    partially written. The temporary file is unique to this writer, since
+    two workers may build the same consensus at once.
+    """
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    masks.save_mask(mask, tmp)
+    os.replace(tmp + ".png", path + ".png")
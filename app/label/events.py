@@ -0,0 +1,326 @@
+"""
+Server-sent events notifying labellers when their work has been processed,
+e.g. when an upload has been ingested or an average mask has been rendered.
+
+Events are published by the Celery workers, which run in other processes, so
+they are passed to the web server through the Event table. Rather than each
+open stream polling the database, a single hub per event loop polls for new
+events on behalf of every connected client and fans them out to the streams
+for the matching IP addresses. Each event is sent to the browser as:
+
+    id: <id>
+    event: <kind>
+    data: <JSON>
+"""
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from datetime import timedelta
+
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+from .models import Event
+
+logger = logging.getLogger(__name__)
+
+# The number of seconds between keep-alive comments on an idle stream, so that
+# proxies don't close it.
+HEARTBEAT_INTERVAL = 15
+
+# The number of milliseconds that the browser waits before reconnecting.
+RETRY_INTERVAL = 1000
+
+def publish(ips, kind, data):
+    """
+    Publish an event to a set of clients.
+
+
+    Parameters
+    ----------
+
+    ips : [str]
+        The IP addresses of the clients.
+
+    kind : str
+        The kind of event.
+
+    data : dict
+        The JSON serialisable event data.
+    """
+    data = json.dumps(data)
+    Event.objects.bulk_create(
+        [Event(ip_address=ip, kind=kind, data=data) for ip in set(ips)])
+
+def remove_expired_events(max_age):
+    """
+    Remove events that are too old to be resent to a reconnecting client.
+
+
+    Parameters
+    ----------
+
+    max_age : float
+        The age in seconds after which an event has expired.
+
+
+    Returns
+    -------
+
+    num_removed : int
+        The number of events that were removed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    num_removed, _ = Event.objects.filter(created__lt=cutoff).delete()
+
+    return num_removed
+
+class EventHub:
+    """
+    Polls for new events on behalf of all of the streams in an event loop.
+    """
+
+    def __init__(self):
+        # The queues of the open streams, keyed by IP address.
+        self._queues = {}
+
+        # The ID of the last event that was polled, the polling task, and
+        # whether polling has started.
+        self._last_id = None
+        self._task = None
+        self._ready = None
+
+    async def subscribe(self, ip):
+        """
+        Open a stream of the events for a client.
+
+
+        Parameters
+        ----------
+
+        ip : str
+            The IP address of the client.
+
+
+        Returns
+        -------
+
+        queue : asyncio.Queue
+            The queue to which the events for the client are added.
+        """
+        queue = asyncio.Queue()
+        self._queues.setdefault(ip, set()).add(queue)
+
+        # Start polling if this is the first stream, and wait until polling
+        # has started so that the stream doesn't miss any events.
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._task = asyncio.ensure_future(self._poll())
+        await self._ready.wait()
+
+        return queue
+
+    def unsubscribe(self, ip, queue):
+        """
+        Close a stream of the events for a client.
+
+
+        Parameters
+        ----------
+
+        ip : str
+            The IP address of the client.
+
+        queue : asyncio.Queue
+            The queue returned when the stream was opened.
+        """
+        queues = self._queues.get(ip, set())
+        queues.discard(queue)
+        if len(queues) == 0:
+            self._queues.pop(ip, None)
+
+    async def _poll(self):
+        """
+        Fetch the new events for the connected clients until there are none
+        left.
+        """
+        try:
+            self._last_id = await _latest_id()
+            self._ready.set()
+
+            while len(self._queues) > 0:
+                await asyncio.sleep(settings.PROOF_EVENT_POLL_INTERVAL)
+
+                try:
+                    events = [event async for event in
+                              Event.objects.filter(id__gt=self._last_id,
+                                                   ip_address__in=list(self._queues))
+                                           .order_by("id")]
+                except Exception:
+                    logger.exception("Failed to poll for events")
+                    continue
+
+                for event in events:
+                    self._last_id = event.id
+                    for queue in self._queues.get(event.ip_address, ()):
+                        queue.put_nowait(event)
+
+        finally:
+            # Let any waiting streams through if polling failed to start.
+            self._ready.set()
+            self._task = None
+
+# The hub for each event loop.
+_hubs = weakref.WeakKeyDictionary()
+
+def get_hub():
+    """
+    Return the hub for the running event loop, creating it if needed.
+
+
+    Returns
+    -------
+
+    hub : label.events.EventHub
+        The hub.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs[loop] = EventHub()
+
+    return _hubs[loop]
+
+async def stream(ip, last_event_id=None):
+    """
+    Stream the events for a client as server-sent events. The stream closes
+    after PROOF_EVENT_STREAM_TIMEOUT seconds, after which the browser
+    reconnects, resuming from the last event that it received.
+
+
+    Parameters
+    ----------
+
+    ip : str
+        The IP address of the client.
+
+    last_event_id : int
+        The ID of the last event that the client received, if it is
+        reconnecting. Only new events are sent otherwise.
+
+
+    Returns
+    -------
+
+    stream : async generator
+        The text of the stream.
+    """
+    hub = get_hub()
+
+    # Only new events are sent to a client that isn't reconnecting. The
+    # latest event is found before subscribing, so that any event published
+    # while subscribing is caught up on below.
+    if last_event_id is None:
+        last_event_id = await _latest_id(ip)
+
+    # Subscribe before catching up, so that no events are missed in between.
+    queue = await hub.subscribe(ip)
+
+    try:
+        yield f"retry: {RETRY_INTERVAL}\n\n"
+
+        # Send the events that were missed while the client was away, or
+        # while subscribing.
+        async for event in Event.objects.filter(ip_address=ip, id__gt=last_event_id) \
+                                        .order_by("id"):
+            yield _format(event)
+            last_event_id = event.id
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.PROOF_EVENT_STREAM_TIMEOUT
+
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+
+            try:
+                event = await asyncio.wait_for(queue.get(), min(HEARTBEAT_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            # The event was already sent while catching up.
+            if event.id <= last_event_id:
+                continue
+
+            yield _format(event)
+            last_event_id = event.id
+
+    finally:
+        hub.unsubscribe(ip, queue)
+
+def stream_sync(ip, last_event_id=None):
+    """
+    Stream the events for a client as server-sent events, polling the
+    database directly. This is used when served by a WSGI server, e.g. the
+    development server, which ties up a thread for each stream.
+
+
+    Parameters
+    ----------
+
+    ip : str
+        The IP address of the client.
+
+    last_event_id : int
+        The ID of the last event that the client received, if it is
+        reconnecting. Only new events are sent otherwise.
+
+
+    Returns
+    -------
+
+    stream : generator
+        The text of the stream.
+    """
+    yield f"retry: {RETRY_INTERVAL}\n\n"
+
+    if last_event_id is None:
+        last_event_id = Event.objects.filter(ip_address=ip) \
+                                     .aggregate(latest=Max("id"))["latest"] or 0
+
+    deadline = time.monotonic() + settings.PROOF_EVENT_STREAM_TIMEOUT
+    heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+    while time.monotonic() < deadline:
+        for event in Event.objects.filter(ip_address=ip, id__gt=last_event_id).order_by("id"):
+            yield _format(event)
+            last_event_id = event.id
+
+        if time.monotonic() > heartbeat:
+            yield ": keep-alive\n\n"
+            heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+        time.sleep(settings.PROOF_EVENT_POLL_INTERVAL)
+
+async def _latest_id(ip=None):
+    """
+    Helper function to return the ID of the latest event, optionally for a
+    single client.
+    """
+    events = Event.objects.all()
+    if ip is not None:
+        events = events.filter(ip_address=ip)
+
+    return (await events.aaggregate(latest=Max("id")))["latest"] or 0
+
+def _format(event):
+    """
+    Helper function to format an event as a server-sent event.
+    """
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {event.data}\n\n"
@@ -0,0 +1,255 @@
+"""
+Export of the labels as a sharded training dataset.
+
+Each sample holds a micrograph, the consensus of its labels, and every
+individual label mask. Samples are written to fixed-size shards, which are
+compressed NumPy ``.npz`` archives, alongside an ``index.json`` describing
+which shard holds each sample. Since every array is a separate member of its
+archive, a reader can load a single sample without decompressing the rest
+of its shard. The dataset is laid out as:
+
+    <output>/index.json
+    <output>/shard-000000.npz
+    <output>/shard-000001.npz
+    ...
+
+where each shard contains, for each of its samples:
+
+    <name>/micrograph.npy   The 8-bit grayscale micrograph.
+    <name>/counts.npy       The number of labels marking each pixel as filament.
+    <name>/masks.npy        The label masks, bit-packed along the last axis.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+import json
+import logging
+import numpy as np
+import os
+import zipfile
+
+from . import masks, tiles
+
+logger = logging.getLogger(__name__)
+
+# The default number of samples in each shard.
+SHARD_SIZE = 64
+
+# The version of the dataset layout.
+VERSION = 1
+
+def export_dataset(micrographs, output, shard_size=SHARD_SIZE, num_workers=None):
+    """
+    Export the labels for a set of micrographs, writing the shards in
+    parallel. Each worker only holds a single sample in memory at a time.
+
+
+    Parameters
+    ----------
+
+    micrographs : [(int, str, str)]
+        The index, name, and path of each micrograph to export.
+
+    output : str
+        The directory in which to write the dataset.
+
+    shard_size : int
+        The number of micrographs in each shard.
+
+    num_workers : int
+        The number of processes. Defaults to the number of CPUs.
+
+
+    Returns
+    -------
+
+    index : dict
+        The dataset index.
+    """
+    os.makedirs(output, exist_ok=True)
+
+    shards = [micrographs[i:i+shard_size] for i in range(0, len(micrographs), shard_size)]
+    filenames = [f"shard-{i:06d}.npz" for i in range(len(shards))]
+
+    samples = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for filename, written in zip(filenames,
+                                     pool.map(write_shard, shards,
+                                              [f"{output}/{f}" for f in filenames])):
+            for sample in written:
+                sample["shard"] = filename
+                samples.append(sample)
+
+    index = {
+              "version" : VERSION,
+              "shards" : filenames,
+              "samples" : samples,
+            }
+
+    # Write the index last, so that a dataset with an index is complete.
+    with open(f"{output}/index.json.tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(f"{output}/index.json.tmp", f"{output}/index.json")
+
+    return index
+
+def write_shard(micrographs, path):
+    """
+    Write a shard of the dataset.
+
+
+    Parameters
+    ----------
+
+    micrographs : [(int, str, str)]
+        The index, name, and path of each micrograph in the shard.
+
+    path : str
+        The path to the shard.
+
+
+    Returns
+    -------
+
+    samples : [dict]
+        The metadata for each sample that was written. Micrographs with no
+        label masks on disk are skipped.
+    """
+    samples = []
+
+    with zipfile.ZipFile(path + ".tmp", mode="w", compression=zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for index, name, micrograph_path in micrographs:
+            # Accumulate the counts and pack the masks one mask at a time, so
+            # that only the bit-packed masks are held in memory.
+            counts = None
+            packed = []
+            for mask in _iter_masks(name):
+                if counts is None:
+                    counts = np.zeros(mask.shape, dtype=np.uint32)
+                counts += mask
+                packed.append(np.packbits(mask, axis=-1))
+
+            if counts is None:
+                logger.warning(f"Skipping micrograph '{name}', which has no masks")
+                continue
+
+            shape = counts.shape
+            packed = np.stack(packed)
+
+            _write_member(archive, f"{name}/micrograph", _load_micrograph(name, micrograph_path, shape))
+            _write_member(archive, f"{name}/counts", counts.astype(np.uint16)
+                          if len(packed) <= np.iinfo(np.uint16).max else counts)
+            _write_member(archive, f"{name}/masks", packed)
+
+            samples.append({
+                             "index" : index,
+                             "name" : name,
+                             "num_labels" : len(packed),
+                             "shape" : list(shape),
+                           })
+
+    os.replace(path + ".tmp", path)
+
+    return samples
+
+class Dataset:
+    """
+    A reader for an exported dataset, giving random access to its samples.
+    """
+
+    def __init__(self, path):
+        """
+        Open a dataset.
+
+
+        Parameters
+        ----------
+
+        path : str
+            The directory containing the dataset.
+        """
+        self.path = path
+
+        with open(f"{path}/index.json") as f:
+            self.index = json.load(f)
+
+        self.samples = self.index["samples"]
+        self._names = {sample["name"]: i for i, sample in enumerate(self.samples)}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, i):
+        """
+        Load a sample.
+
+
+        Parameters
+        ----------
+
+        i : int, str
+            The position of the sample in the dataset, or the name of the
+            micrograph.
+
+
+        Returns
+        -------
+
+        sample : dict
+            The sample metadata, along with the "micrograph", the label
+            "counts", the consensus "average", i.e. the fraction of labels
+            marking each pixel as filament, and the boolean label "masks".
+        """
+        if isinstance(i, str):
+            i = self._names[i]
+
+        sample = dict(self.samples[i])
+        name = sample["name"]
+
+        # Only the members for this sample are decompressed.
+        with np.load(f"{self.path}/{sample['shard']}") as shard:
+            sample["micrograph"] = shard[f"{name}/micrograph"]
+            sample["counts"] = shard[f"{name}/counts"]
+            packed = shard[f"{name}/masks"]
+
+        sample["average"] = sample["counts"] / sample["num_labels"]
+        sample["masks"] = np.unpackbits(packed, axis=-1,
+                                        count=sample["shape"][1]).astype(bool)
+
+        return sample
+
+def _iter_masks(name):
+    """
+    Helper function to load the label masks on disk for a micrograph, one
+    at a time, in the order in which they were uploaded.
+    """
+    label = 1
+    while os.path.exists(f"label/masks/{name}/{label:06d}.png"):
+        yield masks.load_mask(f"label/masks/{name}/{label:06d}")
+        label += 1
+
+def _load_micrograph(name, path, shape):
+    """
+    Helper function to load a micrograph at the resolution of its masks,
+    using the full resolution level of its tile pyramid if the masks were
+    labelled at full resolution.
+    """
+    if tiles.full_resolution_shape(name) == tuple(shape):
+        descriptor = tiles.load_descriptor(name)
+        return np.load(f"{tiles.pyramid_dir(name)}/levels/{descriptor['max_level']}.npy")
+
+    image = Image.open(f"label/{path}").convert("L")
+    if image.size != (shape[1], shape[0]):
+        image = image.resize((shape[1], shape[0]))
+
+    return np.asarray(image)
+
+def _write_member(archive, name, array):
+    """
+    Helper function to write an array to a compressed archive, in the same
+    format as numpy.savez_compressed.
+    """
+    with archive.open(name + ".npy", mode="w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
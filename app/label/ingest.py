@@ -0,0 +1,292 @@
+"""
+Spooling of decoded label masks so that concurrent uploads for the same
+micrograph can be ingested as a single batch.
+
+Each upload task decodes its mask and writes it to a per-micrograph spool
+directory. An ingestion task then drains everything that has arrived for the
+micrograph, sums the masks in a single vectorised operation, and commits the
+batch with one update of the micrograph record.
+
+Spooled masks that can't be read, or that don't match the shape at which the
+micrograph's labels are accumulated, are moved to a per-micrograph quarantine
+directory, so that they are neither retried forever nor counted.
+
+Before a batch is committed its masks are claimed, i.e. renamed so that they
+are no longer pending, with the number of labels the micrograph will have
+once the batch is committed. A retried ingestion therefore never counts a
+committed batch twice, even if its masks couldn't be removed, and masks left
+claimed by an interrupted ingestion are resolved against the micrograph
+record by the next one.
+"""
+
+from collections import namedtuple
+
+import glob
+import numpy as np
+import os
+import logging
+import shutil
+import time
+import uuid
+import zipfile
+
+# The directory in which pending masks are spooled.
+INGEST_DIR = "label/ingest"
+
+# The directory to which masks that can't be ingested are moved.
+QUARANTINE_DIR = "label/quarantine"
+
+# The extension of spooled masks that have been claimed by a batch.
+CLAIMED_EXTENSION = ".claimed"
+
+logger = logging.getLogger(__name__)
+
+# A mask waiting to be ingested.
+PendingMask = namedtuple("PendingMask", ["path", "ip", "mask", "svg", "strokes"])
+
+def spool_mask(name, ip, mask, svg_serialized, strokes=None):
+    """
+    Write a decoded mask to the spool for a micrograph.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    ip : str
+        The IP address of the client.
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+
+    svg_serialized : str, None
+        The serialized SVG image, if any.
+
+    strokes : str, None
+        The JSON encoded strokes, if any.
+    """
+
+    # Create the spool directory if it doesn't already exist.
+    spool_dir = f"{INGEST_DIR}/{name}"
+    os.makedirs(spool_dir, exist_ok=True)
+
+    # Name the file by arrival time so that masks are ingested in order.
+    filename = f"{spool_dir}/{time.time_ns()}-{uuid.uuid4().hex}"
+
+    # Write to a temporary file first so that a partially written mask is
+    # never picked up by the ingestion task. Masks are bit-packed and no
+    # Python objects are pickled.
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, mask=np.packbits(mask), shape=np.array(mask.shape),
+                 ip=np.array(ip), svg=np.array(svg_serialized or ""),
+                 strokes=np.array(strokes or ""))
+    os.replace(filename + ".tmp", filename + ".npz")
+
+def pending_masks(name, shape=None):
+    """
+    Load all of the masks that are waiting to be ingested for a micrograph.
+    Masks that can't be read, or that don't have the expected shape, are
+    quarantined. The caller must hold the micrograph's accumulator lock.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    shape : (int, int)
+        The expected (height, width) of the masks, if any.
+
+
+    Returns
+    -------
+
+    pending : [PendingMask]
+        The pending masks, in order of arrival.
+    """
+    pending = []
+
+    for path in sorted(glob.glob(f"{INGEST_DIR}/{name}/*.npz")):
+        try:
+            with np.load(path) as data:
+                mask_shape = tuple(int(x) for x in data["shape"])
+                if shape is not None and mask_shape != tuple(shape):
+                    raise ValueError(f"Mask shape {mask_shape} doesn't match "
+                                     f"the label shape {tuple(shape)}")
+                mask = np.unpackbits(data["mask"], count=int(np.prod(mask_shape)))
+                entry = PendingMask(path, str(data["ip"]),
+                                    mask.reshape(mask_shape).astype(bool),
+                                    str(data["svg"]) or None,
+                                    str(data["strokes"]) or None)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            quarantine_mask(name, path, e)
+            continue
+
+        pending.append(entry)
+
+    return pending
+
+def quarantine_mask(name, path, reason):
+    """
+    Move a spooled mask that can't be ingested to the quarantine directory.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    path : str
+        The path to the spooled mask.
+
+    reason : Exception
+        The reason the mask can't be ingested.
+    """
+    logger.warning(f"Quarantining spooled mask '{path}' for micrograph '{name}': {reason}")
+
+    quarantine_dir = f"{QUARANTINE_DIR}/{name}"
+    os.makedirs(quarantine_dir, exist_ok=True)
+    shutil.move(path, f"{quarantine_dir}/{os.path.basename(path)}")
+
+def sum_masks(pending):
+    """
+    Sum a batch of pending masks.
+
+
+    Parameters
+    ----------
+
+    pending : [PendingMask]
+        The pending masks.
+
+
+    Returns
+    -------
+
+    counts : numpy.ndarray
+        The number of masks marking each pixel as filament.
+    """
+    return np.stack([entry.mask for entry in pending]).sum(axis=0, dtype=np.uint32)
+
+def claim_masks(pending, num_labels):
+    """
+    Claim a batch of pending masks before it is committed, so that they are
+    no longer pending. The caller must hold the micrograph's accumulator
+    lock.
+
+
+    Parameters
+    ----------
+
+    pending : [PendingMask]
+        The pending masks.
+
+    num_labels : int
+        The number of labels the micrograph has once the batch is committed.
+
+
+    Returns
+    -------
+
+    claimed : [PendingMask]
+        The claimed masks.
+    """
+    claimed = []
+
+    try:
+        for entry in pending:
+            path = f"{os.path.splitext(entry.path)[0]}.{num_labels}{CLAIMED_EXTENSION}"
+            os.replace(entry.path, path)
+            claimed.append(entry._replace(path=path))
+    except OSError:
+        # Leave the batch pending as a whole.
+        release_masks(claimed)
+        raise
+
+    return claimed
+
+def release_masks(claimed):
+    """
+    Return claimed masks to the spool after their batch fails to commit, so
+    that they are ingested again.
+
+
+    Parameters
+    ----------
+
+    claimed : [PendingMask]
+        The claimed masks.
+    """
+    for entry in claimed:
+        os.replace(entry.path, _pending_path(entry.path))
+
+def recover_masks(name, num_labels):
+    """
+    Resolve the masks left claimed by an interrupted ingestion, e.g. if a
+    worker died. Masks from a batch that was committed are removed, and the
+    others are returned to the spool. The caller must hold the micrograph's
+    accumulator lock.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    num_labels : int
+        The number of labels the micrograph has.
+
+
+    Returns
+    -------
+
+    released : bool
+        Whether any masks were returned to the spool, in which case the label
+        counts may already include them.
+    """
+    released = False
+
+    for path in glob.glob(f"{INGEST_DIR}/{name}/*{CLAIMED_EXTENSION}"):
+        batch_num_labels = int(os.path.splitext(os.path.splitext(path)[0])[1][1:])
+
+        if batch_num_labels <= num_labels:
+            logger.warning(f"Removing committed mask '{path}' for micrograph '{name}'")
+            os.remove(path)
+        else:
+            logger.warning(f"Returning uncommitted mask '{path}' for micrograph "
+                           f"'{name}' to the spool")
+            os.replace(path, _pending_path(path))
+            released = True
+
+    return released
+
+def _pending_path(path):
+    """
+    Helper function to return the spool path of a claimed mask.
+    """
+    return os.path.splitext(os.path.splitext(path)[0])[0] + ".npz"
+
+def remove_masks(claimed):
+    """
+    Remove ingested masks from the spool. Masks that can't be removed are
+    left for the next ingestion of the micrograph to remove.
+
+
+    Parameters
+    ----------
+
+    claimed : [PendingMask]
+        The masks that have been ingested.
+    """
+    for entry in claimed:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove ingested mask '{entry.path}': {e}")
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from label import benchmark
+
+class Command(BaseCommand):
+    help = "Benchmark the labelling endpoints and tasks in-process, against " \
+           "synthetic micrographs, a throwaway database, and eager Celery tasks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labellers", type=int, default=8,
+                            help="The number of concurrent labellers in the load test.")
+        parser.add_argument("--cycles", type=int, default=10,
+                            help="The number of micrographs that each labeller labels.")
+        parser.add_argument("--micrographs", type=int, default=50,
+                            help="The number of synthetic micrographs in the load test.")
+        parser.add_argument("--repeat", type=int, default=5,
+                            help="The number of times that each micro-benchmark is run.")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="The seed for the synthetic data.")
+        parser.add_argument("--baseline", default=None,
+                            help="A baseline JSON file to compare the results with. "
+                                 "The command fails if any benchmark has regressed.")
+        parser.add_argument("--tolerance", type=float, default=benchmark.TOLERANCE,
+                            help="The fractional increase in p95 latency, or decrease "
+                                 "in throughput, allowed before a benchmark counts as "
+                                 "having regressed.")
+        parser.add_argument("--save-baseline", default=None,
+                            help="Save the results as a baseline JSON file.")
+
+    def handle(self, *args, **options):
+        parameters = {
+                       "labellers" : options["labellers"],
+                       "cycles" : options["cycles"],
+                       "micrographs" : options["micrographs"],
+                       "repeat" : options["repeat"],
+                       "seed" : options["seed"],
+                     }
+
+        # Load the baseline first, so that a bad path fails fast.
+        if options["baseline"]:
+            baseline = benchmark.load_baseline(options["baseline"])
+
+        results = benchmark.run(parameters["labellers"], parameters["cycles"],
+                                parameters["micrographs"], parameters["repeat"],
+                                parameters["seed"])
+
+        # Report the results.
+        self.stdout.write(f"{'benchmark':32} {'count':>6} {'ops/s':>9} "
+                          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, summary in results.items():
+            self.stdout.write(f"{name:32} {summary['count']:6d} {summary['throughput']:9.1f} "
+                              f"{summary['p50']:9.1f} {summary['p95']:9.1f} {summary['p99']:9.1f}")
+
+        if options["save_baseline"]:
+            benchmark.save_baseline(results, options["save_baseline"], parameters)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to "
+                                                 f"'{options['save_baseline']}'."))
+
+        if options["baseline"]:
+            regressions = benchmark.compare(results, baseline, options["tolerance"])
+            if regressions:
+                raise CommandError("Performance regressions:\n  " + "\n  ".join(regressions))
+
+            self.stdout.write(self.style.SUCCESS("No performance regressions."))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from label.consensus import build_consensus
+from label.models import Micrograph
+
+class Command(BaseCommand):
+    help = "Build binary consensus masks from the labels for each micrograph " \
+           "at a set of agreement thresholds."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threshold", type=float, action="append",
+                            help="The fraction of labels that must agree for a "
+                                 "pixel to be marked as filament. Can be "
+                                 "repeated. Defaults to 0.5.")
+        parser.add_argument("--min-labels", type=int, default=1,
+                            help="The minimum number of labels for a micrograph.")
+        parser.add_argument("--max-variance", type=float, default=None,
+                            help="The maximum label variance for a micrograph.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="The number of worker processes. Defaults to "
+                                 "the number of CPUs.")
+
+    def handle(self, *args, **options):
+        thresholds = sorted(set(options["threshold"] or [0.5]))
+
+        if not all(0 <= t <= 1 for t in thresholds):
+            raise CommandError("Thresholds must be between 0 and 1.")
+
+        # Get the micrographs that pass the filters.
+        micrographs = Micrograph.objects.filter(num_labels__gte=max(1, options["min_labels"]))
+        if options["max_variance"] is not None:
+            micrographs = micrographs.filter(variance__lte=options["max_variance"])
+        indices = list(micrographs.order_by("id").values_list("id", flat=True))
+
+        # Build the masks in parallel.
+        paths = build_consensus(indices, thresholds, options["workers"])
+
+        num_built = sum(1 for p in paths.values() if p is not None)
+        self.stdout.write(self.style.SUCCESS(f"Built consensus masks for {num_built} "
+                                             f"micrographs at thresholds "
+                                             f"{', '.join(str(t) for t in thresholds)}."))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from label.export import SHARD_SIZE, export_dataset
+from label.models import Micrograph
+
+class Command(BaseCommand):
+    help = "Export the micrographs and their labels as a sharded training " \
+           "dataset."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output",
+                            help="The directory in which to write the dataset.")
+        parser.add_argument("--shard-size", type=int, default=SHARD_SIZE,
+                            help="The number of micrographs in each shard.")
+        parser.add_argument("--min-labels", type=int, default=1,
+                            help="The minimum number of labels for a micrograph "
+                                 "to be exported.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="The number of worker processes. Defaults to "
+                                 "the number of CPUs.")
+
+    def handle(self, *args, **options):
+        # Get the micrographs to export.
+        micrographs = Micrograph.objects.filter(num_labels__gte=max(1, options["min_labels"])) \
+                                        .only("id", "path").order_by("id")
+        micrographs = [(m.id, m.name, m.path) for m in micrographs]
+
+        # The workers only read files, so don't share the database connection
+        # with them.
+        connections.close_all()
+
+        index = export_dataset(micrographs, options["output"],
+                               options["shard_size"], options["workers"])
+
+        self.stdout.write(self.style.SUCCESS(f"Exported {len(index['samples'])} "
+                                             f"micrographs in {len(index['shards'])} "
+                                             f"shards."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from label.models import Micrograph
+from label.tasks import rebuild_label_statistics_locally
+
+class Command(BaseCommand):
+    help = "Rebuild the label counts and variance for each micrograph from " \
+           "the masks on disk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--index", type=int, action="append",
+                            help="The index of a micrograph to rebuild. Can be "
+                                 "repeated. Defaults to all micrographs.")
+        parser.add_argument("--dirty", action="store_true",
+                            help="Only rebuild micrographs whose statistics "
+                                 "may be out of step with their masks.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="The number of worker processes. Defaults to "
+                                 "the number of CPUs.")
+
+    def handle(self, *args, **options):
+        # Get the micrographs to rebuild.
+        if options["index"]:
+            indices = options["index"]
+        else:
+            micrographs = Micrograph.objects.all()
+            if options["dirty"]:
+                micrographs = micrographs.filter(statistics_dirty=True)
+            indices = list(micrographs.order_by("id").values_list("id", flat=True))
+
+        # Rebuild the micrographs in parallel.
+        rebuild_label_statistics_locally(indices, options["workers"])
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt statistics for "
+                                             f"{len(indices)} micrographs."))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from label.registration import MICROGRAPH_DIR, register_micrographs
+
+class Command(BaseCommand):
+    help = "Register any new micrograph images in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory", default=MICROGRAPH_DIR,
+                            help="The directory containing the micrograph "
+                                 "images.")
+        parser.add_argument("--force", action="store_true",
+                            help="Compare every image with the database, even "
+                                 "if the directory hasn't changed.")
+
+    def handle(self, *args, **options):
+        num_created = register_micrographs(options["directory"], options["force"])
+
+        self.stdout.write(self.style.SUCCESS(f"Registered {num_created} new "
+                                             f"micrographs."))
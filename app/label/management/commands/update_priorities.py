@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from label.scheduling import update_all_priorities
+
+class Command(BaseCommand):
+    help = "Recompute the labelling priority of every micrograph, e.g. after " \
+           "changing the priority weights."
+
+    def handle(self, *args, **options):
+        num_updated = update_all_priorities()
+
+        self.stdout.write(self.style.SUCCESS(f"Updated the priority of "
+                                             f"{num_updated} micrographs."))
@@ -0,0 +1,527 @@
+"""
+Decoding and persistence of uploaded micrograph label masks.
+
+Masks are held in memory as boolean NumPy arrays that are True wherever a
+filament has been labelled. This is the form that is fed to the label
+accumulator. On disk, masks are stored as 1-bit PNG images with filament
+pixels in black.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from io import BytesIO
+from PIL import Image
+
+import base64
+import numpy as np
+import os
+
+from . import metrics, rasterise, tiles
+
+# Grayscale values above this are treated as filament.
+THRESHOLD = 10
+
+# A single background thread used to write deferred masks to disk, so that
+# encoding doesn't hold up the ingestion of the next upload.
+_writer = ThreadPoolExecutor(max_workers=1)
+
+def decode_data_url(data_url):
+    """
+    Decode a PNG data URL from the labeller canvas into a binary mask.
+
+
+    Parameters
+    ----------
+
+    data_url : str
+        The base64 encoded data URL for the micrograph label mask.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+    return decode_png(base64.b64decode(data_url.split(",")[1]))
+
+def decode_png(data):
+    """
+    Decode PNG image bytes into a binary mask.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The PNG encoded micrograph label mask.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+
+    # Decode and convert to grayscale in a single pass, then threshold the
+    # whole array at once.
+    with metrics.ingest_stage_seconds.labels("decode").time():
+        image = np.asarray(Image.open(BytesIO(data)).convert("L"))
+
+    with metrics.ingest_stage_seconds.labels("threshold").time():
+        return image > THRESHOLD
+
+def decode_rle(data, shape=None):
+    """
+    Decode a run-length encoded mask.
+
+    The mask is encoded as a sequence of unsigned LEB128 variable-length
+    integers: the height, the width, then the lengths of alternating runs of
+    background and filament pixels in row-major order, starting with
+    background. The first run has zero length if the first pixel is
+    filament.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The run-length encoded micrograph label mask.
+
+    shape : (int, int)
+        The expected (height, width) of the mask, if known. The mask is
+        rejected before it is expanded if its shape doesn't match.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+    height, width = rle_shape(data)
+
+    if shape is not None and (height, width) != tuple(shape):
+        raise ValueError(f"Run-length encoded mask has shape {(height, width)}, "
+                         f"expected {tuple(shape)}")
+
+    runs = _decode_varints(data)[2:]
+
+    if int(runs.sum()) != height * width:
+        raise ValueError(f"Run-length encoded mask has {int(runs.sum())} "
+                         f"pixels, expected {height*width}")
+
+    # Runs alternate between background and filament.
+    states = np.zeros(len(runs), dtype=bool)
+    states[1::2] = True
+
+    return np.repeat(states, runs).reshape(height, width)
+
+def encode_rle(mask):
+    """
+    Run-length encode a mask in the format read by decode_rle, as the
+    labeller does before uploading it.
+
+
+    Parameters
+    ----------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+
+
+    Returns
+    -------
+
+    data : bytes
+        The run-length encoded mask.
+    """
+    flat = np.asarray(mask, dtype=bool).ravel()
+
+    # The lengths of the runs between each change of state, starting with a
+    # run of background.
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [len(flat)])))
+    if len(flat) > 0 and flat[0]:
+        runs = np.concatenate(([0], runs))
+
+    return _encode_varints(np.concatenate((mask.shape, runs)))
+
+def rle_shape(data):
+    """
+    Read the shape of a run-length encoded mask from its header, without
+    decoding the runs.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The run-length encoded micrograph label mask.
+
+
+    Returns
+    -------
+
+    shape : (int, int)
+        The (height, width) of the mask.
+    """
+    # Each integer is at most five bytes.
+    header = np.frombuffer(data[:10], dtype=np.uint8)
+    ends = np.flatnonzero((header & 0x80) == 0)
+
+    if len(ends) < 2:
+        raise ValueError("Run-length encoded mask is missing its shape")
+
+    height, width = _decode_varints(data[:ends[1]+1])
+
+    return int(height), int(width)
+
+def png_shape(data):
+    """
+    Read the shape of a PNG encoded mask from its header, without decoding
+    the pixels.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The PNG encoded micrograph label mask.
+
+
+    Returns
+    -------
+
+    shape : (int, int)
+        The (height, width) of the mask.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            return image.height, image.width
+    except OSError:
+        raise ValueError("Mask is not a valid image")
+
+def upload_shape(data, encoding):
+    """
+    Read the shape of an uploaded mask, or the canvas that vector strokes
+    were drawn on, without decoding it.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The encoded micrograph label mask.
+
+    encoding : str
+        The encoding of the mask: "png", "rle", or "json" for vector strokes.
+
+
+    Returns
+    -------
+
+    shape : (int, int)
+        The (height, width) of the upload.
+    """
+    if encoding == "png":
+        return png_shape(data)
+    elif encoding == "rle":
+        return rle_shape(data)
+    elif encoding == "json":
+        strokes = rasterise.parse_strokes(data)
+        return strokes["height"], strokes["width"]
+    else:
+        raise ValueError(f"Unsupported mask encoding '{encoding}'")
+
+def canvas_shape(micrograph):
+    """
+    Return the shape of the micrograph image served to the labeller, which
+    is the size of the labeller canvas.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+
+    Returns
+    -------
+
+    shape : (int, int)
+        The (height, width) of the image.
+    """
+    with Image.open(f"label/{micrograph.path}") as image:
+        return image.height, image.width
+
+def label_shape(micrograph):
+    """
+    Return the shape at which the labels for a micrograph are accumulated.
+    This is the full resolution of the micrograph, as given by its tile
+    pyramid, if PROOF_FULL_RESOLUTION_LABELS is set, otherwise the size of
+    the labeller canvas.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+
+    Returns
+    -------
+
+    shape : (int, int)
+        The (height, width) of the label masks.
+    """
+    if settings.PROOF_FULL_RESOLUTION_LABELS:
+        shape = tiles.full_resolution_shape(micrograph.name)
+        if shape is not None:
+            return shape
+
+    return canvas_shape(micrograph)
+
+def upload_shapes(micrograph):
+    """
+    Return the shapes that are accepted for uploads for a micrograph: the
+    size of the labeller canvas, and the levels of the micrograph's tile
+    pyramid that are at least as large, from its full resolution down.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+
+    Returns
+    -------
+
+    shapes : set
+        The accepted (height, width) shapes.
+    """
+    canvas = canvas_shape(micrograph)
+    shapes = {canvas}
+
+    descriptor = tiles.load_descriptor(micrograph.name)
+    if descriptor is not None:
+        for level in range(descriptor["max_level"], -1, -1):
+            shape = tiles.level_shape(descriptor, level)
+            if max(shape) < max(canvas):
+                break
+            shapes.add(shape)
+
+    return shapes
+
+def decode(data, encoding, shape=None, shapes=None):
+    """
+    Decode an uploaded mask.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The encoded micrograph label mask.
+
+    encoding : str
+        The encoding of the mask: "png", "rle", or "json" for vector strokes.
+
+    shape : (int, int)
+        The (height, width) of the decoded mask, e.g. the full resolution of
+        the micrograph. Vector strokes are rasterised at this resolution,
+        while raster masks are resampled to it. This must be given for
+        vector strokes. Raster masks default to the resolution of the upload.
+
+    shapes : set
+        The accepted shapes of the upload, as returned by upload_shapes. If
+        given, uploads of any other shape are rejected before they are
+        decoded.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+    if shapes is not None:
+        upload = upload_shape(data, encoding)
+        if upload not in shapes:
+            raise ValueError(f"Upload has shape {upload}, expected one of {sorted(shapes)}")
+
+    if encoding == "png":
+        mask = decode_png(data)
+    elif encoding == "rle":
+        with metrics.ingest_stage_seconds.labels("decode").time():
+            mask = decode_rle(data)
+    elif encoding == "json":
+        if shape is None:
+            raise ValueError("Strokes must be rasterised at the shape of the micrograph")
+        with metrics.ingest_stage_seconds.labels("decode").time():
+            return rasterise.rasterise_strokes(rasterise.parse_strokes(data, shapes), shape)
+    else:
+        raise ValueError(f"Unsupported mask encoding '{encoding}'")
+
+    if shape is not None:
+        mask = resample(mask, shape)
+
+    return mask
+
+def resample(mask, shape):
+    """
+    Resample a mask to a new resolution using nearest neighbour lookup.
+
+
+    Parameters
+    ----------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+
+    shape : (int, int)
+        The (height, width) of the resampled mask.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        The resampled mask.
+    """
+    if mask.shape == tuple(shape):
+        return mask
+
+    # Map the centre of each output pixel to the input pixel containing it.
+    rows = ((np.arange(shape[0]) + 0.5) * mask.shape[0] / shape[0]).astype(np.int64)
+    cols = ((np.arange(shape[1]) + 0.5) * mask.shape[1] / shape[1]).astype(np.int64)
+
+    return mask[np.ix_(rows, cols)]
+
+def save_mask(mask, mask_name, svg_serialized=None, strokes=None):
+    """
+    Write a mask to disk as a 1-bit PNG, along with the SVG representation
+    of the labels and the JSON encoded strokes, if provided.
+
+
+    Parameters
+    ----------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+
+    mask_name : str
+        The path to the mask, without extension.
+
+    svg_serialized : str
+        The serialized SVG image.
+
+    strokes : str
+        The JSON encoded strokes.
+    """
+
+    # Create the mask directory if it doesn't already exist.
+    os.makedirs(os.path.dirname(mask_name), exist_ok=True)
+
+    # Filament pixels are stored in black.
+    Image.fromarray(~mask).save(mask_name + ".png")
+
+    # Write the SVG to file.
+    if svg_serialized is not None:
+        with open(mask_name + ".svg", "w") as f:
+            f.write(svg_serialized)
+
+    # Write the strokes to file, so that the label can be re-rasterised.
+    if strokes is not None:
+        with open(mask_name + ".json", "w") as f:
+            f.write(strokes)
+
+def save_mask_deferred(mask, mask_name, svg_serialized=None, strokes=None):
+    """
+    Queue a mask to be written to disk by a background thread. The
+    arguments are the same as for save_mask.
+
+
+    Returns
+    -------
+
+    future : concurrent.futures.Future
+        A future that completes when the mask has been written.
+    """
+    return _writer.submit(save_mask, mask, mask_name, svg_serialized, strokes)
+
+def load_mask(mask_name):
+    """
+    Load a mask that was written with save_mask.
+
+
+    Parameters
+    ----------
+
+    mask_name : str
+        The path to the mask, without extension.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+    return ~np.asarray(Image.open(mask_name + ".png").convert("1"))
+
+def _encode_varints(values):
+    """
+    Helper function to encode a sequence of non-negative integers as unsigned
+    LEB128 variable-length integers in a single vectorised pass.
+    """
+    values = np.asarray(values, dtype=np.int64)
+
+    # The number of 7-bit groups needed for each integer, up to five.
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 5):
+        sizes += values >= (1 << (7 * k))
+
+    # The integer that each byte belongs to, and its position within it.
+    group = np.repeat(np.arange(len(values)), sizes)
+    position = np.arange(len(group)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    # Every byte but the last of each integer has its continuation bit set.
+    data = (values[group] >> (7 * position)) & 0x7f
+    data[position < sizes[group] - 1] |= 0x80
+
+    return data.astype(np.uint8).tobytes()
+
+def _decode_varints(data):
+    """
+    Helper function to decode a sequence of unsigned LEB128 variable-length
+    integers in a single vectorised pass.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # The last byte of each integer has its continuation bit clear.
+    ends = (data & 0x80) == 0
+    if not ends[-1]:
+        raise ValueError("Truncated variable-length integer")
+
+    # Find the first byte of each integer, and the position of every byte
+    # within its integer.
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    group = np.concatenate(([0], np.cumsum(ends)[:-1]))
+    position = np.arange(len(data)) - starts[group]
+
+    if position.max() > 4:
+        raise ValueError("Variable-length integer is too large")
+
+    # Shift the 7-bit groups into place and sum them for each integer.
+    values = (data & 0x7f).astype(np.int64) << (7 * position)
+
+    return np.add.reduceat(values, starts)
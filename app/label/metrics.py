@@ -0,0 +1,583 @@
+"""
+Lightweight in-process metrics for the labelling app.
+
+Each process records its metrics in memory. So that the metrics from every
+process, i.e. the Django server and each Celery worker, can be scraped from
+a single endpoint, each process periodically writes a snapshot of its
+metrics to its own file in METRICS_DIR. The snapshots are summed when the
+metrics are rendered in the Prometheus text exposition format:
+
+    label/metric_snapshots/<host>-<pid>-<token>.json
+    label/metric_snapshots/aggregate.json
+
+So that the snapshots don't build up as processes are restarted, the
+counters of processes that have exited are merged into the aggregate
+snapshot, which is summed with the others, and their snapshots are deleted.
+This keeps the counters from going backwards, which pruning the snapshots
+would do. Once a process has written a snapshot, a background thread
+rewrites it every FLUSH_INTERVAL seconds, so a snapshot that hasn't been
+written for STALE_INTERVAL seconds belongs to a process that has exited, on
+any host, e.g. a container that has been replaced. A process on the same
+host that has exited is detected straight away. Snapshots are merged when
+a process writes its snapshot, or when the metrics are scraped.
+"""
+
+from contextlib import contextmanager
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# All registered metrics, keyed by name.
+registry = {}
+
+# The directory in which each process writes a snapshot of its metrics.
+METRICS_DIR = "label/metric_snapshots"
+
+# The snapshot holding the summed metrics of processes that have exited.
+AGGREGATE_PATH = f"{METRICS_DIR}/aggregate.json"
+
+# The minimum number of seconds between snapshots of a process's metrics.
+FLUSH_INTERVAL = 5
+
+# The number of seconds after which a snapshot that hasn't been rewritten
+# belongs to a process that has exited.
+STALE_INTERVAL = 60
+
+# Latency buckets, in seconds.
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+class Metric:
+    """
+    A metric with an optional set of labels. Values are recorded for each
+    combination of label values.
+    """
+
+    # The Prometheus metric type.
+    type = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def labels(self, *values):
+        """
+        Return the metric for a combination of label values.
+
+
+        Parameters
+        ----------
+
+        values : [str]
+            The value of each label, in the order of the label names.
+
+
+        Returns
+        -------
+
+        child : label.metrics.Child
+            The metric for the label values.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' has labels {self.labelnames}")
+
+        return Child(self, tuple(str(value) for value in values))
+
+    def reset(self):
+        """
+        Clear the recorded values.
+        """
+        with self._lock:
+            self.values = {}
+
+    def snapshot(self):
+        """
+        Return the recorded values as a JSON serialisable dictionary.
+        """
+        with self._lock:
+            return {
+                     "type" : self.type,
+                     "description" : self.description,
+                     "labelnames" : list(self.labelnames),
+                     "buckets" : getattr(self, "buckets", None),
+                     "values" : [[list(key), value] for key, value in self.values.items()],
+                   }
+
+class Child:
+    """
+    A metric bound to a combination of label values.
+    """
+
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        """
+        Increment the count.
+        """
+        self._metric.inc(amount, _key=self._key)
+
+    def observe(self, value):
+        """
+        Record a value.
+        """
+        self._metric.observe(value, _key=self._key)
+
+    def time(self):
+        """
+        Context manager that records the number of seconds taken by the
+        enclosed block.
+        """
+        return self._metric.time(_key=self._key)
+
+class Counter(Metric):
+    """
+    A monotonically increasing count.
+    """
+
+    type = "counter"
+
+    def inc(self, amount=1, _key=()):
+        """
+        Increment the count.
+        """
+        with self._lock:
+            self.values[_key] = self.values.get(_key, 0) + amount
+
+    @property
+    def value(self):
+        """
+        The count, summed over all label values.
+        """
+        return sum(self.values.values())
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, bucketed by upper bound.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, description, buckets, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, _key=()):
+        """
+        Record a value.
+        """
+        with self._lock:
+            # The cumulative bucket counts, followed by the count and sum.
+            entry = self.values.get(_key)
+            if entry is None:
+                entry = self.values[_key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, _key=()):
+        """
+        Context manager that records the number of seconds taken by the
+        enclosed block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, _key=_key)
+
+# The identity of this process's snapshot file, when it was last written, and
+# the thread that keeps rewriting it.
+_process = {"host" : socket.gethostname(), "pid" : None, "token" : None, "flushed" : 0,
+            "heartbeat" : None}
+_flush_lock = threading.Lock()
+
+def _snapshot_path():
+    """
+    Helper function to return the path of this process's snapshot file. The
+    host identifies the PID namespace, and a random token distinguishes
+    processes that reuse a PID.
+    """
+    if _process["pid"] != os.getpid():
+        _process.update(pid=os.getpid(), token=uuid.uuid4().hex[:8], flushed=0)
+
+    return f"{METRICS_DIR}/{_process['host']}-{_process['pid']}-{_process['token']}.json"
+
+def _is_exited(path):
+    """
+    Helper function to return whether the process that wrote a snapshot is
+    known to have exited, either because its snapshot is stale, or because
+    it was on this host and is no longer running.
+    """
+    fields = os.path.basename(path)[:-len(".json")].rsplit("-", 2)
+    if len(fields) != 3:
+        return False
+
+    try:
+        if time.time() - os.path.getmtime(path) > STALE_INTERVAL:
+            return True
+    except FileNotFoundError:
+        return False
+
+    if fields[0] != _process["host"]:
+        return False
+
+    try:
+        os.kill(int(fields[1]), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        pass
+
+    return False
+
+def _merge_exited():
+    """
+    Helper function to merge the snapshots of processes that have exited
+    into the aggregate snapshot, and delete them.
+    """
+    own = _snapshot_path()
+    exited = [path for path in glob.glob(f"{METRICS_DIR}/*.json")
+              if path != own and _is_exited(path)]
+
+    if len(exited) == 0:
+        return
+
+    # Hold a lock while merging, so that each snapshot is only merged once.
+    with open(f"{METRICS_DIR}/aggregate.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        snapshots = []
+        merged = []
+        for path in [AGGREGATE_PATH] + exited:
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except FileNotFoundError:
+                # There is no aggregate yet, or another process has already
+                # merged the snapshot.
+                continue
+            except ValueError:
+                # The snapshot is corrupt, so can't be merged.
+                pass
+            if path != AGGREGATE_PATH:
+                merged.append(path)
+
+        aggregate = {name: dict(metric, values=[[list(key), value]
+                                                for key, value in metric["values"].items()])
+                     for name, metric in _sum(snapshots).items()}
+        with open(AGGREGATE_PATH + ".tmp", "w") as f:
+            json.dump(aggregate, f)
+        os.replace(AGGREGATE_PATH + ".tmp", AGGREGATE_PATH)
+
+        for path in merged:
+            os.remove(path)
+
+def _reset_after_fork():
+    """
+    Helper function to clear the metrics inherited by a forked child
+    process, e.g. a Celery worker, so that they aren't counted twice.
+    """
+    global _flush_lock
+
+    # A lock may have been held by another thread when the process forked.
+    # The heartbeat thread isn't copied, so is restarted by the next flush.
+    _flush_lock = threading.Lock()
+    _process["heartbeat"] = None
+    for metric in registry.values():
+        metric._lock = threading.Lock()
+        metric.values = {}
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def flush(force=False):
+    """
+    Write a snapshot of this process's metrics, so that they can be scraped
+    from another process. Snapshots are rate limited to one every
+    FLUSH_INTERVAL seconds, unless forced.
+
+
+    Parameters
+    ----------
+
+    force : bool
+        Whether to write the snapshot regardless of when the last one was
+        written.
+    """
+    with _flush_lock:
+        path = _snapshot_path()
+
+        now = time.monotonic()
+        if not force and now - _process["flushed"] < FLUSH_INTERVAL:
+            return
+        _process["flushed"] = now
+
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+        snapshot = {name: metric.snapshot() for name, metric in registry.items()}
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+        _merge_exited()
+
+        # Keep rewriting the snapshot while the process is running, so that
+        # it only goes stale once the process has exited.
+        if _process["heartbeat"] is None:
+            _process["heartbeat"] = threading.Thread(target=_heartbeat, daemon=True,
+                                                     name="metrics-heartbeat")
+            _process["heartbeat"].start()
+
+def _heartbeat():
+    """
+    Helper function to rewrite this process's snapshot every FLUSH_INTERVAL
+    seconds.
+    """
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush(force=True)
+        except Exception:
+            logger.exception("Failed to write the metrics snapshot")
+
+def collect():
+    """
+    Sum the metrics from this process with the latest snapshots from all
+    other processes, and the aggregate of those that have exited.
+
+
+    Returns
+    -------
+
+    metrics : dict
+        The snapshot of each metric, keyed by name, with the values summed
+        across processes.
+    """
+    if os.path.isdir(METRICS_DIR):
+        _merge_exited()
+
+    own = _snapshot_path()
+
+    snapshots = [{name: metric.snapshot() for name, metric in registry.items()}]
+    for path in glob.glob(f"{METRICS_DIR}/*.json"):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    return _sum(snapshots)
+
+def _sum(snapshots):
+    """
+    Helper function to sum the values of each metric over a list of
+    snapshots.
+    """
+    metrics = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if name not in metrics:
+                metrics[name] = dict(metric, values={})
+            values = metrics[name]["values"]
+            for key, value in metric["values"]:
+                key = tuple(key)
+                if key not in values:
+                    values[key] = value
+                elif isinstance(value, list):
+                    values[key] = [a + b for a, b in zip(values[key], value)]
+                else:
+                    values[key] += value
+
+    return metrics
+
+def render():
+    """
+    Render the metrics from all processes in the Prometheus text exposition
+    format.
+
+
+    Returns
+    -------
+
+    text : str
+        The metrics.
+    """
+    lines = []
+
+    for name, metric in sorted(collect().items()):
+        lines.append(f"# HELP {name} {metric['description']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+
+        # Metrics without labels are reported even if nothing was recorded.
+        values = metric["values"]
+        if len(values) == 0 and len(metric["labelnames"]) == 0:
+            values = {() : [0] * (len(metric["buckets"]) + 2)
+                           if metric["type"] == "histogram" else 0}
+
+        for key, value in sorted(values.items()):
+            labels = list(zip(metric["labelnames"], key))
+
+            if metric["type"] == "histogram":
+                bounds = [_format(bound) for bound in metric["buckets"]] + ["+Inf"]
+                counts = value[:len(metric["buckets"])] + [value[-2]]
+                for bound, count in zip(bounds, counts):
+                    lines.append(f"{name}_bucket{_labels(labels + [('le', bound)])} {count}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_sum{_labels(labels)} {_format(value[-1])}")
+            else:
+                lines.append(f"{name}{_labels(labels)} {_format(value)}")
+
+    return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    """
+    Helper function to format a set of labels.
+    """
+    if len(labels) == 0:
+        return ""
+
+    def escape(value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+def _format(value):
+    """
+    Helper function to format a sample value.
+    """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Ingestion metrics.
+ingest_batch_size = Histogram(
+        "proof_ingest_batch_size",
+        "The number of uploaded masks committed in each ingestion batch.",
+        [1, 2, 4, 8, 16, 32, 64]
+        )
+ingest_conflicts_avoided = Counter(
+        "proof_ingest_conflicts_avoided_total",
+        "Micrograph record updates saved by batching uploads together."
+        )
+ingest_conflicts = Counter(
+        "proof_ingest_conflicts_total",
+        "Ingestion batches that hit a concurrent micrograph record update, "
+        "and were rescheduled."
+        )
+ingest_stage_seconds = Histogram(
+        "proof_ingest_stage_seconds",
+        "The time taken by each stage of processing an upload: decode, "
+        "threshold, accumulate, commit (updating the database), and save "
+        "(writing the masks).",
+        LATENCY_BUCKETS,
+        ["stage"]
+        )
+upload_bytes = Histogram(
+        "proof_upload_bytes",
+        "The size of each upload, by encoding.",
+        [1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20],
+        ["encoding"]
+        )
+
+# Cache metrics. The hit rate of each cache is the ratio of its hits to all
+# of its requests.
+cache_requests = Counter(
+        "proof_cache_requests_total",
+        "Requests for cached files, by cache and result (hit or miss).",
+        ["cache", "result"]
+        )
+
+# Micrographs served, by format. Clients that don't support any of the
+# compressed variants are served the original PNG.
+micrograph_formats = Counter(
+        "proof_micrograph_formats_total",
+        "Micrograph images served to labellers, by image format.",
+        ["format"]
+        )
+
+# View metrics.
+view_seconds = Histogram(
+        "proof_view_seconds",
+        "The time taken to handle each request, by view.",
+        LATENCY_BUCKETS,
+        ["view"]
+        )
+view_db_seconds = Histogram(
+        "proof_view_db_seconds",
+        "The time spent in database queries while handling each request, by view.",
+        LATENCY_BUCKETS,
+        ["view"]
+        )
+view_responses = Counter(
+        "proof_view_responses_total",
+        "Responses, by view and status code.",
+        ["view", "status"]
+        )
+
+# Task metrics.
+task_seconds = Histogram(
+        "proof_task_seconds",
+        "The time taken to run each task, by task.",
+        LATENCY_BUCKETS,
+        ["task"]
+        )
+task_db_seconds = Histogram(
+        "proof_task_db_seconds",
+        "The time spent in database queries while running each task, by task.",
+        LATENCY_BUCKETS,
+        ["task"]
+        )
+task_queue_seconds = Histogram(
+        "proof_task_queue_seconds",
+        "The time from publishing each task to it starting on a worker, by "
+        "task. This includes any countdown.",
+        LATENCY_BUCKETS,
+        ["task"]
+        )
+task_publish_seconds = Histogram(
+        "proof_task_publish_seconds",
+        "The time taken to serialise and send each task to the broker, by task.",
+        LATENCY_BUCKETS,
+        ["task"]
+        )
+task_results = Counter(
+        "proof_task_results_total",
+        "Finished tasks, by task and state.",
+        ["task", "state"]
+        )
+task_retries = Counter(
+        "proof_task_retries_total",
+        "Task retries, by task.",
+        ["task"]
+        )
+
+class QueryTimer:
+    """
+    A database execute wrapper that adds up the time spent in queries.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
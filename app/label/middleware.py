@@ -0,0 +1,129 @@
+"""
+Middleware recording the latency of each view, and optionally profiling a
+sample of requests.
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+import cProfile
+import os
+import random
+import threading
+import time
+
+from . import metrics
+
+# Only one request is profiled at a time, since only one profiler can be
+# active in a process.
+_profiling = threading.Lock()
+
+class MetricsMiddleware:
+    """
+    Record the time taken by each request, and the time spent in database
+    queries, labelled by the name of the view that handled it.
+
+    If PROOF_PROFILE_RATE is set, that fraction of requests is run under
+    cProfile, and the profiles are written to PROOF_PROFILE_DIR as
+    <view>-<time>.prof, for inspection with pstats or snakeviz. When served
+    asynchronously, the profile covers the event loop, so it also includes
+    any other requests that were being served at the same time.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        # Run asynchronously if the rest of the stack does, so that async
+        # views aren't forced onto a thread.
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timer = metrics.QueryTimer()
+        profiler = self._start_profile()
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+
+        self._finish(request, response, time.perf_counter() - start, timer, profiler)
+
+        return response
+
+    async def __acall__(self, request):
+        timer = metrics.QueryTimer()
+        profiler = self._start_profile()
+
+        # Database queries are run on the thread used for the request's
+        # synchronous code, so the timer is attached to its connection.
+        wrapper = await sync_to_async(_enter_wrapper)(timer)
+
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrapper.__exit__)(None, None, None)
+
+        self._finish(request, response, time.perf_counter() - start, timer, profiler)
+
+        return response
+
+    def _start_profile(self):
+        """
+        Start profiling if this request is sampled, returning the profiler.
+        """
+        if settings.PROOF_PROFILE_RATE > 0 and random.random() < settings.PROOF_PROFILE_RATE \
+            and _profiling.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+
+        return None
+
+    def _finish(self, request, response, seconds, timer, profiler):
+        """
+        Record the metrics for a request, and write its profile, if any.
+        """
+        if profiler is not None:
+            profiler.disable()
+            _profiling.release()
+
+        # Views are labelled by their URL pattern. Requests that didn't
+        # resolve to a view are grouped together.
+        match = request.resolver_match
+        view = match.route if match else "unresolved"
+
+        metrics.view_seconds.labels(view).observe(seconds)
+        metrics.view_db_seconds.labels(view).observe(timer.seconds)
+        metrics.view_responses.labels(view, response.status_code).inc()
+
+        if profiler is not None:
+            os.makedirs(settings.PROOF_PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(f"{settings.PROOF_PROFILE_DIR}/"
+                                f"{_slug(view)}-{time.time():.6f}.prof")
+
+        # Make the metrics for this process visible to the scrape endpoint.
+        metrics.flush()
+
+def _enter_wrapper(timer):
+    """
+    Helper function to attach a query timer to the database connection for
+    the current thread.
+    """
+    wrapper = connection.execute_wrapper(timer)
+    wrapper.__enter__()
+
+    return wrapper
+
+def _slug(route):
+    """
+    Helper function to turn a URL pattern into part of a file name.
+    """
+    return "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
@@ -1,6 +1,5 @@
 from concurrency.fields import IntegerVersionField
 from django.db import models
-from django_mysql.models import ListTextField
 
 class Micrograph(models.Model):
     version = IntegerVersionField(
@@ -10,20 +9,125 @@ class Micrograph(models.Model):
             max_length = 100,
             help_text = "The path to the micrograph image."
             )
-    ip_addresses = ListTextField(
-            base_field = models.CharField(max_length=39),
-            help_text = "A list of IP addresses that have uploaded labels "
-                        "for this micrograph."
+    key = models.CharField(
+            max_length = 64,
+            unique = True,
+            null = True,
+            help_text = "A key derived from the contents of the micrograph "
+                        "image, used to register each image only once."
             )
     num_labels = models.IntegerField(
             default = 0,
             help_text = "The number of uploaded labels for this micrograph."
             )
-    average = models.BinaryField(
-            default = b"",
-            help_text = "The average of the micrograph labels."
-            )
     variance = models.FloatField(
             default = 0.0,
             help_text = "The variance in the labelling for this micrograph."
             )
+    label_sum = models.BigIntegerField(
+            default = 0,
+            help_text = "The sum of the label counts over all pixels."
+            )
+    label_sum_squares = models.BigIntegerField(
+            default = 0,
+            help_text = "The sum of the squared label counts over all pixels."
+            )
+    prediction_uncertainty = models.FloatField(
+            default = 0.0,
+            help_text = "The uncertainty of the predicted filaments for this "
+                        "micrograph, between 0 and 1."
+            )
+    priority = models.FloatField(
+            default = 1.0,
+            db_index = True,
+            help_text = "The labelling priority. Higher priority micrographs "
+                        "are served to labellers first."
+            )
+    statistics_dirty = models.BooleanField(
+            default = False,
+            db_index = True,
+            help_text = "Whether the label statistics may be out of step with "
+                        "the masks, e.g. after a failed rollback, and need "
+                        "rebuilding."
+            )
+
+    @property
+    def name(self):
+        """
+        The name of the micrograph with no path or extension. This is used
+        to name the masks and the label accumulator for the micrograph.
+        """
+        return self.path.split("/")[2].split(".")[0]
+
+class Label(models.Model):
+    micrograph = models.ForeignKey(
+            Micrograph,
+            on_delete = models.CASCADE,
+            related_name = "labels",
+            help_text = "The micrograph that was labelled."
+            )
+    ip_address = models.CharField(
+            max_length = 39,
+            help_text = "The IP address of the client that uploaded the label."
+            )
+
+    class Meta:
+        # Index on (IP address, micrograph) so that the micrographs labelled
+        # by a client can be found, or excluded, with a single index lookup.
+        indexes = [
+            models.Index(fields=["ip_address", "micrograph"]),
+        ]
+
+class Reservation(models.Model):
+    micrograph = models.ForeignKey(
+            Micrograph,
+            on_delete = models.CASCADE,
+            related_name = "reservations",
+            help_text = "The micrograph that has been reserved."
+            )
+    ip_address = models.CharField(
+            max_length = 39,
+            help_text = "The IP address of the client holding the reservation."
+            )
+    expires = models.DateTimeField(
+            db_index = True,
+            help_text = "The time at which the reservation lapses."
+            )
+
+    class Meta:
+        # Index on (IP address, micrograph, expiry) so that the live
+        # reservations held by a client can be excluded with an index lookup.
+        indexes = [
+            models.Index(fields=["ip_address", "micrograph", "expires"]),
+        ]
+        # A client holds at most one reservation for each micrograph.
+        constraints = [
+            models.UniqueConstraint(fields=["micrograph", "ip_address"],
+                                    name="unique_reservation"),
+        ]
+
+class Event(models.Model):
+    ip_address = models.CharField(
+            max_length = 39,
+            help_text = "The IP address of the client that the event is for."
+            )
+    kind = models.CharField(
+            max_length = 32,
+            help_text = "The kind of event, e.g. \"upload\" once an upload has "
+                        "been processed."
+            )
+    data = models.TextField(
+            help_text = "The JSON encoded event data."
+            )
+    created = models.DateTimeField(
+            auto_now_add = True,
+            db_index = True,
+            help_text = "The time at which the event was published."
+            )
+
+    class Meta:
+        # Index on (IP address, id) so that the events for a client that
+        # follow the last one it received can be found with an index lookup.
+        indexes = [
+            models.Index(fields=["ip_address", "id"]),
+        ]
@@ -0,0 +1,221 @@
+"""
+Vectorised rasterisation of the filament strokes drawn in the labeller.
+
+Strokes are uploaded as JSON of the form:
+
+    {
+        "width" : 800,
+        "height" : 800,
+        "paths" : [[[x0, y0], [x1, y1], ...], ...],
+        "widths" : [10, ...]
+    }
+
+where the coordinates are in the canvas space given by the width and height,
+and each path has its own line width. Paths are drawn as round-capped line
+segments, as on the labeller canvas, and can be rasterised at any target
+resolution, so stored labels can be re-rasterised without re-labelling.
+Uploads are always rasterised at the shape of the micrograph's labels, so the
+canvas size given by the client only scales the coordinates. The number of
+paths and points in an upload is limited by PROOF_MAX_STROKE_PATHS and
+PROOF_MAX_STROKE_POINTS, and the memory used to rasterise them by MAX_PAIRS.
+"""
+
+from django.conf import settings
+
+import json
+import numpy as np
+
+# The maximum number of (segment, pixel) pairs that are tested at once. This
+# bounds the memory used when rasterising long line segments, which are split
+# into bands of rows if their bounding box holds more pixels than this.
+MAX_PAIRS = 4000000
+
+# The maximum canvas dimension that will be accepted. The canvas must also be
+# one of the shapes accepted for the micrograph, if they are given.
+MAX_SIZE = 65536
+
+def parse_strokes(data, shapes=None):
+    """
+    Parse and validate uploaded strokes.
+
+
+    Parameters
+    ----------
+
+    data : bytes, str
+        The JSON encoded strokes.
+
+    shapes : set
+        The accepted (height, width) shapes of the canvas, e.g. the size of
+        the micrograph or a known downsample of it. Any canvas up to MAX_SIZE
+        is accepted if not given.
+
+
+    Returns
+    -------
+
+    strokes : dict
+        The validated strokes.
+    """
+    try:
+        strokes = json.loads(data)
+    except ValueError:
+        raise ValueError("Strokes are not valid JSON")
+
+    if not isinstance(strokes, dict):
+        raise ValueError("Strokes must be a JSON object")
+
+    for key in ["width", "height"]:
+        value = strokes.get(key)
+        if not isinstance(value, int) or not 0 < value <= MAX_SIZE:
+            raise ValueError(f"Invalid canvas {key}: {value}")
+
+    if shapes is not None and (strokes["height"], strokes["width"]) not in shapes:
+        raise ValueError(f"Canvas shape {(strokes['height'], strokes['width'])} doesn't "
+                         f"match the micrograph, expected one of {sorted(shapes)}")
+
+    paths = strokes.get("paths")
+    widths = strokes.get("widths")
+
+    if not isinstance(paths, list) or not isinstance(widths, list) \
+        or len(paths) != len(widths):
+        raise ValueError("Strokes must have a width for each path")
+
+    if len(paths) > settings.PROOF_MAX_STROKE_PATHS:
+        raise ValueError(f"Strokes have {len(paths)} paths, the maximum is "
+                         f"{settings.PROOF_MAX_STROKE_PATHS}")
+
+    num_points = sum(len(path) if isinstance(path, list) else 0 for path in paths)
+    if num_points > settings.PROOF_MAX_STROKE_POINTS:
+        raise ValueError(f"Strokes have {num_points} points, the maximum is "
+                         f"{settings.PROOF_MAX_STROKE_POINTS}")
+
+    for path, width in zip(paths, widths):
+        try:
+            points = np.asarray(path, dtype=float).reshape(-1, 2)
+            width = float(width)
+        except (TypeError, ValueError):
+            raise ValueError("Paths must be lists of [x, y] coordinates")
+
+        if len(path) == 0 or len(points) != len(path) or not width > 0 \
+            or not np.all(np.isfinite(points)):
+            raise ValueError("Paths must be lists of [x, y] coordinates "
+                             "with a positive line width")
+
+    return strokes
+
+def rasterise_strokes(strokes, shape):
+    """
+    Rasterise strokes into a binary mask.
+
+    A pixel is marked as filament if its centre lies within half a line
+    width, plus half a pixel, of a path. The extra half pixel approximates
+    the canvas, where any pixel that is partially covered by an anti-aliased
+    stroke is labelled.
+
+
+    Parameters
+    ----------
+
+    strokes : dict
+        The strokes, as returned by parse_strokes.
+
+    shape : (int, int)
+        The (height, width) of the mask, i.e. the shape of the labels for
+        the micrograph. This is never taken from the strokes, so that the
+        size of the mask can't be chosen by the client.
+
+
+    Returns
+    -------
+
+    mask : numpy.ndarray
+        A boolean array that is True for filament pixels.
+    """
+    height, width = shape
+
+    # Scale factors from canvas coordinates to mask pixels.
+    scale_x = width / strokes["width"]
+    scale_y = height / strokes["height"]
+    scale = 0.5 * (scale_x + scale_y)
+
+    # Gather the line segments of all paths. A single point is drawn as a
+    # segment of zero length, i.e. a dot.
+    starts, ends, radii = [], [], []
+    for path, line_width in zip(strokes["paths"], strokes["widths"]):
+        points = np.asarray(path, dtype=float).reshape(-1, 2) * (scale_x, scale_y)
+        starts.append(points[:max(1, len(points)-1)])
+        ends.append(points[min(1, len(points)-1):])
+        radii.append(np.full(max(1, len(points)-1),
+                             0.5 * float(line_width) * scale + 0.5))
+
+    mask = np.zeros(shape, dtype=bool)
+
+    if len(starts) == 0:
+        return mask
+
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    radii = np.concatenate(radii)
+
+    # The bounding box of each segment, clipped to the mask.
+    x0 = np.clip(np.floor(np.minimum(starts[:, 0], ends[:, 0]) - radii), 0, width).astype(np.int64)
+    x1 = np.clip(np.ceil(np.maximum(starts[:, 0], ends[:, 0]) + radii), 0, width).astype(np.int64)
+    y0 = np.clip(np.floor(np.minimum(starts[:, 1], ends[:, 1]) - radii), 0, height).astype(np.int64)
+    y1 = np.clip(np.ceil(np.maximum(starts[:, 1], ends[:, 1]) + radii), 0, height).astype(np.int64)
+    nx = x1 - x0
+    ny = y1 - y0
+
+    # Split the bounding box of any segment that is too large to test at once
+    # into bands of rows, each holding at most MAX_PAIRS pixels.
+    rows = np.maximum(1, MAX_PAIRS // np.maximum(nx, 1))
+    bands = np.maximum(1, -(-ny // rows))
+    segment = np.repeat(np.arange(len(nx)), bands)
+    band = np.arange(len(segment)) - np.repeat(np.cumsum(bands) - bands, bands)
+    starts, ends, radii = starts[segment], ends[segment], radii[segment]
+    x0, nx = x0[segment], nx[segment]
+    y0 = y0[segment] + band * rows[segment]
+    ny = np.minimum(rows[segment], y1[segment] - y0)
+    sizes = nx * ny
+
+    # Rasterise the segments in chunks so that the number of (segment, pixel)
+    # pairs held in memory is bounded.
+    first = 0
+    while first < len(sizes):
+        last = first + max(1, int(np.searchsorted(np.cumsum(sizes[first:]), MAX_PAIRS,
+                                                  side="right")))
+        _rasterise_segments(mask, starts[first:last], ends[first:last],
+                            radii[first:last], x0[first:last], y0[first:last],
+                            nx[first:last], sizes[first:last])
+        first = last
+
+    return mask
+
+def _rasterise_segments(mask, starts, ends, radii, x0, y0, nx, sizes):
+    """
+    Helper function to mark the pixels within range of a set of line
+    segments, testing every pixel in every segment's bounding box at once.
+    """
+    total = int(sizes.sum())
+    if total == 0:
+        return
+
+    # Enumerate the pixels in each bounding box.
+    segment = np.repeat(np.arange(len(sizes)), sizes)
+    offset = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    px = x0[segment] + offset % nx[segment]
+    py = y0[segment] + offset // nx[segment]
+
+    # Find the closest point on each segment to each pixel centre.
+    ax, ay = starts[segment, 0], starts[segment, 1]
+    dx = ends[segment, 0] - ax
+    dy = ends[segment, 1] - ay
+    cx = px + 0.5 - ax
+    cy = py + 0.5 - ay
+    length2 = dx*dx + dy*dy
+    t = np.divide(cx*dx + cy*dy, length2, out=np.zeros(total), where=length2 > 0)
+    t = np.clip(t, 0, 1)
+
+    # Mark the pixels that are within range.
+    hit = (cx - t*dx)**2 + (cy - t*dy)**2 <= radii[segment]**2
+    mask[py[hit], px[hit]] = True
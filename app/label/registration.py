@@ -0,0 +1,168 @@
+"""
+Incremental registration of the micrograph images in the database.
+
+Each micrograph is identified by a key derived from the contents of its image,
+so the primary key of a micrograph never depends on the order in which the
+images are found, and the same image is never registered twice. Only new
+images are hashed and inserted. A signature of the directory listing is kept
+from the last registration, so that when nothing has changed, registration is
+a single directory scan and a row count.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+
+from .models import Micrograph
+
+logger = logging.getLogger(__name__)
+
+# The directory containing the micrograph images.
+MICROGRAPH_DIR = "label/static/micrographs"
+
+# The name of the file recording the last registration, within the directory.
+SIGNATURE = ".registered"
+
+def micrograph_key(path):
+    """
+    Return the key for a micrograph, derived from the contents of its image.
+
+
+    Parameters
+    ----------
+
+    path : str
+        The path to the micrograph image.
+
+
+    Returns
+    -------
+
+    key : str
+        The hexadecimal SHA-256 digest of the image.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def listing_signature(paths):
+    """
+    Return a signature of a directory listing, which changes if any image is
+    added, removed, or modified.
+
+
+    Parameters
+    ----------
+
+    paths : [str]
+        The paths to the micrograph images.
+
+
+    Returns
+    -------
+
+    signature : str
+        The signature.
+    """
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+    return h.hexdigest()
+
+def register_micrographs(directory=MICROGRAPH_DIR, force=False):
+    """
+    Register any new micrograph images in the database.
+
+
+    Parameters
+    ----------
+
+    directory : str
+        The directory containing the micrograph images.
+
+    force : bool
+        Whether to compare every image with the database, even if the
+        directory hasn't changed since the last registration.
+
+
+    Returns
+    -------
+
+    num_created : int
+        The number of micrographs that were added.
+    """
+    paths = sorted(path for path in glob.glob(f"{directory}/*.png")
+                   if not path.endswith(".tmp.png"))
+    signature = listing_signature(paths)
+
+    # Nothing has changed since the last registration.
+    previous = _load_signature(directory)
+    if not force and previous.get("signature") == signature \
+        and previous.get("count") == Micrograph.objects.count():
+        return 0
+
+    # Paths are stored relative to the label app.
+    relative = {path: "static/micrographs/" + os.path.basename(path) for path in paths}
+
+    existing = dict(Micrograph.objects.values_list("path", "key"))
+
+    # Fill in the keys of micrographs registered before keys were introduced.
+    missing = list(Micrograph.objects.filter(key__isnull=True).only("id", "path"))
+    for micrograph in missing:
+        path = f"{directory}/{os.path.basename(micrograph.path)}"
+        if os.path.exists(path):
+            micrograph.key = micrograph_key(path)
+            existing[micrograph.path] = micrograph.key
+    Micrograph.objects.bulk_update([m for m in missing if m.key], ["key"], batch_size=500)
+
+    by_key = {key: path for path, key in existing.items() if key}
+
+    # Only hash the images that aren't already registered.
+    new = []
+    for path in paths:
+        if relative[path] in existing:
+            continue
+
+        key = micrograph_key(path)
+
+        # The image is a copy, or a renamed version, of a registered image.
+        # Masks are stored by name, so the existing micrograph isn't moved.
+        if key in by_key:
+            logger.warning(f"Skipping '{path}', which duplicates '{by_key[key]}'")
+            continue
+
+        by_key[key] = relative[path]
+        new.append(Micrograph(path=relative[path], key=key))
+
+    # Insert the new micrographs in bulk.
+    Micrograph.objects.bulk_create(new, batch_size=500)
+
+    _save_signature(directory, signature, Micrograph.objects.count())
+
+    return len(new)
+
+def _load_signature(directory):
+    """
+    Helper function to load the record of the last registration.
+    """
+    try:
+        with open(f"{directory}/{SIGNATURE}") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_signature(directory, signature, count):
+    """
+    Helper function to atomically save the record of a registration.
+    """
+    path = f"{directory}/{SIGNATURE}"
+    with open(path + ".tmp", "w") as f:
+        json.dump({"signature" : signature, "count" : count}, f)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,340 @@
+"""
+Cached images derived from the running label counts for each micrograph.
+
+Renders are keyed by the micrograph index and the number of labels that they
+were computed from, so each kind of render is computed at most once per
+label count. When a new label arrives the key changes, which invalidates the
+cached render, and older renders of the same kind for the micrograph are
+removed. Since a key always refers to the same image, renders are served
+from versioned URLs with long-lived HTTP caching. The cache is bounded, with
+the least recently used renders evicted first.
+"""
+
+from PIL import Image
+
+import glob
+import numpy as np
+import os
+import time
+import uuid
+
+from . import accumulator, metrics
+
+# The directory in which the renders are stored.
+RENDER_DIR = "label/renders"
+
+def render_path(index, kind, num_labels):
+    """
+    Return the path to a render.
+
+
+    Parameters
+    ----------
+
+    index : int
+        The index of the micrograph in the Django database.
+
+    kind : str
+        The kind of render, i.e. "average" or "variance".
+
+    num_labels : int
+        The number of labels that the render was computed from.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the render.
+    """
+    return f"{RENDER_DIR}/{index}-{kind}-{num_labels}.png"
+
+def render_url(micrograph, kind):
+    """
+    Return the versioned URL of a render, relative to the site root.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    kind : str
+        The kind of render, i.e. "average" or "variance".
+
+
+    Returns
+    -------
+
+    url : str, None
+        The URL of the render, or None if there are no labels.
+    """
+    if micrograph.num_labels == 0:
+        return None
+
+    return f"label/renders/{kind}/{micrograph.id}/{micrograph.num_labels}.png"
+
+def load_counts(micrograph):
+    """
+    Return a copy of the label counts for a micrograph, taken while holding
+    its lock, and refresh the number of labels for the micrograph so that it
+    is consistent with the counts.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+
+    Returns
+    -------
+
+    counts : numpy.ndarray, None
+        The number of labels marking each pixel as filament, or None if no
+        labels have been accumulated.
+    """
+    with accumulator.lock(micrograph.name):
+        micrograph.refresh_from_db(fields=["num_labels"])
+        counts = accumulator.load_accumulator(micrograph.name)
+        if counts is not None:
+            counts = np.array(counts)
+
+    return counts
+
+def average_map(counts, num_labels):
+    """
+    Compute the average of the labels from the label counts, as a grayscale
+    image with filament pixels in black.
+
+
+    Parameters
+    ----------
+
+    counts : numpy.ndarray
+        The number of labels marking each pixel as filament.
+
+    num_labels : int
+        The number of labels.
+
+
+    Returns
+    -------
+
+    average : numpy.ndarray
+        The average image.
+    """
+    return (255 * (num_labels - counts.astype(np.uint32)) / num_labels).astype(np.uint8)
+
+def variance_map(counts, num_labels):
+    """
+    Compute the per-pixel variance of the labels from the label counts.
+    Since each label is binary, this is p(1 - p), where p is the fraction of
+    labels marking the pixel as filament. It is zero where the labellers all
+    agree, and 0.25 where they are evenly split.
+
+
+    Parameters
+    ----------
+
+    counts : numpy.ndarray
+        The number of labels marking each pixel as filament.
+
+    num_labels : int
+        The number of labels.
+
+
+    Returns
+    -------
+
+    variance : numpy.ndarray
+        The variance at each pixel.
+    """
+    p = counts / num_labels
+    return p * (1 - p)
+
+def _variance_image(counts, num_labels):
+    """
+    Helper function to render the per-pixel label disagreement as a red
+    heatmap, whose opacity is proportional to the variance, so that it can
+    be overlaid on the micrograph.
+    """
+    image = np.zeros(counts.shape + (4,), dtype=np.uint8)
+    image[..., 0] = 255
+    image[..., 3] = np.round(4 * 255 * variance_map(counts, num_labels)).astype(np.uint8)
+
+    return image
+
+# The functions used to render each kind of image from the label counts.
+KINDS = {
+    "average" : average_map,
+    "variance" : _variance_image,
+}
+
+def get_render(micrograph, kind, max_renders=None):
+    """
+    Return the path to a render for a micrograph, rendering it if it isn't
+    already cached.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph. The number of labels is refreshed if the render is
+        computed, since more labels may have arrived.
+
+    kind : str
+        The kind of render, i.e. "average" or "variance".
+
+    max_renders : int
+        The maximum number of renders to keep in the cache. Defaults to no
+        limit.
+
+
+    Returns
+    -------
+
+    path : str, None
+        The path to the render, or None if there are no labels.
+    """
+    if micrograph.num_labels == 0:
+        return None
+
+    path = render_path(micrograph.id, kind, micrograph.num_labels)
+
+    # Cache hit. Mark the render as recently used.
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+            metrics.cache_requests.labels("render", "hit").inc()
+            return path
+        except FileNotFoundError:
+            # The render was evicted in the meantime.
+            pass
+
+    metrics.cache_requests.labels("render", "miss").inc()
+
+    counts = load_counts(micrograph)
+
+    if counts is None or micrograph.num_labels == 0:
+        return None
+
+    # More labels may have arrived in the meantime.
+    path = render_path(micrograph.id, kind, micrograph.num_labels)
+
+    _write_render(KINDS[kind](counts, micrograph.num_labels), path)
+    _remove_superseded(micrograph.id, kind, micrograph.num_labels)
+
+    if max_renders is not None:
+        evict(max_renders)
+
+    return path
+
+def evict(max_renders):
+    """
+    Remove the least recently used renders so that no more than max_renders
+    remain in the cache.
+
+
+    Parameters
+    ----------
+
+    max_renders : int
+        The maximum number of renders to keep.
+
+
+    Returns
+    -------
+
+    num_removed : int
+        The number of renders that were removed.
+    """
+    paths = []
+    for path in glob.glob(f"{RENDER_DIR}/*.png"):
+        try:
+            paths.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            pass
+
+    num_removed = 0
+    for _, path in sorted(paths)[:max(0, len(paths) - max_renders)]:
+        num_removed += _remove(path)
+
+    return num_removed
+
+def sweep(current, max_age):
+    """
+    Remove renders that are stale, i.e. computed from an out of date number
+    of labels, or that haven't been used for max_age seconds, along with any
+    partially written renders.
+
+
+    Parameters
+    ----------
+
+    current : dict
+        The current number of labels for each micrograph index.
+
+    max_age : float
+        The number of seconds after which an unused render is removed.
+
+
+    Returns
+    -------
+
+    num_removed : int
+        The number of files that were removed.
+    """
+    num_removed = 0
+    cutoff = time.time() - max_age
+
+    for path in glob.glob(f"{RENDER_DIR}/*"):
+        try:
+            if path.endswith(".tmp"):
+                is_stale = os.path.getmtime(path) < cutoff
+            else:
+                index, kind, num_labels = os.path.basename(path).split(".")[0].split("-")
+                is_stale = current.get(int(index)) != int(num_labels) \
+                        or os.path.getmtime(path) < cutoff
+        except (ValueError, FileNotFoundError):
+            continue
+
+        if is_stale:
+            num_removed += _remove(path)
+
+    return num_removed
+
+def _write_render(image, path):
+    """
+    Helper function to write a render so that it is never seen partially
+    written. Each writer uses its own temporary file, since the same render
+    may be requested by several clients at once.
+    """
+    os.makedirs(RENDER_DIR, exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    Image.fromarray(image).save(tmp, format="PNG")
+    os.replace(tmp, path)
+
+def _remove_superseded(index, kind, num_labels):
+    """
+    Helper function to remove the renders of a kind for a micrograph that
+    were computed from fewer labels. Those computed from more labels, e.g. by
+    another worker, are kept.
+    """
+    for path in glob.glob(f"{RENDER_DIR}/{index}-{kind}-*.png"):
+        if int(path[:-len(".png")].rsplit("-", 1)[1]) < num_labels:
+            _remove(path)
+
+def _remove(path):
+    """
+    Helper function to remove a file that may already have been removed.
+    Returns the number of files removed.
+    """
+    try:
+        os.remove(path)
+        return 1
+    except FileNotFoundError:
+        return 0
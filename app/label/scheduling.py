@@ -0,0 +1,205 @@
+"""
+Priority-driven scheduling of micrographs for labelling.
+
+Each micrograph has a priority, stored in an indexed column so that the most
+useful micrographs can be found without scanning the table. The priority is
+a weighted sum of:
+
+    The label deficit: the fraction of the target number of labels that
+    the micrograph is still missing.
+
+    The disagreement between its labels: the label variance, summed over
+    the pixels and relative to the mean labelled area. This is zero when
+    the labels agree exactly and approaches one when they don't overlap.
+    Unlike the variance averaged over all pixels, it doesn't depend on how
+    much of the micrograph is filament.
+
+    The uncertainty of the predicted filaments, if any: the mean of
+    4 p (1 - p) over the pixels, where p is the predicted probability.
+
+The priority is recomputed whenever labels are ingested or a prediction is
+made. When serving micrographs, a reservation held by another labeller
+counts as a label that is on its way, so concurrent labellers are spread
+across the highest priority micrographs.
+"""
+
+from django.conf import settings
+from django.db.models import Count
+
+import random
+
+from .models import Micrograph, Reservation
+
+def disagreement(num_labels, label_sum, label_sum_squares):
+    """
+    Compute the disagreement between the labels for a micrograph.
+
+    With S the label count at a pixel, the variance summed over pixels is
+    sum(S)/n - sum(S^2)/n^2, and the mean labelled area is sum(S)/n, so the
+    ratio is 1 - sum(S^2) / (n sum(S)).
+
+
+    Parameters
+    ----------
+
+    num_labels : int
+        The number of labels for the micrograph.
+
+    label_sum : int
+        The sum of the counts over all pixels.
+
+    label_sum_squares : int
+        The sum of the squared counts over all pixels.
+
+
+    Returns
+    -------
+
+    disagreement : float
+        The disagreement, between 0 and 1.
+    """
+    if num_labels < 2 or label_sum == 0:
+        return 0.0
+
+    return max(0.0, 1 - label_sum_squares / (num_labels * label_sum))
+
+def compute_priority(num_labels, label_sum, label_sum_squares, uncertainty=0.0):
+    """
+    Compute the labelling priority of a micrograph.
+
+
+    Parameters
+    ----------
+
+    num_labels : int
+        The number of labels for the micrograph.
+
+    label_sum : int
+        The sum of the counts over all pixels.
+
+    label_sum_squares : int
+        The sum of the squared counts over all pixels.
+
+    uncertainty : float
+        The uncertainty of the predicted filaments, between 0 and 1.
+
+
+    Returns
+    -------
+
+    priority : float
+        The priority. Higher priority micrographs are served first.
+    """
+    target = max(1, settings.PROOF_TARGET_LABELS)
+    deficit = max(0, target - num_labels) / target
+
+    return settings.PROOF_PRIORITY_DEFICIT_WEIGHT * deficit \
+         + settings.PROOF_PRIORITY_VARIANCE_WEIGHT * disagreement(num_labels, label_sum,
+                                                                  label_sum_squares) \
+         + settings.PROOF_PRIORITY_UNCERTAINTY_WEIGHT * uncertainty
+
+def update_priority(micrograph):
+    """
+    Update the priority of a micrograph from its statistics. The caller must
+    save the micrograph.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+    """
+    micrograph.priority = compute_priority(micrograph.num_labels,
+                                           micrograph.label_sum,
+                                           micrograph.label_sum_squares,
+                                           micrograph.prediction_uncertainty)
+
+def choose_micrographs(candidates, count, now):
+    """
+    Choose the highest priority micrographs from a set of candidates.
+
+
+    Parameters
+    ----------
+
+    candidates : django.db.models.QuerySet
+        The micrographs that may be served.
+
+    count : int
+        The number of micrographs to choose.
+
+    now : datetime.datetime
+        The current time, used to find the active reservations.
+
+
+    Returns
+    -------
+
+    micrographs : [label.models.Micrograph]
+        The chosen micrographs, in order of priority.
+    """
+    if count <= 0:
+        return []
+
+    # Only look at a window of the highest priority micrographs, found with
+    # the index on the priority.
+    window = list(candidates.order_by("-priority", "id")
+                            [:count * settings.PROOF_SCHEDULER_WINDOW])
+
+    if len(window) == 0:
+        return []
+
+    # Count the active reservations for each micrograph in the window, which
+    # are labels that are likely on their way.
+    reserved = dict(Reservation.objects
+                               .filter(micrograph__in=window, expires__gt=now)
+                               .values_list("micrograph")
+                               .annotate(Count("id")))
+
+    # Discount the deficit part of the priority for each pending label, and
+    # break ties at random so that labellers don't all get the same work.
+    target = max(1, settings.PROOF_TARGET_LABELS)
+    penalty = settings.PROOF_PRIORITY_DEFICIT_WEIGHT / target
+
+    def score(micrograph):
+        pending = min(reserved.get(micrograph.id, 0),
+                      max(0, target - micrograph.num_labels))
+        return micrograph.priority - penalty * pending
+
+    window.sort(key=lambda micrograph: (-score(micrograph), random.random()))
+
+    return window[:count]
+
+def update_all_priorities(batch_size=1000):
+    """
+    Recompute the priority of every micrograph, e.g. after the weights have
+    been changed.
+
+
+    Parameters
+    ----------
+
+    batch_size : int
+        The number of micrographs updated in each query.
+
+
+    Returns
+    -------
+
+    num_updated : int
+        The number of micrographs whose priority changed.
+    """
+    micrographs = Micrograph.objects.only("id", "num_labels", "label_sum", "label_sum_squares",
+                                          "prediction_uncertainty", "priority")
+
+    changed = []
+    for micrograph in micrographs.iterator(chunk_size=batch_size):
+        priority = micrograph.priority
+        update_priority(micrograph)
+        if micrograph.priority != priority:
+            changed.append(micrograph)
+
+    Micrograph.objects.bulk_update(changed, ["priority"], batch_size=batch_size)
+
+    return len(changed)
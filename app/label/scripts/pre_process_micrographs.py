@@ -1,45 +1,432 @@
 #!/usr/bin/env python
 
 # Python script to pre-process raw micrographs for web use.
+#
+# Micrographs are processed in parallel across a pool of worker processes.
+# As well as a fixed size image for the labeller canvas, a multi-resolution
+# tile pyramid is built from each micrograph at full resolution, and smaller,
+# compressed variants of the canvas image are written for serving.
+# A manifest recording the modification time, size, and content hash of each
+# input is kept alongside the output images, so that on subsequent runs only
+# new or modified micrographs are re-processed.
+#
+# Large micrographs, and stacks of movie frames, are equalised in a streaming
+# mode that works through the memory-mapped data a chunk of rows at a time,
+# so that peak memory doesn't grow with the size of the input.
 
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
 from skimage import exposure
 from skimage import io
 from skimage import transform
 
 import argparse
 import glob
+import hashlib
+import json
 import mrcfile
+import numpy as np
 import os
 import skimage
+import sys
+import tempfile
 
-parser = argparse.ArgumentParser(description="Pre-process MRC files for web use.")
-parser.add_argument("--directory", help="The path to the raw MRC files.",
-                                   default="label/raw_micrographs",
-                                   type=str)
-args = parser.parse_args()
+# Make the label app importable when run as a script from the app directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
 
-# Store the micgrograph directory.
-micrograph_directory = args.directory
+from label import tiles, variants
 
-# Make sure the directory exists.
-if not os.path.isdir(micrograph_directory):
-    raise IOError(f"Directory doesn't exist: {micrograph_directory}")
+# The name of the manifest file within the output directory.
+MANIFEST = ".manifest.json"
 
-# Glob all of the mrc files in the directory.
-micrographs = glob.glob(f"{micrograph_directory}/*.mrc")
+# The number of histogram bins used for equalisation.
+NUM_BINS = 256
 
-# Pre-process all of the micrographs.
-for idx, micrograph in enumerate(micrographs):
-    filename = os.path.basename(micrograph)
-    print(f"Processing micrograph: {filename}")
+# The approximate number of input values processed at a time when streaming.
+CHUNK_SIZE = 1 << 22
 
-    with mrcfile.open(micrograph, permissive=True) as mrc:
-        h = mrc.header
-        d = mrc.data
+# Inputs larger than this number of bytes are equalised in streaming mode.
+STREAMING_THRESHOLD = 256 << 20
 
-    d = exposure.equalize_hist(d)
-    normalised = skimage.img_as_ubyte(d)
-    resized = transform.resize(normalised, (800, 800))
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Return the SHA-256 hash of a file's contents, read in chunks so that the
+    whole file is never held in memory.
 
-    filename = filename.split(".")[0]
-    io.imsave(f"label/static/micrographs/{filename}.png", skimage.img_as_ubyte(resized))
+
+    Parameters
+    ----------
+
+    path : str
+        The path to the file.
+
+    chunk_size : int
+        The number of bytes to read at a time.
+
+
+    Returns
+    -------
+
+    digest : str
+        The hexadecimal digest.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def load_manifest(output_directory):
+    """
+    Load the manifest from a previous run.
+
+
+    Parameters
+    ----------
+
+    output_directory : str
+        The directory containing the processed micrographs.
+
+
+    Returns
+    -------
+
+    manifest : dict
+        The manifest entry for each input file, keyed by file name.
+    """
+    try:
+        with open(f"{output_directory}/{MANIFEST}") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(output_directory, manifest):
+    """
+    Atomically write the manifest.
+
+
+    Parameters
+    ----------
+
+    output_directory : str
+        The directory containing the processed micrographs.
+
+    manifest : dict
+        The manifest entry for each input file, keyed by file name.
+    """
+    path = f"{output_directory}/{MANIFEST}"
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def average_frames(data, out, chunk_size=CHUNK_SIZE):
+    """
+    Average a stack of frames, a chunk of rows at a time.
+
+
+    Parameters
+    ----------
+
+    data : numpy.ndarray
+        The (frames, height, width) stack, e.g. a memory map of an MRC file.
+
+    out : numpy.ndarray
+        The (height, width) array in which to store the average.
+
+    chunk_size : int
+        The approximate number of input values to process at a time.
+    """
+    for rows in _chunks(data.shape, chunk_size):
+        out[rows] = data[:, rows].mean(axis=0, dtype=np.float32)
+
+def equalise_streaming(data, chunk_size=CHUNK_SIZE, num_bins=NUM_BINS):
+    """
+    Perform histogram equalisation of an image a chunk of rows at a time,
+    so that no full size floating point temporaries are created. This
+    matches skimage.exposure.equalize_hist to within one grey level.
+
+
+    Parameters
+    ----------
+
+    data : numpy.ndarray
+        The (height, width) image, e.g. a memory map of an MRC file.
+
+    chunk_size : int
+        The approximate number of values to process at a time.
+
+    num_bins : int
+        The number of histogram bins.
+
+
+    Returns
+    -------
+
+    equalised : numpy.ndarray
+        The equalised 8-bit image.
+    """
+
+    # First pass: find the range of the data.
+    lo, hi = np.inf, -np.inf
+    for rows in _chunks(data.shape, chunk_size):
+        chunk = data[rows]
+        lo = min(lo, float(chunk.min()))
+        hi = max(hi, float(chunk.max()))
+
+    # Second pass: accumulate the histogram over the range.
+    counts = np.zeros(num_bins, dtype=np.int64)
+    for rows in _chunks(data.shape, chunk_size):
+        counts += np.histogram(data[rows], bins=num_bins, range=(lo, hi))[0]
+
+    # The cumulative distribution, evaluated at the bin centres.
+    _, edges = np.histogram([], bins=num_bins, range=(lo, hi))
+    centres = 0.5 * (edges[:-1] + edges[1:])
+    cdf = np.cumsum(counts) / counts.sum()
+
+    # Final pass: map each value through the cumulative distribution.
+    equalised = np.empty(data.shape, dtype=np.uint8)
+    for rows in _chunks(data.shape, chunk_size):
+        equalised[rows] = np.round(255 * np.interp(data[rows], centres, cdf))
+
+    return equalised
+
+def process_micrograph(micrograph, output, size, tile_size=None, previous=None,
+                       streaming=None, chunk_size=CHUNK_SIZE, formats=None):
+    """
+    Pre-process a single micrograph, unless its contents match the previous
+    run.
+
+
+    Parameters
+    ----------
+
+    micrograph : str
+        The path to the MRC file.
+
+    output : str
+        The path to the output PNG image.
+
+    size : int
+        The width and height of the output image.
+
+    tile_size : int
+        The width and height of the tiles in the pyramid. If None, no
+        pyramid is built.
+
+    previous : dict
+        The manifest entry from the previous run, if any.
+
+    streaming : bool
+        Whether to equalise the micrograph in streaming mode. By default,
+        this is used for stacks of frames and inputs larger than
+        STREAMING_THRESHOLD bytes.
+
+    chunk_size : int
+        The approximate number of input values to process at a time when
+        streaming.
+
+    formats : [str]
+        The formats of the compressed variants of the output image. Defaults
+        to all available formats. If empty, no variants are written.
+
+
+    Returns
+    -------
+
+    entry : dict
+        The manifest entry for the micrograph.
+
+    processed : bool
+        Whether the micrograph was processed, rather than skipped.
+    """
+    if formats is None:
+        formats = variants.available_formats()
+
+    stat = os.stat(micrograph)
+    entry = {
+              "mtime" : stat.st_mtime_ns,
+              "size" : stat.st_size,
+              "hash" : file_hash(micrograph),
+              "output" : os.path.basename(output),
+            }
+
+    # The contents are unchanged, e.g. the file was touched or copied.
+    if previous is not None and previous.get("hash") == entry["hash"] \
+        and _is_complete(output, tile_size, formats):
+        return entry, False
+
+    # Memory map the data, so that only the pages that are needed are read.
+    with mrcfile.mmap(micrograph, mode="r", permissive=True) as mrc:
+        data = mrc.data
+
+        if streaming is None:
+            streaming = data.ndim == 3 or data.nbytes > STREAMING_THRESHOLD
+
+        if streaming:
+            # Average the frames of a stack into a temporary memory map, so
+            # that they aren't re-read for every pass of the equalisation.
+            with tempfile.TemporaryDirectory() as directory:
+                if data.ndim == 3:
+                    average = np.lib.format.open_memmap(f"{directory}/average.npy", mode="w+",
+                                                        dtype=np.float32, shape=data.shape[1:])
+                    average_frames(data, average, chunk_size)
+                    data = average
+
+                normalised = equalise_streaming(data, chunk_size)
+
+        else:
+            d = np.asarray(data, dtype=np.float32)
+            if d.ndim == 3:
+                d = d.mean(axis=0)
+            normalised = skimage.img_as_ubyte(exposure.equalize_hist(d))
+
+    # Build the tile pyramid at full resolution.
+    if tile_size is not None:
+        tiles.build_pyramid(os.path.basename(output).split(".")[0], normalised, tile_size)
+
+    # Write to a temporary file first, so that a partially written image is
+    # never left behind if the script is interrupted.
+    tmp = output[:-len(".png")] + ".tmp.png"
+
+    # Resize in 8-bit when streaming, to avoid a full size float copy.
+    if streaming:
+        resized = np.asarray(Image.fromarray(normalised).resize((size, size), Image.LANCZOS))
+        Image.fromarray(resized).save(tmp)
+    else:
+        resized = transform.resize(normalised.astype(np.float32) / 255, (size, size))
+        resized = skimage.img_as_ubyte(np.clip(resized, 0, 1))
+        io.imsave(tmp, resized, check_contrast=False)
+
+    # Write the compressed variants that are served in place of the PNG.
+    if len(formats) > 0:
+        variants.build_variants(os.path.basename(output).split(".")[0], resized, formats)
+
+    os.replace(tmp, output)
+
+    return entry, True
+
+def _chunks(shape, chunk_size):
+    """
+    Helper function to yield slices over the rows of an image, or of a stack
+    of frames, each covering roughly chunk_size values.
+    """
+    num_rows = shape[-2]
+    chunk_rows = max(1, chunk_size // int(np.prod(shape) // num_rows))
+
+    for start in range(0, num_rows, chunk_rows):
+        yield slice(start, min(start + chunk_rows, num_rows))
+
+def _is_complete(output, tile_size, formats):
+    """
+    Helper function to check whether all of the outputs for a micrograph
+    exist.
+    """
+    name = os.path.basename(output).split(".")[0]
+
+    return os.path.exists(output) and \
+        (tile_size is None or tiles.load_descriptor(name) is not None) and \
+        set(formats) <= set(variants.load_variants(name))
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-process MRC files for web use.")
+    parser.add_argument("--directory", help="The path to the raw MRC files.",
+                                       default="label/raw_micrographs",
+                                       type=str)
+    parser.add_argument("--output", help="The directory for the processed images.",
+                                    default="label/static/micrographs",
+                                    type=str)
+    parser.add_argument("--size", help="The width and height of the processed images.",
+                                  default=800,
+                                  type=int)
+    parser.add_argument("--tile-size", help="The width and height of the tiles in the pyramid.",
+                                       default=tiles.TILE_SIZE,
+                                       type=int)
+    parser.add_argument("--no-tiles", help="Don't build the tile pyramids.",
+                                      action="store_true")
+    parser.add_argument("--no-variants", help="Don't write the compressed variants of the "
+                                              "processed images.",
+                                         action="store_true")
+    parser.add_argument("--workers", help="The number of worker processes. "
+                                          "Defaults to the number of CPUs.",
+                                     default=None,
+                                     type=int)
+    parser.add_argument("--streaming", help="Equalise all micrographs in streaming mode. By "
+                                            "default, this is only used for stacks and "
+                                            "large inputs.",
+                                       action="store_true",
+                                       default=None)
+    parser.add_argument("--chunk-size", help="The approximate number of values processed "
+                                             "at a time in streaming mode.",
+                                        default=CHUNK_SIZE,
+                                        type=int)
+    parser.add_argument("--force", help="Re-process all micrographs, ignoring the manifest.",
+                                   action="store_true")
+    args = parser.parse_args()
+
+    # Store the micgrograph directory.
+    micrograph_directory = args.directory
+
+    # Make sure the directory exists.
+    if not os.path.isdir(micrograph_directory):
+        raise IOError(f"Directory doesn't exist: {micrograph_directory}")
+
+    # Create the output directory if it doesn't already exist.
+    os.makedirs(args.output, exist_ok=True)
+
+    tile_size = None if args.no_tiles else args.tile_size
+    formats = [] if args.no_variants else variants.available_formats()
+
+    # Load the manifest from the previous run.
+    manifest = {} if args.force else load_manifest(args.output)
+
+    # Glob all of the mrc files in the directory.
+    micrographs = sorted(glob.glob(f"{micrograph_directory}/*.mrc"))
+
+    # Work out which micrographs need to be checked. Inputs whose modification
+    # time and size match the manifest are skipped without being read.
+    current = {}
+    pending = []
+    for micrograph in micrographs:
+        filename = os.path.basename(micrograph)
+        output = f"{args.output}/{filename.split('.')[0]}.png"
+        previous = manifest.get(filename)
+        stat = os.stat(micrograph)
+
+        if previous is not None and previous.get("mtime") == stat.st_mtime_ns \
+            and previous.get("size") == stat.st_size and _is_complete(output, tile_size, formats):
+            current[filename] = previous
+        else:
+            pending.append((micrograph, output, previous))
+
+    print(f"Skipping {len(micrographs) - len(pending)} unchanged micrographs")
+
+    # Pre-process the remaining micrographs in parallel.
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(process_micrograph, micrograph, output,
+                                       args.size, tile_size, previous,
+                                       args.streaming, args.chunk_size, formats)
+                       for micrograph, output, previous in pending]
+
+            for (micrograph, _, _), future in zip(pending, futures):
+                filename = os.path.basename(micrograph)
+                try:
+                    entry, processed = future.result()
+                except Exception as e:
+                    print(f"Failed to process micrograph: {filename}: {e}")
+                    continue
+
+                if processed:
+                    print(f"Processed micrograph: {filename}")
+                else:
+                    print(f"Skipping unchanged micrograph: {filename}")
+
+                current[filename] = entry
+
+    # Record the state of the inputs for the next run. Entries for inputs
+    # that no longer exist, or that failed, are dropped.
+    save_manifest(args.output, current)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Claim-check staging of uploaded label payloads.
+
+Uploads are written once to a local staging directory that is shared by the
+web server and the Celery workers. Only a short reference to the staged
+payload is passed through the message broker. Staged payloads are removed
+once they have been consumed, and any that are never consumed are removed
+once they expire.
+"""
+
+import glob
+import os
+import time
+import uuid
+
+from . import metrics
+
+# The directory in which uploads are staged.
+STAGING_DIR = "label/staging"
+
+def stage_upload(data, extension, svg_serialized=None):
+    """
+    Write an uploaded payload to the staging directory.
+
+
+    Parameters
+    ----------
+
+    data : bytes
+        The encoded label mask.
+
+    extension : str
+        The file extension describing the encoding of the mask, e.g. "png".
+
+    svg_serialized : str
+        The serialized SVG image.
+
+
+    Returns
+    -------
+
+    reference : str
+        The reference used to retrieve the staged payload.
+    """
+
+    # Create the staging directory if it doesn't already exist.
+    os.makedirs(STAGING_DIR, exist_ok=True)
+
+    # Generate a unique reference for the payload.
+    key = uuid.uuid4().hex
+    reference = f"{key}.{extension}"
+
+    # Write the SVG first, so that it is always present once the mask is.
+    if svg_serialized is not None:
+        _write_atomic(f"{STAGING_DIR}/{key}.svg", svg_serialized.encode())
+
+    _write_atomic(f"{STAGING_DIR}/{reference}", data)
+
+    # Record the size of the upload.
+    metrics.upload_bytes.labels(extension).observe(len(data))
+
+    return reference
+
+def load_staged_upload(reference):
+    """
+    Read a staged payload.
+
+
+    Parameters
+    ----------
+
+    reference : str
+        The reference returned by stage_upload.
+
+
+    Returns
+    -------
+
+    data : bytes, None
+        The encoded label mask, or None if the payload no longer exists.
+
+    svg_serialized : str, None
+        The serialized SVG image, or None if none was staged.
+    """
+    path, svg_path = _paths(reference)
+
+    if not os.path.exists(path):
+        return None, None
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if os.path.exists(svg_path):
+        with open(svg_path, "r") as f:
+            svg_serialized = f.read()
+    else:
+        svg_serialized = None
+
+    return data, svg_serialized
+
+def remove_staged_upload(reference):
+    """
+    Remove a staged payload once it has been consumed.
+
+
+    Parameters
+    ----------
+
+    reference : str
+        The reference returned by stage_upload.
+    """
+    for path in _paths(reference):
+        if os.path.exists(path):
+            os.remove(path)
+
+def remove_expired_uploads(max_age):
+    """
+    Remove staged payloads that have not been consumed.
+
+
+    Parameters
+    ----------
+
+    max_age : float
+        The age in seconds after which a staged payload has expired.
+
+
+    Returns
+    -------
+
+    num_removed : int
+        The number of files that were removed.
+    """
+    num_removed = 0
+    cutoff = time.time() - max_age
+
+    for path in glob.glob(f"{STAGING_DIR}/*"):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                num_removed += 1
+        except FileNotFoundError:
+            # The payload was consumed in the meantime.
+            pass
+
+    return num_removed
+
+def _paths(reference):
+    """
+    Helper function to get the paths to the mask and SVG for a staged
+    payload. The reference is reduced to its base name so that it can't
+    point outside of the staging directory.
+    """
+    reference = os.path.basename(reference)
+    key = reference.split(".")[0]
+
+    return f"{STAGING_DIR}/{reference}", f"{STAGING_DIR}/{key}.svg"
+
+def _write_atomic(path, data):
+    """
+    Helper function to write a file so that it is never seen partially
+    written.
+    """
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
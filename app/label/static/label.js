@@ -4,9 +4,45 @@ var background, foreground, canvas, ctx, svg_ctx;
 // Variable for the background micrograph image.
 var micrograph = new Image();
 
-// Variable for the foreground micrograph labels.
+// Queue of preloaded micrographs and the number of micrographs to keep in it.
+var queue = [], queueSize = 3;
+
+// The compressed image formats that the browser can decode, which are sent to
+// the server so that micrographs are served in the smallest format possible.
+// JPEG is always supported, and AVIF and WebP are detected on start-up.
+var imageFormats = ["jpeg"];
+
+// The format used to upload labels: a run-length encoded binary mask ("rle"),
+// the vector strokes that were drawn ("strokes"), or a PNG data URL ("png").
+var uploadFormat = "rle";
+
+// The region of the micrograph that is in view. The zoom factor is relative
+// to the whole micrograph filling the canvas, and (x, y) is the top-left of
+// the view in canvas coordinates at a zoom of one. Labels are always stored
+// in these unzoomed coordinates.
+var view = {zoom: 1, x: 0, y: 0};
+
+// Tiles of the current micrograph that have been requested, keyed by level,
+// column, and row.
+var tileCache = {};
+
+// Variable for the foreground micrograph labels. The index of the micrograph
+// whose average is being rendered by the server, if any, is kept so that it
+// can be shown once the server says that it is ready.
 var average = new Image();
 average.isActive = false;
+average.pending = null;
+
+// The number of this client's uploads that the server has processed.
+var labelsProcessed = 0;
+
+// Variable for the foreground heatmap of the disagreement between labels.
+var variance = new Image();
+variance.isActive = false;
+
+// Variable for the foreground overlay of the predicted filaments.
+var prediction = new Image();
+prediction.isActive = false;
 
 // Variables to keep track of the mouse position and status.
 var mouseX, mouseY, mouseDown = false, mouseRight = false;
@@ -99,7 +135,7 @@ function drawLine(ctx, x, y, savePath)
 // Clear the canvas context using the canvas width and height.
 function clearAll(canvas, ctx, clearPaths)
 {
-    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    ctx.clearRect(view.x, view.y, canvas.width/view.zoom, canvas.height/view.zoom);
 
     // Clear the array of paths.
     if (clearPaths)
@@ -126,10 +162,53 @@ function newMicrograph(canvas, ctx)
     randomMicrograph();
 }
 
+// Run-length encode the labels on a canvas. The mask is encoded as a sequence
+// of unsigned LEB128 variable-length integers: the height, the width, then the
+// lengths of alternating runs of background and filament pixels in row-major
+// order, starting with background.
+function encodeMask(canvas, ctx)
+{
+    var pixels = ctx.getImageData(0, 0, canvas.width, canvas.height).data;
+    var bytes = [];
+
+    // Append a variable-length integer to the encoded bytes.
+    var pushVarint = function(value)
+    {
+        while (value >= 128)
+        {
+            bytes.push((value % 128) | 128);
+            value = Math.floor(value / 128);
+        }
+        bytes.push(value);
+    }
+
+    pushVarint(canvas.height);
+    pushVarint(canvas.width);
+
+    var filament = false, run = 0;
+    for (var i=0; i<pixels.length; i+=4)
+    {
+        // Use the same grayscale threshold as the server does for PNG uploads.
+        var isFilament = (0.299*pixels[i] + 0.587*pixels[i+1] + 0.114*pixels[i+2]) > 10;
+
+        if (isFilament != filament)
+        {
+            pushVarint(run);
+            filament = isFilament;
+            run = 0;
+        }
+        run++;
+    }
+    pushVarint(run);
+
+    return new Uint8Array(bytes);
+}
+
 // Upload the labelled image to the webserver.
 function upload(canvas, ctx)
 {
-    var dataUrl = canvas.toDataURL('image/png');
+    // The labels must be drawn unzoomed to encode the mask.
+    resetView();
 
     // Draw an SVG representation of the canvas.
     redraw(canvas, svg_ctx);
@@ -137,71 +216,446 @@ function upload(canvas, ctx)
     // Serialize the SVG.
     svgSerialized = (svg_ctx.getSerializedSvg(true));
 
-    $.post('/label/upload',
-          { index: micrograph.index,
-            dataUrl: dataUrl,
-            svgSerialized: svgSerialized
-          },
-          function(response)
-          {
-            clearAll(canvas, ctx, true);
-            clearAll(canvas, svg_ctx, true);
-            randomMicrograph();
-          }
-    );
+    if (uploadFormat == "strokes")
+    {
+        // Include any path that is still being drawn.
+        var allPaths = paths.slice(), allWidths = widths.slice();
+        if (path.length > 0)
+        {
+            allPaths.push(path);
+            allWidths.push(lineWidth);
+        }
+
+        $.ajax({ url: '/label/upload/strokes',
+                 type: 'POST',
+                 data: JSON.stringify({ index: micrograph.index,
+                                        width: canvas.width,
+                                        height: canvas.height,
+                                        paths: allPaths,
+                                        widths: allWidths.map(Number)
+                                      }),
+                 contentType: 'application/json'
+               }
+        );
+    }
+    else if (uploadFormat == "rle")
+    {
+        var form = new FormData();
+        form.append("index", micrograph.index);
+        form.append("svgSerialized", svgSerialized);
+        form.append("mask", new Blob([encodeMask(canvas, ctx)],
+                                     {type: "application/octet-stream"}));
+
+        $.ajax({ url: '/label/upload/binary',
+                 type: 'POST',
+                 data: form,
+                 processData: false,
+                 contentType: false
+               }
+        );
+    }
+    else
+    {
+        var dataUrl = canvas.toDataURL('image/png');
+
+        $.post('/label/upload',
+              { index: micrograph.index,
+                dataUrl: dataUrl,
+                svgSerialized: svgSerialized
+              }
+        );
+    }
+
+    // Move straight on to the next preloaded micrograph, rather than waiting
+    // for the upload to complete.
+    clearAll(canvas, ctx, true);
+    clearAll(canvas, svg_ctx, true);
+    randomMicrograph();
 }
 
-// Load a random micrograph.
-function randomMicrograph()
+// Detect whether the browser can decode AVIF and WebP images, by decoding a
+// tiny grayscale image in each format, since micrographs are grayscale.
+// Parameters are:
+//     callback  A function to call once detection has finished.
+function detectImageFormats(callback)
 {
-	$.get('/label/micrograph',
+    var probes = {
+        avif: "data:image/avif;base64,AAAAHGZ0eXBhdmlmAAAAAGF2aWZtaWYxbWlhZgAAAOltZXRhAAAAAAAAACFoZGxyAAAAAAAAAABwaWN0AAAAAAAAAAAAAAAAAAAAAA5waXRtAAAAAAABAAAAHmlsb2MAAAAARAAAAQABAAAAAQAAAQ0AAAAYAAAAKGlpbmYAAAAAAAEAAAAaaW5mZQIAAAAAAQAAYXYwMUNvbG9yAAAAAGhpcHJwAAAASWlwY28AAAAUaXNwZQAAAAAAAAABAAAAAQAAAA5waXhpAAAAAAEIAAAADGF2MUOBABwAAAAAE2NvbHJuY2x4AAEADQAGgAAAABdpcG1hAAAAAAAAAAEAAQQBAoMEAAAAIG1kYXQSAAoHGAAGmAhoNTILGUYhh55oAJBA2aA=",
+        webp: "data:image/webp;base64,UklGRiQAAABXRUJQVlA4IBgAAABQAQCdASoBAAEAAsBMJaQABHQAAORAAAA="
+    };
+    var remaining = Object.keys(probes).length;
+
+    Object.keys(probes).forEach(function(format)
+    {
+        var image = new Image();
+        image.onload = image.onerror = function(e)
+        {
+            if (e.type == "load" && image.width > 0)
+            {
+                imageFormats.push(format);
+            }
+            if (--remaining == 0)
+            {
+                callback();
+            }
+        };
+        image.src = probes[format];
+    });
+}
+
+// Top up the queue of preloaded micrographs. The server reserves each
+// micrograph for this client, so the queue never contains duplicates.
+// Parameters are:
+//     callback  An optional function to call once the queue has been updated.
+function fillQueue(callback)
+{
+    var count = queueSize - queue.length;
+
+    $.get('/label/micrographs',
+          { count: count, formats: imageFormats.join(",") },
           function(response)
           {
-              // Change the background canvas, ensuring that the micrograph has loaded.
-              micrograph.onload = function()
+              // Start downloading each micrograph image in the background.
+              for (var i=0; i<response.micrographs.length; i++)
+              {
+                  var image = new Image();
+                  image.src = "../" + response.micrographs[i].micrograph;
+                  image.index = response.micrographs[i].index;
+                  image.tiles = response.micrographs[i].tiles;
+                  queue.push(image);
+              }
+
+              if (callback)
               {
-                  // Get the specific background and canvas elements from the HTML document.
-                  background = document.getElementById('background');
-
-                  // Draw the micrograph on the background layer.
-                  if (background.getContext)
-                  {
-                      background.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
-                      background.getContext('2d').drawImage(micrograph, 0, 0, canvas.width, canvas.height);
-                  }
+                  callback();
               }
-              micrograph.src = "../" + response.micrograph;
-              micrograph.index = response.index;
           }
     );
 }
 
+// Draw a micrograph on the background layer, ensuring that it has loaded.
+function showMicrograph(image)
+{
+    micrograph = image;
+    tileCache = {};
+    resetView();
+
+    if (!micrograph.complete)
+    {
+        micrograph.onload = drawBackground;
+    }
+}
+
+// Draw the part of the micrograph that is in view on the background layer.
+// If the micrograph has a tile pyramid, the tiles in view at the current zoom
+// are drawn over the preloaded image as they arrive.
+function drawBackground()
+{
+    // Get the specific background element from the HTML document.
+    background = document.getElementById('background');
+
+    if (!background.getContext)
+    {
+        return;
+    }
+
+    var bctx = background.getContext('2d');
+    bctx.clearRect(0, 0, canvas.width, canvas.height);
+
+    if (micrograph.complete)
+    {
+        drawInView(bctx, micrograph);
+    }
+
+    if (!micrograph.tiles)
+    {
+        return;
+    }
+
+    var tiles = micrograph.tiles, size = tiles.tile_size;
+
+    // Choose the coarsest level with at least one pixel per screen pixel.
+    var scale = view.zoom * Math.max(canvas.width / tiles.width, canvas.height / tiles.height);
+    var level = tiles.max_level + Math.ceil(Math.log2(scale));
+    level = Math.max(0, Math.min(tiles.max_level, level));
+
+    // The size of the level, and the region of it that is in view.
+    var factor = Math.pow(2, tiles.max_level - level);
+    var width = Math.ceil(tiles.width / factor), height = Math.ceil(tiles.height / factor);
+    var x0 = view.x / canvas.width * width, x1 = x0 + width / view.zoom;
+    var y0 = view.y / canvas.height * height, y1 = y0 + height / view.zoom;
+
+    for (var row=Math.floor(y0/size); row<Math.min(Math.ceil(y1/size), Math.ceil(height/size)); row++)
+    {
+        for (var col=Math.floor(x0/size); col<Math.min(Math.ceil(x1/size), Math.ceil(width/size)); col++)
+        {
+            var key = level + "/" + col + "_" + row;
+            var tile = tileCache[key];
+
+            // Request the tile, and redraw once it has loaded.
+            if (!tile)
+            {
+                tile = new Image();
+                tile.index = micrograph.index;
+                tile.onload = function()
+                {
+                    if (this.index == micrograph.index)
+                    {
+                        drawBackground();
+                    }
+                }
+                tile.src = "../label/tiles/" + micrograph.index + "/" + key + ".png";
+                tileCache[key] = tile;
+            }
+
+            if (tile.complete && tile.naturalWidth > 0)
+            {
+                // Map the tile from level pixels to canvas coordinates.
+                bctx.drawImage(tile,
+                    (col*size/width*canvas.width - view.x) * view.zoom,
+                    (row*size/height*canvas.height - view.y) * view.zoom,
+                    tile.naturalWidth/width*canvas.width*view.zoom,
+                    tile.naturalHeight/height*canvas.height*view.zoom);
+            }
+        }
+    }
+}
+
+// Draw an image covering the whole micrograph, e.g. the average labels, so
+// that the part in view fills the canvas.
+// Parameters are:
+//     context   A canvas context.
+//     image     The image.
+function drawInView(context, image)
+{
+    context.drawImage(image, -view.x*view.zoom, -view.y*view.zoom,
+                      canvas.width*view.zoom, canvas.height*view.zoom);
+}
+
+// Redraw all of the layers after the view has changed.
+function updateView()
+{
+    // Draw the labels in the zoomed coordinates.
+    if (ctx)
+    {
+        ctx.setTransform(view.zoom, 0, 0, view.zoom, -view.x*view.zoom, -view.y*view.zoom);
+        redraw(canvas, ctx);
+    }
+
+    drawBackground();
+
+    // Redraw any active overlay.
+    foreground = document.getElementById('foreground');
+    if (foreground.getContext)
+    {
+        foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+        if (average.isActive)
+        {
+            drawInView(foreground.getContext('2d'), average);
+        }
+        else if (variance.isActive)
+        {
+            drawInView(foreground.getContext('2d'), variance);
+        }
+        else if (prediction.isActive)
+        {
+            drawInView(foreground.getContext('2d'), prediction);
+        }
+    }
+}
+
+// Show the whole micrograph.
+function resetView()
+{
+    view = {zoom: 1, x: 0, y: 0};
+    updateView();
+}
+
+// Zoom in or out around the mouse position using the mouse wheel.
+function labeller_wheel(e)
+{
+    e.preventDefault();
+
+    // Allow zooming until one full resolution pixel fills a screen pixel.
+    var maxZoom = 4;
+    if (micrograph.tiles)
+    {
+        maxZoom = Math.max(1, micrograph.tiles.width / canvas.width,
+                              micrograph.tiles.height / canvas.height);
+    }
+
+    var zoom = view.zoom * (e.deltaY < 0 ? 1.25 : 0.8);
+    zoom = Math.max(1, Math.min(maxZoom, zoom));
+
+    // Keep the point under the mouse fixed, and the view within the micrograph.
+    var x = view.x + e.offsetX/view.zoom, y = view.y + e.offsetY/view.zoom;
+    view.x = Math.max(0, Math.min(canvas.width - canvas.width/zoom, x - e.offsetX/zoom));
+    view.y = Math.max(0, Math.min(canvas.height - canvas.height/zoom, y - e.offsetY/zoom));
+    view.zoom = zoom;
+
+    updateView();
+}
+
+// Load a random micrograph.
+function randomMicrograph()
+{
+    if (queue.length > 0)
+    {
+        // Show the next preloaded micrograph, then top up the queue.
+        showMicrograph(queue.shift());
+        fillQueue();
+    }
+    else
+    {
+        // Nothing is preloaded, so wait for the queue to be filled.
+        fillQueue(function()
+        {
+            if (queue.length > 0)
+            {
+                showMicrograph(queue.shift());
+            }
+            else
+            {
+                // Labelling is finished for this client.
+                var image = new Image();
+                image.src = "../static/complete.png";
+                image.index = -1;
+                showMicrograph(image);
+            }
+        });
+    }
+}
+
+// Show the average micrograph labels on the foreground layer.
+// Parameters are:
+//     url  The URL of the average labels, or "NULL" if there are none.
+function showAverage(url)
+{
+    // Change the foreground canvas, ensuring that the image has loaded.
+    average.onload = function()
+    {
+        // Get the specific foreground element from the HTML document.
+        foreground = document.getElementById('foreground');
+
+        // Draw the average on the foreground layer.
+        if (foreground.getContext)
+        {
+            foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+            drawInView(foreground.getContext('2d'), average);
+        }
+    }
+    if (url != "NULL")
+    {
+        average.src = "../" + url;
+        average.isActive = true;
+        variance.isActive = false;
+        prediction.isActive = false;
+    }
+}
+
 // Toggle displaying the average micrograph labels.
 function toggleAverage()
 {
     if (!average.isActive)
     {
+        var index = micrograph.index;
+
         $.get('/label/average',
-            {index: micrograph.index, average: average.src},
+            {index: index},
+            function(response)
+            {
+                // The server is rendering the average, and will send an
+                // "average" event once it is ready.
+                if (response.average == "PENDING")
+                {
+                    average.pending = index;
+                    return;
+                }
+
+                // Ignore the response if the micrograph has changed.
+                if (index == micrograph.index)
+                {
+                    showAverage(response.average);
+                }
+            }
+        );
+    }
+    else
+    {
+        // Get the specific foreground element from the HTML document.
+        foreground = document.getElementById('foreground');
+
+        // Draw the average on the foreground layer.
+        if (foreground.getContext)
+        {
+            foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+        }
+
+        average.isActive = false;
+        average.pending = null;
+    }
+}
+
+// Listen for events pushed by the server. The browser reconnects
+// automatically, resuming from the last event received.
+function listenForEvents()
+{
+    if (!window.EventSource)
+    {
+        return;
+    }
+
+    var source = new EventSource('/label/events');
+
+    // An average that was requested has been rendered.
+    source.addEventListener('average', function(e)
+    {
+        var data = JSON.parse(e.data);
+
+        // Only show the average if it is still wanted for the micrograph in view.
+        if (data.index == average.pending && data.index == micrograph.index)
+        {
+            showAverage(data.average);
+        }
+        average.pending = null;
+    });
+
+    // An upload has been processed.
+    source.addEventListener('upload', function(e)
+    {
+        labelsProcessed += 1;
+        document.getElementById("labelsProcessed").innerHTML = labelsProcessed;
+    });
+}
+
+// Toggle displaying the disagreement between the micrograph labels.
+function toggleVariance()
+{
+    if (!variance.isActive)
+    {
+        $.get('/label/variance',
+            {index: micrograph.index},
             function(response)
             {
                 // Change the foreground canvas, ensuring that the image has loaded.
-                average.onload = function()
+                variance.onload = function()
                 {
                     // Get the specific foreground element from the HTML document.
                     foreground = document.getElementById('foreground');
 
-                    // Draw the average on the foreground layer.
+                    // Draw the heatmap on the foreground layer.
                     if (foreground.getContext)
                     {
                         foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
-                        foreground.getContext('2d').drawImage(average, 0, 0);
+                        drawInView(foreground.getContext('2d'), variance);
                     }
                 }
-                if (response.average != "NULL")
+                if (response.variance != "NULL")
                 {
-                    average.src = "../" + response.average;
-                    average.isActive = true;
+                    variance.src = "../" + response.variance;
+                    variance.isActive = true;
+                    average.isActive = false;
+                    prediction.isActive = false;
                 }
             }
         );
@@ -211,13 +665,83 @@ function toggleAverage()
         // Get the specific foreground element from the HTML document.
         foreground = document.getElementById('foreground');
 
-        // Draw the average on the foreground layer.
+        // Clear the foreground layer.
         if (foreground.getContext)
         {
             foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
         }
 
-        average.isActive = false;
+        variance.isActive = false;
+    }
+}
+
+// Toggle displaying the filaments predicted by the default model.
+// Parameters are:
+//     attempt   The number of times the prediction has been requested. The
+//               prediction is made in the background, so is polled for.
+function togglePrediction(attempt)
+{
+    attempt = attempt || 0;
+
+    if (!prediction.isActive)
+    {
+        var index = micrograph.index;
+
+        $.get('/predict/prediction',
+            {index: index, kind: "overlay"},
+            function(response)
+            {
+                // Ignore the response if the micrograph has changed.
+                if (index != micrograph.index)
+                {
+                    return;
+                }
+
+                // The prediction is still being made, so ask again shortly.
+                if (response.prediction == "PENDING")
+                {
+                    if (attempt < 10)
+                    {
+                        setTimeout(function() { togglePrediction(attempt + 1); }, 1000);
+                    }
+                    return;
+                }
+
+                // Change the foreground canvas, ensuring that the image has loaded.
+                prediction.onload = function()
+                {
+                    // Get the specific foreground element from the HTML document.
+                    foreground = document.getElementById('foreground');
+
+                    // Draw the prediction on the foreground layer.
+                    if (foreground.getContext)
+                    {
+                        foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+                        drawInView(foreground.getContext('2d'), prediction);
+                    }
+                }
+                if (response.prediction != "NULL")
+                {
+                    prediction.src = "../" + response.prediction;
+                    prediction.isActive = true;
+                    average.isActive = false;
+                    variance.isActive = false;
+                }
+            }
+        );
+    }
+    else
+    {
+        // Get the specific foreground element from the HTML document.
+        foreground = document.getElementById('foreground');
+
+        // Clear the foreground layer.
+        if (foreground.getContext)
+        {
+            foreground.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+        }
+
+        prediction.isActive = false;
     }
 }
 
@@ -378,6 +902,10 @@ function getMousePos(e)
         mouseX = e.layerX;
         mouseY = e.layerY;
     }
+
+    // Convert to unzoomed coordinates.
+    mouseX = view.x + mouseX/view.zoom;
+    mouseY = view.y + mouseY/view.zoom;
 }
 
 // Draw something when a touch start is detected.
@@ -440,6 +968,10 @@ function getTouchPos(e)
             var touch = e.touches[0];
             touchX = touch.pageX-touch.target.offsetLeft;
             touchY = touch.pageY-touch.target.offsetTop;
+
+            // Convert to unzoomed coordinates.
+            touchX = view.x + touchX/view.zoom;
+            touchY = view.y + touchY/view.zoom;
         }
     }
 }
@@ -451,8 +983,11 @@ function init()
     background = document.getElementById('background');
     canvas = document.getElementById('labeller');
 
-    // Load a random micrograph.
-    randomMicrograph();
+    // Load a random micrograph, once the supported image formats are known.
+    detectImageFormats(randomMicrograph);
+
+    // Listen for the server to say when uploads and averages are ready.
+    listenForEvents();
 
     // Draw the micrograph on the background layer.
     if (background.getContext)
@@ -474,6 +1009,7 @@ function init()
         // document.
         canvas.addEventListener('mousedown', labeller_mouseDown, false);
         canvas.addEventListener('mousemove', labeller_mouseMove, false);
+        canvas.addEventListener('wheel', labeller_wheel, false);
         window.addEventListener('mouseup', labeller_mouseUp, false);
 
         // React to touch events on the canvas.
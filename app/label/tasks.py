@@ -1,24 +1,28 @@
-from io import BytesIO
-from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor
 
-import base64
-import imageio
+import django
 import logging
 import numpy as np
 import os
-import pickle
-import uuid
+import time
 
 from proof.celery import app
+from celery import signals
 from celery.schedules import crontab
-from .models import Micrograph
+from concurrency.exceptions import RecordModifiedError
+from django.conf import settings
+from django.db import DatabaseError, connection, connections, transaction
+from . import accumulator, events, ingest, masks, metrics, renders, scheduling, staging
+from .models import Label, Micrograph, Reservation
 
 logger = logging.getLogger(__name__)
 
 @app.task
-def process_micrograph_mask(ip, index, data_url, svg_serialized):
+def process_micrograph_mask(ip, index, reference):
     """
     Process the upload of micrograph filament labels as a background task.
+    The mask is decoded and spooled, then ingested along with any other
+    masks uploaded for the same micrograph within the ingestion window.
 
 
     Parameters
@@ -30,91 +34,239 @@ def process_micrograph_mask(ip, index, data_url, svg_serialized):
     index : int
         The index of the micrograph in the Django database.
 
-    data_url : base64
-        The data URL for the micrograph label mask.
-
-    svg_serialized : str
-        The serialized SVG image.
+    reference : str
+        The reference to the staged upload.
     """
 
     # Index is set to -1 if labelling is complete.
     if index >= 0:
 
-        # Get the micrograph from the database.
-        micrograph = Micrograph.objects.get(id=str(index))
+        # Get the micrograph, and its name with no path or extension.
+        micrograph = Micrograph.objects.only("path").get(id=str(index))
+        name = micrograph.name
 
-        # Get the name of the micrograph with no path or extension.
-        name = micrograph.path.split("/")[2].split(".")[0]
+        # Read the staged upload.
+        data, svg_serialized = staging.load_staged_upload(reference)
 
-        # Increment the number of micrograph labels.
-        micrograph.num_labels += 1
+        # The upload has already been consumed, or has expired.
+        if data is None:
+            logger.warning(f"Staged upload '{reference}' for micrograph '{name}' no longer exists")
+            return
 
-        # Record that this IP address has labelled the micrograph. The IP address
-        # can appear multiple times if they have labelled all of the current m#icrographs.
-        micrograph.ip_addresses.append(ip)
+        # Decode the upload straight into a binary mask. The encoding is given
+        # by the extension of the reference.
+        encoding = reference.split(".")[-1]
 
-        # Create the directory name for the masks.
-        mask_dir = f"label/masks/{name}"
+        # Labels are accumulated at a fixed shape for each micrograph, e.g. its
+        # full resolution if requested, so that every mask matches the
+        # accumulator. Uploads of an unexpected shape are rejected by the
+        # views, but are checked again here in case they were staged before
+        # the micrograph changed.
+        try:
+            mask = masks.decode(data, encoding, masks.label_shape(micrograph),
+                                masks.upload_shapes(micrograph))
+        except ValueError as e:
+            logger.warning(f"Discarding upload '{reference}' for micrograph '{name}': {e}")
+            staging.remove_staged_upload(reference)
+            return
+
+        # Keep the strokes for vector uploads, so they can be re-rasterised.
+        strokes = data.decode() if encoding == "json" else None
+
+        # Spool the mask until it is ingested. The staged upload has then
+        # been consumed.
+        ingest.spool_mask(name, ip, mask, svg_serialized, strokes)
+        staging.remove_staged_upload(reference)
+
+        # Ingest straight away if running locally, otherwise wait for the
+        # ingestion window so that concurrent uploads are batched together.
+        if settings.PROOF_LOCAL:
+            # There is no worker to reschedule a conflicting ingestion, so it
+            # is re-run straight away.
+            while _ingest_micrograph_masks(index):
+                pass
+        else:
+            ingest_micrograph_masks.apply_async((index,),
+                    countdown=settings.PROOF_INGEST_WINDOW)
+
+@app.task(autoretry_for=(OSError, DatabaseError), max_retries=3, retry_backoff=True)
+def ingest_micrograph_masks(index):
+    """
+    Ingest all of the spooled masks for a micrograph as a single batch. The
+    masks are summed in one operation and committed with a single update of
+    the micrograph record. If the commit fails the label counts are rolled
+    back and the masks returned to the spool, so the task can be retried
+    without counting the masks twice.
 
-        # Create a mask directory for this micrograph if it doesn't already exist.
-        if not os.path.isdir(mask_dir):
-            os.makedirs(mask_dir)
 
-        # Create name of the micrograph label mask.
-        mask_name = f"{mask_dir}/" + f"{micrograph.num_labels}".rjust(6, "0")
+    Parameters
+    ----------
+
+    index : int
+        The index of the micrograph in the Django database.
+    """
+    if _ingest_micrograph_masks(index):
+        ingest_micrograph_masks.apply_async((index,),
+                countdown=settings.PROOF_INGEST_WINDOW)
 
-        # Decode the image, convert to grayscale and threshold to create a binary iamge.
-        image = Image.open(BytesIO(base64.b64decode(data_url.split(",")[1])))
-        image = image.convert("L")
-        image = image.point(lambda x: 0 if x>10 else 255, "1")
-        image.save(mask_name + ".png")
+def _ingest_micrograph_masks(index):
+    """
+    Helper function to ingest the spooled masks for a micrograph. This isn't
+    retried, so can be called directly when running locally. Returns whether
+    the ingestion conflicted with another update of the micrograph record, so
+    needs re-running.
+    """
 
-        # Write the SVG to file.
-        with open(mask_name + ".svg", "w") as f:
-            f.write(svg_serialized)
+    # Get the name of the micrograph with no path or extension, and the shape
+    # at which its labels are accumulated.
+    micrograph = Micrograph.objects.only("path").get(id=str(index))
+    name = micrograph.name
+    shape = masks.label_shape(micrograph)
 
-        # Reload the mask as a NumPy array. Make sure this is a 64-bit int since
-        # we'll be accumulating the data, i.e. it will go beyond the range of 0-255.
-        image = imageio.imread(mask_name + ".png").astype("uint64")
+    # Hold the accumulator lock for this micrograph while updating the
+    # record so that batches are applied one at a time.
+    with accumulator.lock(name):
 
-        # Add to the running average.
-        if micrograph.num_labels > 1:
-            # Get the current average.
-            current_average = pickle.loads(base64.b64decode(micrograph.average))
+        # Get the latest micrograph record from the database.
+        micrograph = Micrograph.objects.get(id=str(index))
 
-            # Convert images to one-dimensional NumPy arrays in range 0 to 1.
-            img_array = image.flatten() / 255
-            avg_array = (current_average/micrograph.num_labels).flatten() / 255
+        # Resolve any masks left claimed by an interrupted ingestion. If some
+        # weren't committed, the label counts may include them, so they need
+        # rebuilding.
+        if ingest.recover_masks(name, micrograph.num_labels):
+            Micrograph.objects.filter(id=micrograph.id).update(statistics_dirty=True)
+            micrograph.refresh_from_db()
 
-            # Update the running average.
-            image += current_average
+        # Load everything that has arrived for this micrograph. Masks that
+        # can't be read, or have the wrong shape, are quarantined.
+        pending = ingest.pending_masks(name, shape)
 
-        # Serialize the image and convert to base64.
-        image_bytes = pickle.dumps(image)
-        image_bytes = base64.b64encode(image_bytes)
+        # Another task has already ingested the masks.
+        if len(pending) == 0:
+            return False
 
-        # Store the updated average.
-        micrograph.average = image_bytes
+        # Sum the batch of masks.
+        with metrics.ingest_stage_seconds.labels("accumulate").time():
+            counts = ingest.sum_masks(pending)
 
-        try:
-            # Save the updated micrograph record.
-            micrograph.save()
+        # Store the label number of the first mask in the batch.
+        first_label = micrograph.num_labels + 1
 
-            # Log that a the micrograph was updated.
-            logger.info(f"Successfully updated record for micrograph '{name}'")
+        # Increment the number of micrograph labels.
+        micrograph.num_labels += len(pending)
 
-        except:
+        # Add to the running label counts. If the existing counts have a
+        # different shape, e.g. they were accumulated before the label shape
+        # changed, the batch can never be ingested so is quarantined.
+        try:
+            with metrics.ingest_stage_seconds.labels("accumulate").time():
+                delta_sum, delta_sum_squares = accumulator.add_to_accumulator(name, counts)
+        except ValueError as e:
+            for entry in pending:
+                ingest.quarantine_mask(name, entry.path, e)
+            return False
+
+        claimed = []
+        try:
+            # Update the running sums used to compute the variance.
+            micrograph.label_sum += delta_sum
+            micrograph.label_sum_squares += delta_sum_squares
+            micrograph.variance = accumulator.label_variance(micrograph.num_labels,
+                                                             micrograph.label_sum,
+                                                             micrograph.label_sum_squares,
+                                                             counts.size)
+
+            # Update the labelling priority, now that there are more labels.
+            scheduling.update_priority(micrograph)
+
+            # Take the masks out of the spool before committing, so that once
+            # the batch is committed nothing can ingest them again.
+            claimed = ingest.claim_masks(pending, micrograph.num_labels)
+
+            # Save the updated micrograph record and record the IP addresses
+            # that have labelled it, as a single short transaction.
+            ips = [entry.ip for entry in pending]
+            with metrics.ingest_stage_seconds.labels("commit").time(), transaction.atomic():
+                micrograph.save()
+                Label.objects.bulk_create(
+                    [Label(micrograph=micrograph, ip_address=ip) for ip in ips])
+
+                # The micrograph no longer needs to be reserved for these clients.
+                Reservation.objects.filter(micrograph=micrograph, ip_address__in=ips).delete()
+
+        except RecordModifiedError:
             # Log that a concurrency issue occurred.
             logger.warning(f"Database concurrency issue for micrograph '{name}'")
+            metrics.ingest_conflicts.inc()
 
-            # Re-execute the task if the record has been modified.
-            process_micrograph_mask.delay(ip, index, data_url, svg_serialized)
+            # Roll back the batch, so only the ingestion needs to be
+            # re-executed.
+            _roll_back_batch(micrograph, counts, claimed)
 
-@app.task
-def create_average_mask(index, average):
+            return True
+
+        except Exception:
+            # Roll back the batch for any other failure, so that the label
+            # counts match the database record and the masks are retried.
+            logger.exception(f"Failed to ingest masks for micrograph '{name}'")
+            _roll_back_batch(micrograph, counts, claimed)
+            raise
+
+        # The masks have been ingested. Any that can't be removed now are
+        # removed by the next ingestion.
+        ingest.remove_masks(claimed)
+
+    # Notify the clients that their uploads have been processed.
+    events.publish(ips, "upload", {"index" : index, "num_labels" : micrograph.num_labels})
+
+    # Record the batch size and the record updates that batching saved.
+    metrics.ingest_batch_size.observe(len(pending))
+    metrics.ingest_conflicts_avoided.inc(len(pending) - 1)
+
+    # Log that a the micrograph was updated.
+    logger.info(f"Successfully updated record for micrograph '{name}' "
+                f"with a batch of {len(pending)} labels")
+
+    # Write the masks and SVGs to file, outside of the lock. This can be
+    # deferred to a background thread.
+    for label, entry in enumerate(claimed, start=first_label):
+
+        # Create name of the micrograph label mask.
+        mask_name = f"label/masks/{name}/" + f"{label}".rjust(6, "0")
+
+        if settings.PROOF_DEFER_MASKS:
+            masks.save_mask_deferred(entry.mask, mask_name, entry.svg, entry.strokes)
+        else:
+            with metrics.ingest_stage_seconds.labels("save").time():
+                masks.save_mask(entry.mask, mask_name, entry.svg, entry.strokes)
+
+def _roll_back_batch(micrograph, counts, claimed):
     """
-    Write the average mask for a micrograph to disk and return the path to
-    the image.
+    Helper function to remove a batch from the label counts after its
+    database update fails, and return its masks to the spool. If the counts
+    can't be rolled back, the micrograph is flagged so that
+    `rebuild_label_statistics --dirty` reconciles them with the masks.
+    Masks that can't be returned are resolved by the next ingestion.
+    """
+    try:
+        accumulator.subtract_from_accumulator(micrograph.name, counts)
+    except Exception:
+        logger.exception(f"Failed to roll back label counts for micrograph "
+                         f"'{micrograph.name}'")
+        Micrograph.objects.filter(id=micrograph.id).update(statistics_dirty=True)
+
+    try:
+        ingest.release_masks(claimed)
+    except OSError:
+        logger.exception(f"Failed to return masks to the spool for micrograph "
+                         f"'{micrograph.name}'")
+
+@app.task(ignore_result=False)
+def create_average_mask(index, ip=None):
+    """
+    Render the average mask for a micrograph, if it isn't already cached,
+    and return the versioned URL of the image. The result is stored, so that
+    the average view can wait for it.
 
 
     Parameters
@@ -123,126 +275,279 @@ def create_average_mask(index, average):
     index : int
         The index of the micrograph in the Django database.
 
-    average : str
-        The name of the previous average mask that has been served to the
-        client.
+    ip : str
+        The IP address of the client that requested the image, which is sent
+        an "average" event with the URL once it is ready.
 
 
     Returns
     -------
 
-    path : str
-        The path to the average mask.
+    url : str
+        The URL of the average mask, or "NULL" if there are no labels.
     """
 
     # Get the micrograph in the database.
-    micrograph = Micrograph.objects.get(pk=index)
-
-    # Only process average if a label has been uploaded.
-    if micrograph.num_labels >= 0:
-        # Load the current average label.
-        current_average = pickle.loads(base64.b64decode(micrograph.average))
-        current_average = (current_average / micrograph.num_labels).astype("uint8")
-
-        # Delete the existing image.
-        if average:
-            filename = f"label/static/{average.split('static/')[1]}"
-            if os.path.exists(filename):
-                os.remove(filename)
-
-        # Create a random 64-bit integer string for the file.
-        filename = str(uuid.uuid1().int>>64)
+    micrograph = Micrograph.objects.only("path", "num_labels").get(pk=index)
 
-        # Write the average labels to disk.
-        imageio.imwrite(f"label/static/{filename}.png", current_average)
+    # Render the average labels, or re-use the cached image.
+    if renders.get_render(micrograph, "average", settings.PROOF_RENDER_CACHE_SIZE):
+        url = renders.render_url(micrograph, "average")
+    else:
+        url = "NULL"
 
-        # Insert the micrograph, index, and IP address into the response.
-        return f"static/{filename}.png"
+    # Notify the client that the image is ready.
+    if ip is not None:
+        events.publish([ip], "average", {"index" : index, "average" : url})
 
-    else:
-        return "NULL"
+    return url
 
 @app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
-    # Compute the variance for each set of micrograph masks every hour.
+    # Remove expired uploads from the staging area every hour.
+    sender.add_periodic_task(
+        crontab(hour="*", minute=30, day_of_week="*"),
+        clean_staged_uploads.s(),
+    )
+
+    # Remove stale and unused renders every hour.
+    sender.add_periodic_task(
+        crontab(hour="*", minute=45, day_of_week="*"),
+        sweep_renders.s(),
+    )
+
+    # Remove old events every hour.
     sender.add_periodic_task(
-        crontab(hour="*", minute=0, day_of_week="*"),
-        compute_mask_variance.s(),
+        crontab(hour="*", minute=15, day_of_week="*"),
+        clean_events.s(),
     )
 
+# The start time and database timer of each running task, and the start time
+# of each task being published, keyed by task ID.
+_running = {}
+_publishing = {}
+
+@signals.before_task_publish.connect
+def _before_task_publish(sender=None, headers=None, **kwargs):
+    # Stamp the message, so that the time spent queued can be measured.
+    headers["proof_published"] = time.time()
+    _publishing[headers["id"]] = time.perf_counter()
+
+@signals.after_task_publish.connect
+def _after_task_publish(sender=None, headers=None, **kwargs):
+    start = _publishing.pop(headers["id"], None)
+    if start is not None:
+        metrics.task_publish_seconds.labels(sender).observe(time.perf_counter() - start)
+
+@signals.task_prerun.connect
+def _task_prerun(task_id=None, task=None, **kwargs):
+    published = getattr(task.request, "proof_published", None)
+    if published is not None:
+        metrics.task_queue_seconds.labels(task.name).observe(max(0, time.time() - published))
+
+    # Time the queries made by the task.
+    timer = metrics.QueryTimer()
+    wrapper = connection.execute_wrapper(timer)
+    wrapper.__enter__()
+
+    _running[task_id] = (time.perf_counter(), timer, wrapper)
+
+@signals.task_postrun.connect
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    running = _running.pop(task_id, None)
+    if running is None:
+        return
+
+    start, timer, wrapper = running
+    wrapper.__exit__(None, None, None)
+
+    metrics.task_seconds.labels(task.name).observe(time.perf_counter() - start)
+    metrics.task_db_seconds.labels(task.name).observe(timer.seconds)
+    metrics.task_results.labels(task.name, state).inc()
+
+    # Make the metrics for this worker visible to the scrape endpoint.
+    metrics.flush()
+
+@signals.task_retry.connect
+def _task_retry(sender=None, **kwargs):
+    metrics.task_retries.labels(sender.name).inc()
+
+@signals.worker_process_shutdown.connect
+def _worker_process_shutdown(**kwargs):
+    metrics.flush(force=True)
+
 @app.task
-def compute_mask_variance():
-    # Log that the periodic variance computation has started.
-    logger.info(f"Starting micrograph mask variance computation...")
+def clean_staged_uploads():
+    """
+    Remove staged uploads that were never consumed, e.g. because the task
+    that referenced them was lost.
+    """
+    num_removed = staging.remove_expired_uploads(settings.PROOF_STAGING_TTL)
 
-    # Get the micrographs in the database.
-    micrographs = Micrograph.objects.all()
+    logger.info(f"Removed {num_removed} expired staged upload files")
+
+@app.task
+def clean_events():
+    """
+    Remove events that are too old to be resent to reconnecting clients.
+    """
+    num_removed = events.remove_expired_events(settings.PROOF_EVENT_TTL)
+
+    logger.info(f"Removed {num_removed} expired events")
+
+@app.task
+def sweep_renders():
+    """
+    Remove cached renders that are out of date, or that haven't been used
+    recently, then trim the cache to its maximum size.
+    """
+    current = dict(Micrograph.objects.values_list("id", "num_labels"))
+
+    num_removed = renders.sweep(current, settings.PROOF_RENDER_MAX_AGE)
+    num_removed += renders.evict(settings.PROOF_RENDER_CACHE_SIZE)
+
+    logger.info(f"Removed {num_removed} cached render files")
+
+@app.task
+def compute_mask_variance(rebuild_all=False):
+    """
+    Rebuild the label counts and variance from the masks on disk for the
+    micrographs whose statistics may be out of step with their masks. The
+    variance is kept up to date as labels are ingested, so this is only
+    needed to recover from a failed rollback, or to recover labels uploaded
+    before the running sums were recorded. It isn't scheduled, since reading
+    every mask is expensive.
+
+    The micrographs are sharded across the Celery workers, or across a
+    local process pool if running locally.
 
-    # Loop over all of the micrographs.
-    for micrograph in micrographs:
 
-        # Store the number of labels for this micrograph.
-        num_labels = micrograph.num_labels
+    Parameters
+    ----------
+
+    rebuild_all : bool
+        Whether to rebuild every micrograph, rather than only those with
+        new labels.
+    """
 
-        # Only compute the variance if there are multiple labels.
-        if num_labels > 1:
+    # Log that the variance computation has started.
+    logger.info(f"Starting micrograph mask variance computation...")
 
-            # Try to compute the variance until successful. This avoids concurrency
-            # issues when a micrograph record is updated while the variance is
-            # being calculated.
-            while True:
+    # Get the micrographs that need rebuilding. Only the indices are loaded.
+    micrographs = Micrograph.objects.all()
+    if not rebuild_all:
+        micrographs = micrographs.filter(statistics_dirty=True)
+    indices = list(micrographs.order_by("id").values_list("id", flat=True).iterator())
 
-                # Get the name of the micrograph with no path or extension.
-                name = micrograph.path.split("/")[2].split(".")[0]
+    if settings.PROOF_LOCAL:
+        rebuild_label_statistics_locally(indices)
+    else:
+        # Dispatch the micrographs to the workers in shards.
+        rebuild_label_statistics.chunks(((index,) for index in indices),
+                settings.PROOF_VARIANCE_SHARD_SIZE).group().apply_async()
 
-                # Get the current average.
-                current_average = pickle.loads(base64.b64decode(micrograph.average))
+    logger.info(f"Dispatched {len(indices)} micrographs for mask variance computation.")
 
-                # Convert to one-dimensional NumPy array in range 0 to 1.
-                avg_array = (current_average/num_labels).flatten() / 255
+def rebuild_label_statistics_locally(indices, num_workers=None):
+    """
+    Rebuild the label statistics for a set of micrographs using a pool of
+    local processes.
 
-                # Zero the variance for this micrograph.
-                variance = 0
 
-                # Loop over all of the labels for this micrograph.
-                for label in range(0, micrograph.num_labels):
+    Parameters
+    ----------
 
-                    # Create the directory name for the masks.
-                    mask_dir = f"label/masks/{name}"
+    indices : [int]
+        The indices of the micrographs in the Django database.
 
-                    # Create name of the micrograph label mask.
-                    mask_name = f"{mask_dir}/" + f"{label}".rjust(6, "0") + ".png"
+    num_workers : int
+        The number of processes. Defaults to the number of CPUs.
+    """
+    if len(indices) == 0:
+        return
 
-                    # Load the mask as a NumPy array. Make sure this is a 64-bit int.
-                    image = imageio.imread(mask_name).astype("uint64")
+    # Close the database connections so that they aren't shared with the
+    # worker processes, which open their own.
+    connections.close_all()
 
-                    # Convert to one-dimensional NumPy array in range 0 to 1.
-                    img_array = image.flatten() / 255
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=django.setup) as pool:
+        for index in pool.map(_rebuild_label_statistics, indices):
+            pass
 
-                    # Accumulate the variance.
-                    variance = sum((img_array-avg_array)**2) / len(img_array)
+def _rebuild_label_statistics(index):
+    """
+    Helper function to rebuild the label statistics for a micrograph in a
+    worker process.
+    """
+    rebuild_label_statistics(index)
+    return index
 
-                # Normalise the variance.
-                variance /= num_labels
+@app.task
+def rebuild_label_statistics(index):
+    """
+    Rebuild the label counts, running sums, and variance for a micrograph
+    from the masks on disk.
 
-                try:
-                    micrograph.variance = variance
-                    micrograph.save()
 
-                    # Log that a the micrograph was updated.
-                    logger.info(f"Computed mask variance for micrograph '{name}'")
+    Parameters
+    ----------
 
-                    # Micrograph record updated. Terminate the while loop.
-                    break
+    index : int
+        The index of the micrograph in the Django database.
+    """
 
-                except:
-                    # Log that a concurrency issue occurred.
-                    logger.warning(f"Database concurrency issue for micrograph '{name}'")
+    # Get the name of the micrograph with no path or extension.
+    name = Micrograph.objects.only("path").get(id=str(index)).name
 
-                    # Concurrency error. Re-load the latest micrograph records.
-                    micrographs = Micrograph.objects.all()
+    # Hold the accumulator lock for this micrograph so that no labels are
+    # ingested while the statistics are rebuilt.
+    with accumulator.lock(name):
 
-                    # Return to the top of the while loop.
-                    continue
+        # Get the latest micrograph record from the database.
+        micrograph = Micrograph.objects.get(id=str(index))
 
-    logger.info(f"Endend micrograph mask variance computation.")
+        # Nothing to do if there are no labels.
+        if micrograph.num_labels == 0:
+            return
+
+        # Sum the masks, one at a time so that memory use is bounded. Masks
+        # are numbered from 000001.
+        counts = None
+        for label in range(1, micrograph.num_labels+1):
+
+            # Create name of the micrograph label mask.
+            mask_name = f"label/masks/{name}/" + f"{label}".rjust(6, "0")
+
+            # Don't overwrite the running counts with an incomplete set of
+            # masks, e.g. if deferred masks haven't been written yet. The
+            # micrograph keeps its dirty flag, so a later rebuild retries it.
+            if not os.path.exists(mask_name + ".png"):
+                logger.warning(f"Missing mask '{mask_name}.png', not rebuilding "
+                               f"statistics for micrograph '{name}'")
+                return
+
+            mask = masks.load_mask(mask_name)
+
+            if counts is None:
+                counts = mask.astype(np.uint32)
+            else:
+                counts += mask
+
+        # Replace the running counts and sums.
+        accumulator.replace_accumulator(name, counts)
+        micrograph.statistics_dirty = False
+        counts = counts.astype(np.int64).ravel()
+        micrograph.label_sum = int(counts.sum())
+        micrograph.label_sum_squares = int(np.dot(counts, counts))
+        micrograph.variance = accumulator.label_variance(micrograph.num_labels,
+                                                         micrograph.label_sum,
+                                                         micrograph.label_sum_squares,
+                                                         counts.size)
+        scheduling.update_priority(micrograph)
+
+        # Save the updated micrograph record.
+        micrograph.save()
+
+    # Log that a the micrograph was updated.
+    logger.info(f"Computed mask variance for micrograph '{name}'")
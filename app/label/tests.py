@@ -1,3 +1,1271 @@
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from concurrency.exceptions import RecordModifiedError
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
 
-# Create your tests here.
+from datetime import timedelta
+from PIL import Image
+from skimage import exposure
+from unittest import mock
+
+import asyncio
+import json
+import mrcfile
+import numpy as np
+import os
+import skimage
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from . import accumulator, consensus, events, export, ingest, masks, metrics, rasterise, \
+              registration, renders, scheduling, staging, tasks, tiles, variants, views
+from .models import Event, Label, Micrograph, Reservation
+from .scripts import pre_process_micrographs
+
+def _random_mask(shape, fraction, seed=0):
+    """
+    Helper function to create a random mask with roughly the given fraction
+    of filament pixels.
+    """
+    return np.random.default_rng(seed).random(shape) < fraction
+
+def _strokes(width, height, paths=None, widths=None):
+    """
+    Helper function to JSON encode a set of strokes.
+    """
+    if paths is None:
+        paths = [[[0, height / 2], [width, height / 2]]]
+    if widths is None:
+        widths = [2] * len(paths)
+
+    return json.dumps({"width" : width, "height" : height, "paths" : paths, "widths" : widths})
+
+def _write_mrc(path, data):
+    """
+    Helper function to write a micrograph, or a stack of frames, to an MRC
+    file.
+    """
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(data)
+
+def setUpModule():
+    # Don't start the metrics heartbeat thread, which would keep writing
+    # snapshots into whichever directory is current, including the app's.
+    patch = mock.patch.dict(metrics._process, heartbeat=mock.Mock())
+    patch.start()
+    unittest.addModuleCleanup(patch.stop)
+
+class WorkingDirectoryMixin:
+    """
+    Run each test in a scratch directory, since the app reads and writes
+    relative to the working directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+
+    def create_micrograph(self, name="m0", shape=(60, 80)):
+        """
+        Write a micrograph image and add it to the database.
+        """
+        os.makedirs("label/static/micrographs", exist_ok=True)
+        Image.fromarray(np.zeros(shape, dtype=np.uint8)).save(
+                f"label/static/micrographs/{name}.png")
+        return Micrograph.objects.create(path=f"static/micrographs/{name}.png")
+
+class RunLengthEncodingTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        for shape in [(1, 1), (7, 13), (300, 200)]:
+            for fraction in [0, 0.01, 0.5, 1]:
+                mask = _random_mask(shape, fraction)
+                data = masks.encode_rle(mask)
+
+                self.assertEqual(masks.rle_shape(data), shape)
+                np.testing.assert_array_equal(masks.decode_rle(data), mask)
+                np.testing.assert_array_equal(masks.decode_rle(data, shape), mask)
+
+    def test_first_pixel_filament(self):
+        mask = np.zeros((2, 3), dtype=bool)
+        mask[0, 0] = True
+
+        # The first run of background has zero length.
+        self.assertEqual(masks.encode_rle(mask), bytes([2, 3, 0, 1, 5]))
+
+    def test_large_values(self):
+        mask = np.zeros((200, 1000), dtype=bool)
+        data = masks.encode_rle(mask)
+
+        self.assertEqual(data, bytes([0xc8, 0x01, 0xe8, 0x07, 0xc0, 0x9a, 0x0c]))
+        np.testing.assert_array_equal(masks.decode_rle(data), mask)
+
+    def test_shape_mismatch(self):
+        data = masks.encode_rle(_random_mask((10, 10), 0.5))
+
+        with self.assertRaises(ValueError):
+            masks.decode_rle(data, (800, 800))
+
+    def test_shape_checked_before_expanding(self):
+        # A header claiming a huge mask is rejected without decoding the runs.
+        data = bytes([0xff, 0xff, 0xff, 0x7f, 0xff, 0xff, 0xff, 0x7f, 0x01])
+
+        with self.assertRaises(ValueError):
+            masks.decode_rle(data, (800, 800))
+
+    def test_wrong_number_of_pixels(self):
+        with self.assertRaises(ValueError):
+            masks.decode_rle(bytes([10, 10, 50]))
+
+    def test_missing_shape(self):
+        with self.assertRaises(ValueError):
+            masks.rle_shape(bytes([1]))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            masks.decode_rle(bytes([2, 2, 0x84]))
+
+    def test_decode_rejects_unexpected_shape(self):
+        data = masks.encode_rle(_random_mask((10, 10), 0.5))
+
+        with self.assertRaises(ValueError):
+            masks.decode(data, "rle", (20, 20), {(20, 20)})
+
+    def test_decode_resamples(self):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[:, :5] = True
+
+        decoded = masks.decode(masks.encode_rle(mask), "rle", (20, 20), {(10, 10)})
+
+        self.assertEqual(decoded.shape, (20, 20))
+        self.assertTrue(decoded[:, :10].all())
+        self.assertFalse(decoded[:, 10:].any())
+
+class StrokeTests(SimpleTestCase):
+
+    def test_parse(self):
+        strokes = rasterise.parse_strokes(_strokes(80, 60))
+
+        self.assertEqual((strokes["height"], strokes["width"]), (60, 80))
+
+    def test_parse_accepted_shape(self):
+        rasterise.parse_strokes(_strokes(80, 60), {(60, 80), (120, 160)})
+
+    def test_parse_rejects_unexpected_shape(self):
+        with self.assertRaises(ValueError):
+            rasterise.parse_strokes(_strokes(10, 10), {(60, 80)})
+
+    def test_parse_rejects_invalid(self):
+        for data in ["not json",
+                     "[]",
+                     _strokes(0, 60),
+                     _strokes(rasterise.MAX_SIZE + 1, 60),
+                     _strokes(80, 60, widths=[]),
+                     _strokes(80, 60, widths=[0]),
+                     _strokes(80, 60, paths=[[]]),
+                     _strokes(80, 60, paths=[[["a", 0]]])]:
+            with self.assertRaises(ValueError, msg=data):
+                rasterise.parse_strokes(data)
+
+    def test_rasterise_at_shape(self):
+        strokes = rasterise.parse_strokes(_strokes(80, 60))
+
+        # The mask has the requested shape, not that of the canvas.
+        mask = rasterise.rasterise_strokes(strokes, (120, 160))
+
+        self.assertEqual(mask.shape, (120, 160))
+        self.assertTrue(mask[60].all())
+        self.assertFalse(mask[:50].any())
+        self.assertFalse(mask[70:].any())
+
+    def test_parse_rejects_too_many_paths(self):
+        with self.settings(PROOF_MAX_STROKE_PATHS=2):
+            with self.assertRaises(ValueError):
+                rasterise.parse_strokes(_strokes(80, 60, paths=[[[0, 0]]] * 3))
+
+    def test_parse_rejects_too_many_points(self):
+        with self.settings(PROOF_MAX_STROKE_POINTS=10):
+            with self.assertRaises(ValueError):
+                rasterise.parse_strokes(_strokes(80, 60, paths=[[[0, 0]] * 11]))
+
+    def test_rasterise_long_segment_in_bands(self):
+        strokes = rasterise.parse_strokes(_strokes(80, 60, paths=[[[0, 0], [80, 60]]],
+                                                   widths=[80]))
+
+        # A segment whose bounding box holds more pixels than can be tested
+        # at once gives the same mask when split into bands.
+        expected = rasterise.rasterise_strokes(strokes, (120, 160))
+        with mock.patch.object(rasterise, "MAX_PAIRS", 1000):
+            with mock.patch.object(rasterise, "_rasterise_segments",
+                                   wraps=rasterise._rasterise_segments) as rasterise_segments:
+                mask = rasterise.rasterise_strokes(strokes, (120, 160))
+
+        np.testing.assert_array_equal(mask, expected)
+        self.assertGreater(rasterise_segments.call_count, 1)
+        for call in rasterise_segments.call_args_list:
+            self.assertLessEqual(int(call.args[-1].sum()), 1000)
+
+    def test_decode_requires_shape(self):
+        with self.assertRaises(ValueError):
+            masks.decode(_strokes(80, 60).encode(), "json")
+
+class LabelVarianceTests(SimpleTestCase):
+
+    def test_variance(self):
+        labels = np.stack([_random_mask((30, 40), 0.3, seed) for seed in range(5)])
+        counts = labels.sum(axis=0, dtype=np.int64)
+
+        variance = accumulator.label_variance(len(labels), int(counts.sum()),
+                                              int((counts**2).sum()), counts.size)
+
+        self.assertAlmostEqual(variance, float(labels.var(axis=0).mean()))
+
+    def test_no_labels(self):
+        self.assertEqual(accumulator.label_variance(0, 0, 0, 100), 0.0)
+
+class DisagreementTests(SimpleTestCase):
+
+    def _disagreement(self, labels):
+        counts = np.sum(labels, axis=0, dtype=np.int64)
+        return scheduling.disagreement(len(labels), int(counts.sum()), int((counts**2).sum()))
+
+    def test_agreement(self):
+        mask = _random_mask((30, 40), 0.3)
+
+        self.assertEqual(self._disagreement([mask] * 3), 0.0)
+
+    def test_disjoint(self):
+        labels = np.zeros((4, 10, 10), dtype=bool)
+        for i in range(4):
+            labels[i, i] = True
+
+        self.assertAlmostEqual(self._disagreement(labels), 0.75)
+
+    def test_partial_overlap(self):
+        labels = np.zeros((2, 10, 10), dtype=bool)
+        labels[0, :4] = True
+        labels[1, 2:6] = True
+
+        self.assertAlmostEqual(self._disagreement(labels), 0.25)
+
+    def test_single_label(self):
+        self.assertEqual(self._disagreement([_random_mask((30, 40), 0.3)]), 0.0)
+
+class AccumulatorTests(WorkingDirectoryMixin, SimpleTestCase):
+
+    def test_deltas(self):
+        labels = [_random_mask((30, 40), 0.3, seed) for seed in range(4)]
+        batch = np.sum(labels[2:], axis=0, dtype=np.uint32)
+
+        accumulator.add_to_accumulator("m0", labels[0])
+        accumulator.add_to_accumulator("m0", labels[1])
+        delta_sum, delta_sum_squares = accumulator.add_to_accumulator("m0", batch)
+
+        before = np.sum(labels[:2], axis=0, dtype=np.int64)
+        after = np.sum(labels, axis=0, dtype=np.int64)
+        self.assertEqual(delta_sum, int(after.sum() - before.sum()))
+        self.assertEqual(delta_sum_squares, int((after**2).sum() - (before**2).sum()))
+        np.testing.assert_array_equal(accumulator.load_accumulator("m0"), after)
+
+    def test_empty_batch(self):
+        accumulator.add_to_accumulator("m0", _random_mask((30, 40), 0.3))
+
+        self.assertEqual(accumulator.add_to_accumulator("m0", np.zeros((30, 40), dtype=bool)),
+                         (0, 0))
+
+    def test_promotes_on_overflow(self):
+        maximum = np.iinfo(accumulator.ACCUMULATOR_DTYPE).max
+        counts = np.zeros((30, 40), dtype=np.uint32)
+        counts[0, 0] = maximum
+        accumulator.add_to_accumulator("m0", counts)
+
+        mask = np.zeros((30, 40), dtype=bool)
+        mask[0, :2] = True
+        delta_sum, delta_sum_squares = accumulator.add_to_accumulator("m0", mask)
+
+        result = accumulator.load_accumulator("m0")
+        self.assertEqual(result.dtype, np.uint32)
+        self.assertEqual((int(result[0, 0]), int(result[0, 1])), (maximum + 1, 1))
+        self.assertEqual(delta_sum, 2)
+        self.assertEqual(delta_sum_squares, (maximum + 1)**2 - maximum**2 + 1)
+
+    def test_subtract(self):
+        first, second = _random_mask((30, 40), 0.3, 0), _random_mask((30, 40), 0.3, 1)
+        accumulator.add_to_accumulator("m0", first)
+        accumulator.add_to_accumulator("m0", second)
+
+        accumulator.subtract_from_accumulator("m0", second)
+
+        np.testing.assert_array_equal(accumulator.load_accumulator("m0"), first)
+
+    def test_shape_mismatch(self):
+        accumulator.add_to_accumulator("m0", _random_mask((30, 40), 0.3))
+
+        with self.assertRaises(ValueError):
+            accumulator.add_to_accumulator("m0", _random_mask((40, 30), 0.3))
+
+class IncrementalStatisticsTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+
+    def test_ingest_updates_variance(self):
+        labels = [_random_mask((60, 80), 0.3, seed) for seed in range(3)]
+        for i, label in enumerate(labels):
+            ingest.spool_mask(self.micrograph.name, f"10.0.0.{i}", label, None)
+
+        with self.settings(PROOF_DEFER_MASKS=False):
+            tasks.ingest_micrograph_masks(self.micrograph.id)
+
+        # The statistics are exact without a rebuild, so nothing is left to
+        # reconcile.
+        micrograph = Micrograph.objects.get(id=self.micrograph.id)
+        self.assertEqual(micrograph.num_labels, 3)
+        self.assertAlmostEqual(micrograph.variance, float(np.var(labels, axis=0).mean()))
+        self.assertFalse(micrograph.statistics_dirty)
+
+    def test_failed_rollback_marks_dirty(self):
+        with mock.patch.object(accumulator, "subtract_from_accumulator",
+                               side_effect=OSError):
+            tasks._roll_back_batch(self.micrograph, np.ones((60, 80), dtype=np.uint32), [])
+
+        self.assertTrue(Micrograph.objects.get(id=self.micrograph.id).statistics_dirty)
+
+    def test_periodic_tasks_skip_rebuild(self):
+        sender = mock.Mock()
+        tasks.setup_periodic_tasks(sender)
+
+        scheduled = [call.args[1].task for call in sender.add_periodic_task.call_args_list]
+        self.assertNotIn(tasks.compute_mask_variance.name, scheduled)
+
+class IngestionTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+        self.labels = [_random_mask((60, 80), 0.3, seed) for seed in range(3)]
+
+        override = self.settings(PROOF_DEFER_MASKS=False)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def spool(self, labels):
+        for i, label in enumerate(labels):
+            ingest.spool_mask(self.micrograph.name, f"10.0.0.{i}", label, None)
+
+    def assert_ingested(self, labels):
+        micrograph = Micrograph.objects.get(id=self.micrograph.id)
+        self.assertEqual(micrograph.num_labels, len(labels))
+        self.assertEqual(Label.objects.filter(micrograph=micrograph).count(), len(labels))
+        np.testing.assert_array_equal(accumulator.load_accumulator(micrograph.name),
+                                      np.sum(labels, axis=0))
+        self.assertEqual(os.listdir(f"{ingest.INGEST_DIR}/{micrograph.name}"), [])
+
+    def test_batch(self):
+        self.spool(self.labels)
+
+        tasks.ingest_micrograph_masks(self.micrograph.id)
+
+        self.assert_ingested(self.labels)
+        self.assertEqual(sorted(os.listdir(f"label/masks/{self.micrograph.name}")),
+                         ["000001.png", "000002.png", "000003.png"])
+
+    def test_failed_commit_rolls_back(self):
+        self.spool(self.labels)
+
+        with mock.patch.object(Label.objects, "bulk_create", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                tasks._ingest_micrograph_masks(self.micrograph.id)
+
+        # Nothing is counted, and the masks are pending again.
+        micrograph = Micrograph.objects.get(id=self.micrograph.id)
+        self.assertEqual(micrograph.num_labels, 0)
+        self.assertEqual(Label.objects.filter(micrograph=micrograph).count(), 0)
+        self.assertFalse(accumulator.load_accumulator(micrograph.name).any())
+        self.assertEqual(len(ingest.pending_masks(micrograph.name)), 3)
+
+        # The retry counts them once.
+        tasks._ingest_micrograph_masks(self.micrograph.id)
+        self.assert_ingested(self.labels)
+
+    def test_retry_after_failed_removal(self):
+        self.spool(self.labels)
+
+        with mock.patch("os.remove", side_effect=PermissionError):
+            tasks._ingest_micrograph_masks(self.micrograph.id)
+        self.assertEqual(len(os.listdir(f"{ingest.INGEST_DIR}/{self.micrograph.name}")), 3)
+
+        # The masks left behind were committed, so they aren't counted again.
+        tasks._ingest_micrograph_masks(self.micrograph.id)
+        self.assert_ingested(self.labels)
+
+    def test_recovers_interrupted_commit(self):
+        self.spool(self.labels)
+        pending = ingest.pending_masks(self.micrograph.name)
+        ingest.claim_masks(pending, 3)
+
+        # The batch was claimed but never committed, so it is ingested again,
+        # and the statistics are flagged in case the counts included it.
+        tasks._ingest_micrograph_masks(self.micrograph.id)
+
+        micrograph = Micrograph.objects.get(id=self.micrograph.id)
+        self.assertEqual(micrograph.num_labels, 3)
+        self.assertTrue(micrograph.statistics_dirty)
+
+    def test_conflict_reschedules(self):
+        self.spool(self.labels)
+
+        with mock.patch.object(Micrograph, "save", side_effect=RecordModifiedError(target=None)):
+            with mock.patch.object(tasks.ingest_micrograph_masks, "apply_async") as apply_async:
+                tasks.ingest_micrograph_masks(self.micrograph.id)
+
+        apply_async.assert_called_once()
+        self.assertEqual(len(ingest.pending_masks(self.micrograph.name)), 3)
+        self.assertFalse(accumulator.load_accumulator(self.micrograph.name).any())
+
+    def test_quarantines_wrong_shape(self):
+        self.spool(self.labels[:1] + [_random_mask((10, 10), 0.3)])
+
+        tasks.ingest_micrograph_masks(self.micrograph.id)
+
+        self.assert_ingested(self.labels[:1])
+        self.assertEqual(len(os.listdir(f"{ingest.QUARANTINE_DIR}/{self.micrograph.name}")), 1)
+
+class TaskResultTests(SimpleTestCase):
+
+    def test_app_finalized(self):
+        from proof.celery import app
+
+        # The tasks are bound before any thread can use them.
+        self.assertTrue(app.finalized)
+        self.assertIs(app.tasks[tasks.create_average_mask.name].app, app)
+
+    def test_result_backend(self):
+        from proof.celery import app
+
+        self.assertTrue(app.conf.result_backend.startswith("file://"))
+        self.assertFalse(tasks.create_average_mask.ignore_result)
+
+    def test_wait_for_result(self):
+        result = mock.Mock()
+        result.ready.side_effect = [False, False, True]
+        result.successful.return_value = True
+        result.result = "/label/renders/average.png"
+
+        url = asyncio.run(views._wait_for_result(result, 5))
+
+        self.assertEqual(url, "/label/renders/average.png")
+        self.assertEqual(result.ready.call_count, 3)
+
+    def test_wait_for_failed_result(self):
+        result = mock.Mock()
+        result.ready.return_value = True
+        result.successful.return_value = False
+
+        self.assertIsNone(asyncio.run(views._wait_for_result(result, 5)))
+
+    def test_wait_for_result_timeout(self):
+        result = mock.Mock()
+        result.ready.return_value = False
+
+        self.assertIsNone(asyncio.run(views._wait_for_result(result, 0.1)))
+
+class BenchmarkTests(SimpleTestCase):
+
+    def test_concurrent_labellers(self):
+        # The benchmark sets up its own database, so is run in a separate
+        # process, with several labellers uploading at once.
+        result = subprocess.run([sys.executable, "manage.py", "benchmark", "--labellers", "4",
+                                 "--cycles", "2", "--micrographs", "3", "--repeat", "1"],
+                                cwd=settings.BASE_DIR, capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        # Every cycle of every labeller completes.
+        self.assertRegex(result.stdout, r"load/cycle\s+8\s")
+
+class EventTests(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        override = self.settings(PROOF_EVENT_POLL_INTERVAL=0.01)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    async def read(self, stream, count):
+        """
+        Read a number of events from a stream, skipping the retry interval.
+        """
+        self.assertTrue((await anext(stream)).startswith("retry:"))
+        try:
+            return [await asyncio.wait_for(anext(stream), 5) for _ in range(count)]
+        finally:
+            await stream.aclose()
+
+    async def publish(self, ips, kind, data):
+        await sync_to_async(events.publish)(ips, kind, data)
+
+    def test_only_new_events(self):
+        async def run():
+            await self.publish(["10.0.0.1"], "upload", {"index" : 0})
+            stream = events.stream("10.0.0.1")
+            try:
+                await anext(stream)
+                await self.publish(["10.0.0.1"], "upload", {"index" : 1})
+                return [await asyncio.wait_for(anext(stream), 5)]
+            finally:
+                await stream.aclose()
+
+        (message,) = asyncio.run(run())
+        self.assertIn('"index": 1', message)
+
+    def test_event_while_subscribing(self):
+        subscribe = events.EventHub.subscribe
+
+        async def publish_then_subscribe(hub, ip):
+            await self.publish([ip], "upload", {"index" : 2})
+            return await subscribe(hub, ip)
+
+        async def run():
+            with mock.patch.object(events.EventHub, "subscribe", publish_then_subscribe):
+                return await self.read(events.stream("10.0.0.1"), 1)
+
+        # The event is published after the stream starts, but before it is
+        # subscribed, so it must still be delivered.
+        (message,) = asyncio.run(run())
+        self.assertIn("event: upload", message)
+        self.assertIn('"index": 2', message)
+
+    def test_resume(self):
+        async def run():
+            await self.publish(["10.0.0.1"], "upload", {"index" : 0})
+            await self.publish(["10.0.0.2"], "upload", {"index" : 1})
+            await self.publish(["10.0.0.1"], "average", {"index" : 2})
+            first = await sync_to_async(Event.objects.order_by("id").first)()
+            return await self.read(events.stream("10.0.0.1", first.id), 1)
+
+        # Only the missed events for the client are resent.
+        (message,) = asyncio.run(run())
+        self.assertIn("event: average", message)
+
+class LocalUploadTests(SimpleTestCase):
+
+    def test_processed_in_background(self):
+        started, release = threading.Event(), threading.Event()
+
+        def process(ip, index, reference):
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(views, "proof_local", True), \
+             mock.patch.object(views, "process_micrograph_mask", side_effect=process) as task, \
+             mock.patch.object(views.staging, "stage_upload", return_value="ref.png"):
+            views._queue_upload("10.0.0.1", 0, b"", "png")
+
+            # The upload is queued without waiting for it to be processed.
+            self.assertTrue(started.wait(5))
+            self.assertFalse(release.is_set())
+
+            release.set()
+            views.wait_for_uploads()
+
+        task.assert_called_once_with("10.0.0.1", 0, "ref.png")
+
+class MetricSnapshotTests(WorkingDirectoryMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(metrics.METRICS_DIR)
+
+        # Don't start a heartbeat thread, or count the metrics of this process.
+        patch = mock.patch.dict(metrics._process, heartbeat=mock.Mock())
+        patch.start()
+        self.addCleanup(patch.stop)
+        for metric in metrics.registry.values():
+            patch = mock.patch.object(metric, "values", {})
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write_snapshot(self, name, conflicts, age=0):
+        path = f"{metrics.METRICS_DIR}/{name}.json"
+        snapshot = {"proof_ingest_conflicts_total" : dict(metrics.ingest_conflicts.snapshot(),
+                                                          values=[[[], conflicts]])}
+        with open(path, "w") as f:
+            json.dump(snapshot, f)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+
+        return path
+
+    def conflicts(self):
+        values = metrics.collect()["proof_ingest_conflicts_total"]["values"]
+        return values.get((), 0)
+
+    def test_live_snapshots_kept(self):
+        live = self.write_snapshot(f"{metrics._process['host']}-{os.getpid()}-abcd1234", 2)
+        other = self.write_snapshot("other-host-1-abcd1234", 3)
+
+        self.assertEqual(self.conflicts(), 5)
+        self.assertTrue(os.path.exists(live))
+        self.assertTrue(os.path.exists(other))
+
+    def test_stale_snapshot_merged(self):
+        # A replaced container's snapshot is no longer rewritten.
+        stale = self.write_snapshot("old-container-1-abcd1234", 3,
+                                    age=metrics.STALE_INTERVAL + 1)
+
+        self.assertEqual(self.conflicts(), 3)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(metrics.AGGREGATE_PATH))
+
+        # The counters don't go backwards as more snapshots are merged.
+        self.write_snapshot("old-container-2-abcd1234", 4, age=metrics.STALE_INTERVAL + 1)
+        self.assertEqual(self.conflicts(), 7)
+
+    def test_exited_process_merged(self):
+        process = subprocess.Popen([sys.executable, "-c", ""])
+        process.wait()
+        exited = self.write_snapshot(f"{metrics._process['host']}-{process.pid}-abcd1234", 2)
+
+        self.assertEqual(self.conflicts(), 2)
+        self.assertFalse(os.path.exists(exited))
+
+    def test_flush_starts_heartbeat(self):
+        with mock.patch.dict(metrics._process, heartbeat=None), \
+             mock.patch.object(metrics.threading, "Thread") as thread:
+            metrics.flush(force=True)
+
+        thread.assert_called_once_with(target=metrics._heartbeat, daemon=True,
+                                       name="metrics-heartbeat")
+        thread.return_value.start.assert_called_once()
+
+class MicrographViewTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrographs = [self.create_micrograph(f"m{i}") for i in range(2)]
+
+    def test_labelled_skipped(self):
+        Label.objects.create(micrograph=self.micrographs[0], ip_address="127.0.0.1")
+
+        response = self.client.get("/label/micrograph").json()
+
+        self.assertEqual(response["index"], self.micrographs[1].id)
+        self.assertEqual(response["ip"], "127.0.0.1")
+
+    def test_finished(self):
+        for micrograph in self.micrographs:
+            Label.objects.create(micrograph=micrograph, ip_address="127.0.0.1")
+
+        response = self.client.get("/label/micrograph").json()
+
+        self.assertEqual(response["index"], -1)
+        self.assertEqual(response["micrograph"], "static/complete.png")
+
+class RegistrationTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(registration.MICROGRAPH_DIR)
+
+    def write_image(self, name, value):
+        """
+        Write a micrograph image filled with a value.
+        """
+        Image.fromarray(np.full((20, 30), value, dtype=np.uint8)).save(
+                f"{registration.MICROGRAPH_DIR}/{name}.png")
+
+    def test_register(self):
+        self.write_image("m0", 0)
+        self.write_image("m1", 1)
+
+        self.assertEqual(registration.register_micrographs(), 2)
+        self.assertEqual(sorted(Micrograph.objects.values_list("path", flat=True)),
+                         ["static/micrographs/m0.png", "static/micrographs/m1.png"])
+
+    def test_unchanged(self):
+        self.write_image("m0", 0)
+        registration.register_micrographs()
+
+        with mock.patch.object(registration, "micrograph_key") as key:
+            self.assertEqual(registration.register_micrographs(), 0)
+            self.assertEqual(registration.register_micrographs(force=True), 0)
+        key.assert_not_called()
+
+    def test_incremental(self):
+        self.write_image("m0", 0)
+        registration.register_micrographs()
+        first = Micrograph.objects.get()
+        self.write_image("m1", 1)
+
+        self.assertEqual(registration.register_micrographs(), 1)
+        self.assertEqual(Micrograph.objects.get(path="static/micrographs/m0.png").id, first.id)
+
+    def test_duplicate_skipped(self):
+        self.write_image("m0", 0)
+        self.write_image("m1", 0)
+
+        with self.assertLogs(registration.logger, "WARNING"):
+            self.assertEqual(registration.register_micrographs(), 1)
+
+    def test_fills_missing_keys(self):
+        self.write_image("m0", 0)
+        Micrograph.objects.create(path="static/micrographs/m0.png")
+
+        self.assertEqual(registration.register_micrographs(), 0)
+        self.assertEqual(Micrograph.objects.get().key,
+                         registration.micrograph_key(f"{registration.MICROGRAPH_DIR}/m0.png"))
+
+class ReservationTests(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrographs = [Micrograph.objects.create(path=f"static/micrographs/m{i}.png")
+                            for i in range(4)]
+
+    def test_distinct_batch(self):
+        micrographs = views._assign_micrographs("10.0.0.1", 3)
+
+        self.assertEqual(len({micrograph.id for micrograph in micrographs}), 3)
+        self.assertEqual(Reservation.objects.filter(ip_address="10.0.0.1").count(), 3)
+
+    def test_reserved_not_served_again(self):
+        first = views._assign_micrographs("10.0.0.1", 3)
+        second = views._assign_micrographs("10.0.0.1", 3)
+
+        self.assertEqual(len(second), 1)
+        self.assertNotIn(second[0].id, [micrograph.id for micrograph in first])
+
+    def test_labelled_not_served(self):
+        Label.objects.create(micrograph=self.micrographs[0], ip_address="10.0.0.1")
+
+        micrographs = views._assign_micrographs("10.0.0.1", 4)
+
+        self.assertNotIn(self.micrographs[0].id, [micrograph.id for micrograph in micrographs])
+
+    def test_all_expired_reservations_removed(self):
+        lapsed = timezone.now() - timedelta(seconds=1)
+        Reservation.objects.create(micrograph=self.micrographs[0], ip_address="10.0.0.1",
+                                   expires=lapsed)
+        Reservation.objects.create(micrograph=self.micrographs[1], ip_address="10.0.0.2",
+                                   expires=lapsed)
+
+        micrographs = views._assign_micrographs("10.0.0.3", 1)
+
+        # The reservations of other clients are removed too.
+        self.assertEqual(list(Reservation.objects.values_list("ip_address", flat=True)),
+                         ["10.0.0.3"])
+        self.assertEqual(len(micrographs), 1)
+
+    def test_expired_reservation_served_again(self):
+        Reservation.objects.create(micrograph=self.micrographs[0], ip_address="10.0.0.1",
+                                   expires=timezone.now() - timedelta(seconds=1))
+
+        micrographs = views._assign_micrographs("10.0.0.1", 4)
+
+        self.assertEqual(len(micrographs), 4)
+
+    def test_unique_reservation(self):
+        expires = timezone.now() + timedelta(seconds=60)
+        Reservation.objects.create(micrograph=self.micrographs[0], ip_address="10.0.0.1",
+                                   expires=expires)
+
+        with self.assertRaises(IntegrityError):
+            Reservation.objects.create(micrograph=self.micrographs[0], ip_address="10.0.0.1",
+                                       expires=expires)
+
+class StagingTests(WorkingDirectoryMixin, SimpleTestCase):
+
+    def test_round_trip(self):
+        reference = staging.stage_upload(b"mask", "rle", "<svg/>")
+
+        self.assertTrue(reference.endswith(".rle"))
+        self.assertEqual(staging.load_staged_upload(reference), (b"mask", "<svg/>"))
+
+        staging.remove_staged_upload(reference)
+        self.assertEqual(staging.load_staged_upload(reference), (None, None))
+        self.assertEqual(os.listdir(staging.STAGING_DIR), [])
+
+    def test_without_svg(self):
+        reference = staging.stage_upload(b"mask", "png")
+
+        self.assertEqual(staging.load_staged_upload(reference), (b"mask", None))
+
+    def test_reference_confined_to_staging(self):
+        with open("secret.png", "wb") as f:
+            f.write(b"secret")
+
+        self.assertEqual(staging.load_staged_upload("../../secret.png"), (None, None))
+
+    def test_remove_expired(self):
+        old = staging.stage_upload(b"old", "png", "<svg/>")
+        new = staging.stage_upload(b"new", "png")
+        for path in staging._paths(old):
+            os.utime(path, (0, 0))
+
+        self.assertEqual(staging.remove_expired_uploads(60), 2)
+        self.assertEqual(staging.load_staged_upload(old), (None, None))
+        self.assertEqual(staging.load_staged_upload(new), (b"new", None))
+
+class UploadIndexTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+        self.data = masks.encode_rle(_random_mask((60, 80), 0.3))
+
+        patch = mock.patch.object(views.process_micrograph_mask, "delay")
+        self.delay = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_stages_reference(self):
+        response = self.client.post(f"/label/upload/binary?index={self.micrograph.id}",
+                                    self.data, content_type="application/octet-stream")
+
+        # Only a reference to the staged upload is passed to the task.
+        self.assertEqual(response.status_code, 200)
+        ip, index, reference = self.delay.call_args.args
+        self.assertEqual(index, self.micrograph.id)
+        self.assertEqual(staging.load_staged_upload(reference), (self.data, None))
+
+    def test_labelling_complete(self):
+        responses = [
+            self.client.post("/label/upload/binary?index=-1", self.data,
+                             content_type="application/octet-stream"),
+            self.client.post("/label/upload", {"index" : -1,
+                                               "dataUrl" : "data:image/png;base64,AA=="}),
+            self.client.post("/label/upload/strokes",
+                             json.dumps(dict(json.loads(_strokes(80, 60)), index=-1)),
+                             content_type="application/json"),
+        ]
+
+        # Nothing is staged or queued.
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+        self.assertFalse(os.path.exists(staging.STAGING_DIR))
+        self.delay.assert_not_called()
+
+    def test_task_discards_bad_upload(self):
+        reference = staging.stage_upload(b"not a mask", "rle")
+
+        tasks.process_micrograph_mask("10.0.0.1", self.micrograph.id, reference)
+
+        # An upload that can't be decoded is discarded, not retried.
+        self.assertEqual(os.listdir(staging.STAGING_DIR), [])
+        self.assertFalse(os.path.exists(ingest.INGEST_DIR))
+
+    def test_invalid_index(self):
+        responses = [
+            self.client.post("/label/upload/binary?index=abc", self.data,
+                             content_type="application/octet-stream"),
+            self.client.post("/label/upload", {"dataUrl" : "data:image/png;base64,AA=="}),
+        ]
+
+        for response in responses:
+            self.assertEqual(response.status_code, 400)
+        self.delay.assert_not_called()
+
+class RenderTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+        with accumulator.lock("m0"):
+            for seed in range(2):
+                accumulator.add_to_accumulator("m0", _random_mask((60, 80), 0.3, seed))
+        Micrograph.objects.filter(pk=self.micrograph.pk).update(num_labels=2)
+        self.micrograph.refresh_from_db()
+
+    def test_average_map(self):
+        average = renders.average_map(np.array([0, 1, 2]), 2)
+
+        np.testing.assert_array_equal(average, [255, 127, 0])
+
+    def test_cached(self):
+        path = renders.get_render(self.micrograph, "average")
+
+        with mock.patch.object(renders, "load_counts") as load:
+            self.assertEqual(renders.get_render(self.micrograph, "average"), path)
+        load.assert_not_called()
+
+    def test_immutable(self):
+        url = "/" + renders.render_url(self.micrograph, "average")
+
+        response = self.client.get(url)
+        response.close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], f'"{self.micrograph.id}-average-2"')
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code,
+                         304)
+
+    def test_out_of_date(self):
+        response = self.client.get(f"/label/renders/average/{self.micrograph.id}/1.png")
+
+        self.assertRedirects(response, "/" + renders.render_url(self.micrograph, "average"),
+                             fetch_redirect_response=False)
+
+    def test_evict(self):
+        paths = [renders.get_render(self.micrograph, kind) for kind in renders.KINDS]
+        os.utime(paths[0], (0, 0))
+
+        self.assertEqual(renders.evict(1), 1)
+        self.assertEqual([os.path.exists(path) for path in paths], [False, True])
+
+    def test_sweep(self):
+        path = renders.get_render(self.micrograph, "average")
+
+        self.assertEqual(renders.sweep({self.micrograph.id : 2}, 60), 0)
+        self.assertEqual(renders.sweep({self.micrograph.id : 3}, 60), 1)
+        self.assertFalse(os.path.exists(path))
+
+class ConsensusTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+        self.labels = [_random_mask((60, 80), 0.3, seed) for seed in range(3)]
+
+    def add_labels(self, labels):
+        """
+        Accumulate some labels and record them against the micrograph.
+        """
+        with accumulator.lock("m0"):
+            for label in labels:
+                accumulator.add_to_accumulator("m0", label)
+            Micrograph.objects.filter(pk=self.micrograph.pk).update(
+                    num_labels=self.micrograph.num_labels + len(labels))
+        self.micrograph.refresh_from_db()
+
+    def test_thresholds(self):
+        counts = np.array([[0, 1, 2, 3]])
+
+        result = consensus.consensus_masks(counts, 3, [0.0, 0.5, 1.0])
+
+        np.testing.assert_array_equal(result[:, 0], [[False, True, True, True],
+                                                     [False, False, True, True],
+                                                     [False, False, False, True]])
+
+    def test_no_labels(self):
+        self.assertIsNone(consensus.get_consensus(self.micrograph, [0.5]))
+
+    def test_stale_micrograph(self):
+        self.add_labels(self.labels[:1])
+        stale = Micrograph.objects.get(pk=self.micrograph.pk)
+        self.add_labels(self.labels[1:])
+
+        paths = consensus.get_consensus(stale, [0.5])
+
+        self.assertEqual(paths, {0.5: consensus.consensus_path("m0", 3, 0.5)})
+        expected = np.sum(self.labels, axis=0) >= 2
+        np.testing.assert_array_equal(masks.load_mask(paths[0.5]), expected)
+
+    def test_cache_hit(self):
+        self.add_labels(self.labels)
+        paths = consensus.get_consensus(self.micrograph, [0.5])
+
+        with mock.patch.object(accumulator, "load_accumulator") as load:
+            self.assertEqual(consensus.get_consensus(self.micrograph, [0.5]), paths)
+        load.assert_not_called()
+
+    def test_keeps_newer_masks(self):
+        self.add_labels(self.labels[:1])
+        older = consensus.get_consensus(self.micrograph, [0.5])
+        self.add_labels(self.labels[1:2])
+        newer = consensus.consensus_path("m0", 3, 0.5)
+        os.makedirs(os.path.dirname(newer))
+
+        consensus.get_consensus(self.micrograph, [0.5])
+
+        self.assertFalse(os.path.exists(os.path.dirname(older[0.5])))
+        self.assertTrue(os.path.exists(os.path.dirname(newer)))
+
+    def test_stale_render(self):
+        self.add_labels(self.labels[:1])
+        stale = Micrograph.objects.get(pk=self.micrograph.pk)
+        self.add_labels(self.labels[1:])
+        newer = renders.render_path(stale.id, "average", 4)
+        os.makedirs(os.path.dirname(newer))
+        open(newer, "wb").close()
+
+        path = renders.get_render(stale, "average")
+
+        self.assertEqual(path, renders.render_path(stale.id, "average", 3))
+        self.assertTrue(os.path.exists(newer))
+
+class PreProcessingTests(WorkingDirectoryMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = np.random.default_rng(0).random((64, 64), dtype=np.float32)
+        _write_mrc("m0.mrc", self.data)
+
+    def process(self, previous=None):
+        """
+        Pre-process the micrograph without tiles or variants.
+        """
+        return pre_process_micrographs.process_micrograph("m0.mrc", "m0.png", 32,
+                                                          previous=previous, formats=[])
+
+    def test_process(self):
+        entry, processed = self.process()
+
+        self.assertTrue(processed)
+        self.assertEqual(entry["hash"], pre_process_micrographs.file_hash("m0.mrc"))
+        self.assertEqual(Image.open("m0.png").size, (32, 32))
+
+    def test_skips_unchanged(self):
+        entry, _ = self.process()
+
+        # Touching the file doesn't change its contents.
+        os.utime("m0.mrc", (0, 0))
+
+        self.assertFalse(self.process(entry)[1])
+
+    def test_processes_modified(self):
+        entry, _ = self.process()
+        _write_mrc("m0.mrc", self.data[::-1])
+
+        self.assertTrue(self.process(entry)[1])
+
+    def test_processes_missing_output(self):
+        entry, _ = self.process()
+        os.remove("m0.png")
+
+        self.assertTrue(self.process(entry)[1])
+
+    def test_manifest(self):
+        manifest = {"m0.mrc" : self.process()[0]}
+
+        pre_process_micrographs.save_manifest(".", manifest)
+
+        self.assertEqual(pre_process_micrographs.load_manifest("."), manifest)
+        self.assertEqual(pre_process_micrographs.load_manifest("missing"), {})
+
+class TileTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = np.random.default_rng(0).integers(0, 256, (300, 500), dtype=np.uint8)
+
+    def test_levels(self):
+        descriptor = tiles.build_pyramid("m0", self.image, tile_size=128, eager_size=0)
+
+        self.assertEqual(descriptor["max_level"], 9)
+        self.assertEqual(tiles.level_shape(descriptor, 9), (300, 500))
+        self.assertEqual(tiles.level_shape(descriptor, 8), (150, 250))
+        self.assertEqual(tiles.level_shape(descriptor, 0), (1, 1))
+        self.assertEqual(tiles.full_resolution_shape("m0"), (300, 500))
+
+    def test_eager_tiles(self):
+        tiles.build_pyramid("m0", self.image, tile_size=128, eager_size=250)
+
+        self.assertTrue(os.path.exists(tiles.tile_path("m0", 8, 1, 1)))
+        self.assertFalse(os.path.exists(tiles.tile_path("m0", 9, 0, 0)))
+
+    def test_lazy_tile(self):
+        tiles.build_pyramid("m0", self.image, tile_size=128, eager_size=0)
+
+        path = tiles.get_tile("m0", 9, 3, 2)
+
+        np.testing.assert_array_equal(np.asarray(Image.open(path)), self.image[256:, 384:])
+
+    def test_out_of_range(self):
+        tiles.build_pyramid("m0", self.image, tile_size=128, eager_size=0)
+
+        self.assertIsNone(tiles.get_tile("m0", 9, 4, 0))
+        self.assertIsNone(tiles.get_tile("m0", 10, 0, 0))
+        self.assertIsNone(tiles.get_tile("m1", 0, 0, 0))
+
+    def test_view(self):
+        micrograph = self.create_micrograph()
+        tiles.build_pyramid("m0", self.image, tile_size=128)
+
+        response = self.client.get(f"/label/tiles/{micrograph.id}/8/1_1.png")
+        response.close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f"/label/tiles/{micrograph.id}/8/9_9.png").status_code,
+                         404)
+
+class EqualisationTests(WorkingDirectoryMixin, SimpleTestCase):
+
+    def test_matches_equalize_hist(self):
+        data = np.random.default_rng(0).normal(size=(100, 120)).astype(np.float32)
+
+        result = pre_process_micrographs.equalise_streaming(data, chunk_size=1000)
+
+        expected = skimage.img_as_ubyte(exposure.equalize_hist(data))
+        self.assertLessEqual(np.abs(result.astype(int) - expected).max(), 1)
+
+    def test_average_frames(self):
+        stack = np.random.default_rng(0).random((3, 50, 40), dtype=np.float32)
+        average = np.empty((50, 40), dtype=np.float32)
+
+        pre_process_micrographs.average_frames(stack, average, chunk_size=300)
+
+        np.testing.assert_allclose(average, stack.mean(axis=0), rtol=1e-6)
+
+    def test_chunks(self):
+        chunks = list(pre_process_micrographs._chunks((3, 50, 40), 1000))
+
+        self.assertEqual(chunks[0], slice(0, 8))
+        self.assertEqual(chunks[-1], slice(48, 50))
+
+    def test_streaming_matches(self):
+        data = np.random.default_rng(0).normal(size=(64, 64)).astype(np.float32)
+        _write_mrc("m0.mrc", data)
+
+        for streaming, output in [(False, "full.png"), (True, "streamed.png")]:
+            pre_process_micrographs.process_micrograph("m0.mrc", output, 64,
+                                                       streaming=streaming, formats=[])
+
+        difference = np.asarray(Image.open("full.png"), dtype=int) \
+                   - np.asarray(Image.open("streamed.png"), dtype=int)
+        self.assertLessEqual(np.abs(difference).max(), 1)
+
+    def test_stack(self):
+        _write_mrc("m0.mrc", np.random.default_rng(0).random((3, 64, 64), dtype=np.float32))
+
+        pre_process_micrographs.process_micrograph("m0.mrc", "m0.png", 32, formats=[])
+
+        self.assertEqual(Image.open("m0.png").size, (32, 32))
+
+class ExportTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.labels = [_random_mask((60, 80), 0.3, seed) for seed in range(3)]
+        os.makedirs("label/masks/m0")
+        for i, label in enumerate(self.labels, 1):
+            masks.save_mask(label, f"label/masks/m0/{i:06d}")
+        self.micrographs = [(self.create_micrograph(name).id, name,
+                             f"static/micrographs/{name}.png") for name in ["m0", "m1"]]
+
+    def test_export(self):
+        index = export.export_dataset(self.micrographs, "dataset", num_workers=1)
+
+        # The micrograph with no masks is skipped.
+        self.assertEqual([sample["name"] for sample in index["samples"]], ["m0"])
+
+        sample = export.Dataset("dataset")["m0"]
+        self.assertEqual(sample["num_labels"], 3)
+        np.testing.assert_array_equal(sample["masks"], self.labels)
+        np.testing.assert_array_equal(sample["counts"], np.sum(self.labels, axis=0))
+        np.testing.assert_allclose(sample["average"], np.mean(self.labels, axis=0))
+        self.assertEqual(sample["micrograph"].shape, (60, 80))
+
+    def test_shards(self):
+        os.makedirs("label/masks/m1")
+        masks.save_mask(self.labels[0], "label/masks/m1/000001")
+
+        index = export.export_dataset(self.micrographs, "dataset", shard_size=1, num_workers=1)
+
+        self.assertEqual(index["shards"], ["shard-000000.npz", "shard-000001.npz"])
+        dataset = export.Dataset("dataset")
+        self.assertEqual(len(dataset), 2)
+        self.assertEqual(dataset[1]["shard"], "shard-000001.npz")
+
+    def test_full_resolution(self):
+        image = np.random.default_rng(0).integers(0, 256, (60, 80), dtype=np.uint8)
+        tiles.build_pyramid("m0", image)
+
+        export.export_dataset(self.micrographs[:1], "dataset", num_workers=1)
+
+        np.testing.assert_array_equal(export.Dataset("dataset")[0]["micrograph"], image)
+
+class VariantTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+        self.image = np.random.default_rng(0).integers(0, 256, (60, 80), dtype=np.uint8)
+
+    def test_build(self):
+        built = variants.build_variants("m0", self.image, ["webp", "jpeg"])
+
+        self.assertEqual(variants.load_variants("m0"), built)
+        for extension, filename in built.items():
+            self.assertTrue(filename.endswith(f".{extension}"))
+            with Image.open(f"{variants.variant_dir('m0')}/{filename}") as image:
+                self.assertEqual(image.size, (80, 60))
+
+    def test_best_variant(self):
+        built = variants.build_variants("m0", self.image, ["webp", "jpeg"])
+
+        self.assertEqual(variants.best_variant("m0", {"jpeg", "webp"}), built["webp"])
+        self.assertEqual(variants.best_variant("m0", {"jpeg"}), built["jpeg"])
+        self.assertIsNone(variants.best_variant("m0", {"gif"}))
+        self.assertIsNone(variants.best_variant("m1", {"webp"}))
+
+    def test_negotiation(self):
+        built = variants.build_variants("m0", self.image, ["webp"])
+
+        response = self.client.get("/label/micrograph", HTTP_ACCEPT="image/webp,*/*").json()
+        self.assertEqual(response["micrograph"],
+                         variants.variant_url(self.micrograph, built["webp"]))
+
+        response = self.client.get("/label/micrograph?formats=jpeg",
+                                   REMOTE_ADDR="10.0.0.1").json()
+        self.assertEqual(response["micrograph"], self.micrograph.path)
+
+    def test_immutable(self):
+        built = variants.build_variants("m0", self.image, ["webp"])
+        url = "/" + variants.variant_url(self.micrograph, built["webp"])
+
+        response = self.client.get(url)
+        response.close()
+
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code,
+                         304)
+        self.assertEqual(self.client.get(url.replace(".webp", ".gif")).status_code, 404)
+
+class UploadShapeTests(WorkingDirectoryMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.micrograph = self.create_micrograph()
+
+    def test_accepted_shapes(self):
+        self.assertEqual(masks.label_shape(self.micrograph), (60, 80))
+        self.assertIn((60, 80), masks.upload_shapes(self.micrograph))
+
+    def test_rejects_mismatched_rle(self):
+        data = masks.encode_rle(_random_mask((10, 10), 0.5))
+
+        response = self.client.post(f"/label/upload/binary?index={self.micrograph.id}", data,
+                                    content_type="application/octet-stream")
+
+        # Nothing is staged, so the accumulator can't be poisoned.
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists("label/staging"))
+        self.assertFalse(os.path.exists(accumulator.accumulator_path(self.micrograph.name)))
+
+    def test_rejects_unknown_micrograph(self):
+        data = masks.encode_rle(_random_mask((60, 80), 0.5))
+
+        response = self.client.post(f"/label/upload/binary?index={self.micrograph.id + 1}", data,
+                                    content_type="application/octet-stream")
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_mismatched_strokes(self):
+        strokes = dict(json.loads(_strokes(10, 10)), index=self.micrograph.id)
+
+        response = self.client.post("/label/upload/strokes", json.dumps(strokes),
+                                    content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists("label/staging"))
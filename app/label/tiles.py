@@ -0,0 +1,313 @@
+"""
+Multi-resolution tile pyramids for micrographs.
+
+Each micrograph has a deep-zoom style pyramid. Level ``max_level`` is the
+micrograph at full resolution, and each level below it halves the width and
+height, down to a single pixel at level 0. Every level is stored as a NumPy
+``.npy`` file so that tiles can be cut from it via a memory map, reading only
+the rows that are needed. The coarse levels are tiled eagerly when the
+pyramid is built, and the remaining tiles are rendered lazily when first
+requested, then cached. The pyramid for a micrograph is laid out as:
+
+    label/tiles/<name>/descriptor.json
+    label/tiles/<name>/levels/<level>.npy
+    label/tiles/<name>/<level>/<col>_<row>.png
+"""
+
+from PIL import Image
+
+import json
+import math
+import numpy as np
+import os
+import shutil
+import uuid
+
+from . import metrics
+
+# The directory in which the tile pyramids are stored.
+TILE_DIR = "label/tiles"
+
+# The default width and height of a tile.
+TILE_SIZE = 256
+
+# Levels no larger than this in either dimension are tiled eagerly.
+EAGER_SIZE = 1024
+
+def pyramid_dir(name):
+    """
+    Return the directory containing the tile pyramid for a micrograph.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the pyramid directory.
+    """
+    return f"{TILE_DIR}/{name}"
+
+def tile_path(name, level, col, row):
+    """
+    Return the path to a tile.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    level : int
+        The level of the pyramid.
+
+    col : int
+        The column of the tile within the level.
+
+    row : int
+        The row of the tile within the level.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the tile image.
+    """
+    return f"{pyramid_dir(name)}/{level}/{col}_{row}.png"
+
+def level_shape(descriptor, level):
+    """
+    Return the shape of a level of a pyramid.
+
+
+    Parameters
+    ----------
+
+    descriptor : dict
+        The pyramid descriptor, as returned by load_descriptor.
+
+    level : int
+        The level of the pyramid.
+
+
+    Returns
+    -------
+
+    shape : (int, int)
+        The (height, width) of the level.
+    """
+    factor = 2**(descriptor["max_level"] - level)
+
+    return (math.ceil(descriptor["height"] / factor),
+            math.ceil(descriptor["width"] / factor))
+
+def build_pyramid(name, image, tile_size=TILE_SIZE, eager_size=EAGER_SIZE):
+    """
+    Build the tile pyramid for a micrograph, replacing any existing pyramid.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    image : numpy.ndarray
+        The micrograph at full resolution, as an 8-bit grayscale image.
+
+    tile_size : int
+        The width and height of a tile.
+
+    eager_size : int
+        Levels no larger than this in either dimension are tiled now, rather
+        than when their tiles are first requested.
+
+
+    Returns
+    -------
+
+    descriptor : dict
+        The pyramid descriptor.
+    """
+    height, width = image.shape
+    descriptor = {
+                   "width" : width,
+                   "height" : height,
+                   "tile_size" : tile_size,
+                   "max_level" : max(0, math.ceil(math.log2(max(width, height)))),
+                   "format" : "png",
+                 }
+
+    # Build the new pyramid alongside the old one, then swap it into place so
+    # that tiles are never served from a partially built pyramid.
+    directory = pyramid_dir(name)
+    tmp = directory + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(f"{tmp}/levels")
+
+    level = np.ascontiguousarray(image, dtype=np.uint8)
+    for index in range(descriptor["max_level"], -1, -1):
+        np.save(f"{tmp}/levels/{index}.npy", level)
+
+        if max(level.shape) <= eager_size:
+            _write_tiles(tmp, index, level, tile_size)
+
+        level = _downsample(level)
+
+    with open(f"{tmp}/descriptor.json", "w") as f:
+        json.dump(descriptor, f)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+
+    return descriptor
+
+def load_descriptor(name):
+    """
+    Load the descriptor of the tile pyramid for a micrograph.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+
+    Returns
+    -------
+
+    descriptor : dict, None
+        The pyramid descriptor, or None if the micrograph has no pyramid.
+    """
+    try:
+        with open(f"{pyramid_dir(name)}/descriptor.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def full_resolution_shape(name):
+    """
+    Return the full resolution shape of a micrograph, from its pyramid.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+
+    Returns
+    -------
+
+    shape : (int, int), None
+        The (height, width) of the micrograph, or None if the micrograph has
+        no pyramid.
+    """
+    descriptor = load_descriptor(name)
+
+    if descriptor is None:
+        return None
+
+    return (descriptor["height"], descriptor["width"])
+
+def get_tile(name, level, col, row):
+    """
+    Return the path to a tile, rendering it from its level of the pyramid if
+    it hasn't already been rendered.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the micrograph with no path or extension.
+
+    level : int
+        The level of the pyramid.
+
+    col : int
+        The column of the tile within the level.
+
+    row : int
+        The row of the tile within the level.
+
+
+    Returns
+    -------
+
+    path : str, None
+        The path to the tile image, or None if the micrograph has no pyramid
+        or the tile is out of range.
+    """
+    path = tile_path(name, level, col, row)
+
+    if os.path.exists(path):
+        metrics.cache_requests.labels("tile", "hit").inc()
+        return path
+
+    metrics.cache_requests.labels("tile", "miss").inc()
+
+    descriptor = load_descriptor(name)
+
+    if descriptor is None or not 0 <= level <= descriptor["max_level"]:
+        return None
+
+    height, width = level_shape(descriptor, level)
+    tile_size = descriptor["tile_size"]
+
+    if not (0 <= col and col * tile_size < width and 0 <= row and row * tile_size < height):
+        return None
+
+    # Only the rows of the level covered by the tile are read.
+    data = np.load(f"{pyramid_dir(name)}/levels/{level}.npy", mmap_mode="r")
+    tile = data[row*tile_size:(row+1)*tile_size, col*tile_size:(col+1)*tile_size]
+
+    _write_tile(tile, path)
+
+    return path
+
+def _downsample(level):
+    """
+    Helper function to halve the size of a level by averaging 2x2 blocks of
+    pixels, replicating the last row and column of odd sized levels.
+    """
+    height, width = level.shape
+    if height % 2:
+        level = np.concatenate((level, level[-1:]), axis=0)
+    if width % 2:
+        level = np.concatenate((level, level[:, -1:]), axis=1)
+
+    blocks = level.reshape(level.shape[0] // 2, 2, level.shape[1] // 2, 2)
+
+    return ((blocks.sum(axis=(1, 3), dtype=np.uint16) + 2) // 4).astype(np.uint8)
+
+def _write_tiles(directory, index, level, tile_size):
+    """
+    Helper function to write all of the tiles for a level of a pyramid.
+    """
+    height, width = level.shape
+    for row in range(math.ceil(height / tile_size)):
+        for col in range(math.ceil(width / tile_size)):
+            tile = level[row*tile_size:(row+1)*tile_size, col*tile_size:(col+1)*tile_size]
+            _write_tile(tile, f"{directory}/{index}/{col}_{row}.png")
+
+def _write_tile(tile, path):
+    """
+    Helper function to write a tile so that it is never seen partially
+    written. Concurrent misses for the same tile write separate temporary
+    files.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    Image.fromarray(np.ascontiguousarray(tile)).save(tmp, format="PNG")
+    os.replace(tmp, path)
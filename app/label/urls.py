@@ -5,6 +5,14 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('micrograph', views.micrograph, name='micrograph'),
+    path('micrographs', views.micrographs, name='micrographs'),
     path('average', views.average, name='average'),
+    path('variance', views.variance, name='variance'),
+    path('renders/<str:kind>/<int:index>/<int:num_labels>.png', views.render_image, name='render_image'),
+    path('tiles/<int:index>/<int:level>/<int:col>_<int:row>.png', views.tile, name='tile'),
+    path('variants/<int:index>/<slug:digest>.<slug:extension>', views.variant, name='variant'),
     path('upload', views.upload, name='upload'),
+    path('upload/binary', views.upload_binary, name='upload_binary'),
+    path('upload/strokes', views.upload_strokes, name='upload_strokes'),
+    path('events', views.events, name='events'),
 ]
@@ -1,29 +1,44 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import render
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed, \
+                        HttpResponseNotModified, HttpResponseRedirect, JsonResponse, \
+                        StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 
-from io import BytesIO
-from PIL import Image, ImageOps
-from random import randint
+from datetime import timedelta
 
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
 import base64
-import imageio
 import logging
-import numpy as np
 import os
-import pickle
-import uuid
 
-from .models import Micrograph
+from . import masks, rasterise, renders, scheduling, staging, tiles, variants
+from .events import stream as stream_events, stream_sync as stream_events_sync
+from .metrics import micrograph_formats, render as render_metrics
+from .models import Micrograph, Reservation
 from .tasks import create_average_mask, process_micrograph_mask
 
 logger = logging.getLogger(__name__)
 
 # Determine whether proof is being run locally.
-if os.environ.get("PROOF_LOCAL") != None:
-    proof_local = True
-else:
-    proof_local = False
+proof_local = settings.PROOF_LOCAL
+
+# The number of seconds between checks for the result of a task.
+RESULT_POLL_INTERVAL = 0.05
+
+# Background threads used to process uploads when running locally, so that
+# ingestion doesn't hold up the response. Uploads for the same micrograph
+# that are processed together are ingested as a batch.
+_processor = ThreadPoolExecutor(max_workers=4)
+
+# The uploads that are waiting to be processed by the background threads.
+_processing = set()
 
 def index(request):
     """
@@ -31,7 +46,7 @@ def index(request):
     """
     return render(request, "index.html", {})
 
-def micrograph(request):
+async def micrograph(request):
     """
     Serve a random micrograph image to the client, making sure that the
     image hasn't previously been sent to the same IP addresss.
@@ -42,39 +57,25 @@ def micrograph(request):
     # Get the IP address of the client.
     ip = _get_ip_addresss(request)
 
-    # Get the micrographs in the database.
-    micrographs = Micrograph.objects.all()
-
-    # Store the number of micrographs.
-    num_micrographs = len(micrographs)
-
-    # Choose a random micrograph.
-    index = randint(0, num_micrographs-1)
-    micrograph = micrographs[randint(0, index)]
-
-    # Whether labelling is finished for this IP address.
-    is_finished = True
-
-    # Make sure that the micrograph hasn't already been labelled by this IP.
-    # Only try this a maximum of 100*num_micrographs times. We could store
-    # IP addresses as a separate model and log the micrographs that have been
-    # labelled by each IP, but this will suffice.
-    num_attempts = 1
-    for x in range(0, 100*num_micrographs):
-        index = randint(0, num_micrographs-1)
-        micrograph = micrographs[index]
-        if not ip in micrograph.ip_addresses:
-            is_finished = False
-            break
-
-    # Insert the micrograph, index, and IP address into the response.
-    if not is_finished:
-        response["micrograph"] = micrograph.path
+    # Reserve a single micrograph for the client. The database work is run in
+    # a thread of its own, rather than the one thread shared by synchronous
+    # code, so that concurrent requests aren't serialised.
+    micrographs = await sync_to_async(_assign_micrographs, thread_sensitive=False)(ip, 1)
+
+    # Insert the micrograph, index, and IP address into the response. The
+    # micrograph is served in the best format that the client supports.
+    if len(micrographs) > 0:
+        index = micrographs[0].id
+
+        response["micrograph"] = await sync_to_async(_micrograph_url, thread_sensitive=False)(
+                micrographs[0], _get_image_formats(request))
         response["index"] = index
         response["ip"] = ip
     else:
+        index = -1
+
         response["micrograph"] = "static/complete.png"
-        response["index"] = -1
+        response["index"] = index
         response["ip"] = ip
 
     # Log the micrograph and IP address.
@@ -82,7 +83,52 @@ def micrograph(request):
 
     return JsonResponse(response)
 
-def upload(request):
+async def micrographs(request):
+    """
+    Serve a batch of distinct micrographs to the client so that they can be
+    preloaded. The micrographs are reserved for the client until the lease
+    expires, so they won't be served to the same IP address again while
+    they are queued.
+    """
+    # Initialise response dictionary.
+    response = {}
+
+    # Get the IP address of the client.
+    ip = _get_ip_addresss(request)
+
+    # Get the number of micrographs requested, capped at the maximum batch size.
+    try:
+        count = int(request.GET.get("count", 1))
+    except ValueError:
+        return JsonResponse({"error" : "Invalid micrograph count."}, status=400)
+    count = max(0, min(count, settings.PROOF_MAX_BATCH))
+
+    # Reserve the micrographs for the client.
+    micrographs = await sync_to_async(_assign_micrographs, thread_sensitive=False)(ip, count)
+
+    # Insert the micrographs, IP address, and lease timeout into the response.
+    # An empty list of micrographs means that labelling is finished.
+    # The descriptor of each micrograph's tile pyramid is included, if it has
+    # one, so that the client can fetch tiles without another round trip.
+    # Each micrograph is served in the best format that the client supports.
+    formats = _get_image_formats(request)
+    descriptors = await sync_to_async(
+            lambda: [(_micrograph_url(micrograph, formats), tiles.load_descriptor(micrograph.name))
+                     for micrograph in micrographs], thread_sensitive=False)()
+    response["micrographs"] = [{"micrograph" : url,
+                                "index" : micrograph.id,
+                                "tiles" : descriptor}
+                                for micrograph, (url, descriptor) in zip(micrographs, descriptors)]
+    response["ip"] = ip
+    response["lease"] = settings.PROOF_LEASE_TIMEOUT
+
+    # Log the micrographs and IP address.
+    indices = [micrograph.id for micrograph in micrographs]
+    logger.info(f"Serving micrograph indices {indices} to IP {ip}")
+
+    return JsonResponse(response)
+
+async def upload(request):
     """
     Handle the upload of micrograph filament labels.
     """
@@ -91,7 +137,15 @@ def upload(request):
     ip = _get_ip_addresss(request)
 
     # Get the index of the micrograph.
-    index = request.POST.get("index")
+    try:
+        index = int(request.POST["index"])
+    except (KeyError, ValueError):
+        return JsonResponse({"error" : "Invalid micrograph index."}, status=400)
+
+    # Index is set to -1 if labelling is complete, so there is nothing to
+    # stage.
+    if index < 0:
+        return JsonResponse({})
 
     # Log the the micrograph is being processed.
     logger.info(f"Processing micrograph index {index} from IP {ip}")
@@ -102,52 +156,334 @@ def upload(request):
     # Get the serialized SVG image.
     svg_serialized = request.POST.get("svgSerialized")
 
-    # Call the Celery task to process the upload. Don't delay if running
-    # locally since we require that this task is run before we can
-    # return a response.
-    if proof_local:
-        process_micrograph_mask(ip, int(index), data_url, svg_serialized)
+    # Decode the base64 encoded PNG.
+    data = base64.b64decode(data_url.split(",")[1])
+
+    # Reject masks that don't match the micrograph before they are queued.
+    error = await sync_to_async(_check_upload_shape, thread_sensitive=False)(
+            index, data, "png")
+    if error is not None:
+        return JsonResponse({"error" : error}, status=400)
+
+    # Stage the PNG and SVG, and queue them for processing.
+    await sync_to_async(_queue_upload, thread_sensitive=False)(
+            ip, index, data, "png", svg_serialized)
+
+    # Acknowledge the upload. An "upload" event is sent to the client once
+    # it has been processed.
+    return JsonResponse({})
+
+async def upload_binary(request):
+    """
+    Handle the upload of micrograph filament labels as a compact, run-length
+    encoded binary mask. The mask can be sent as the raw request body, with
+    content type application/octet-stream and the micrograph index in the
+    query string, or as the "mask" file of a multipart form along with the
+    index and the serialized SVG image.
+    """
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    # Get the IP address of the client.
+    ip = _get_ip_addresss(request)
+
+    # Get the index of the micrograph, the encoded mask, and the serialized
+    # SVG image, if present.
+    if request.content_type == "multipart/form-data":
+        index = request.POST.get("index")
+        mask = request.FILES.get("mask")
+        data = mask.read() if mask else b""
+        svg_serialized = request.POST.get("svgSerialized")
     else:
-        process_micrograph_mask.delay(ip, int(index), data_url, svg_serialized)
+        index = request.GET.get("index")
+        data = request.body
+        svg_serialized = None
 
-    # Dummy response for now.
-    response = {}
+    if index is None or len(data) == 0:
+        return JsonResponse({"error" : "Missing micrograph index or mask."}, status=400)
 
-    return JsonResponse(response)
+    try:
+        index = int(index)
+    except ValueError:
+        return JsonResponse({"error" : "Invalid micrograph index."}, status=400)
+
+    # Index is set to -1 if labelling is complete, so there is nothing to
+    # stage.
+    if index < 0:
+        return JsonResponse({})
+
+    # Log the the micrograph is being processed.
+    logger.info(f"Processing micrograph index {index} from IP {ip} "
+                f"({len(data)} byte mask)")
+
+    # Reject masks that don't match the micrograph before they are queued.
+    error = await sync_to_async(_check_upload_shape, thread_sensitive=False)(
+            index, data, "rle")
+    if error is not None:
+        return JsonResponse({"error" : error}, status=400)
+
+    # Stage the mask and SVG, and queue them for processing.
+    await sync_to_async(_queue_upload, thread_sensitive=False)(
+            ip, index, data, "rle", svg_serialized)
 
-def average(request):
+    # Acknowledge the upload. An "upload" event is sent to the client once
+    # it has been processed.
+    return JsonResponse({})
+
+async def upload_strokes(request):
     """
-    Serve an image showing the average labels for the current
+    Handle the upload of micrograph filament labels as vector strokes, i.e.
+    the JSON encoded paths and line widths drawn in the labeller, which are
+    rasterised by the server. The JSON also holds the index of the
     micrograph.
     """
 
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    # Get the IP address of the client.
+    ip = _get_ip_addresss(request)
+
+    # Validate the strokes before they are queued for processing.
+    try:
+        strokes = rasterise.parse_strokes(request.body)
+        index = int(strokes["index"])
+    except (KeyError, TypeError, ValueError) as e:
+        return JsonResponse({"error" : f"Invalid strokes: {e}"}, status=400)
+
+    # Index is set to -1 if labelling is complete, so there is nothing to
+    # stage.
+    if index < 0:
+        return JsonResponse({})
+
+    # Log the the micrograph is being processed.
+    logger.info(f"Processing micrograph index {index} from IP {ip} "
+                f"({len(strokes['paths'])} strokes)")
+
+    # Reject strokes drawn on a canvas that doesn't match the micrograph.
+    error = await sync_to_async(_check_upload_shape, thread_sensitive=False)(
+            index, request.body, "json")
+    if error is not None:
+        return JsonResponse({"error" : error}, status=400)
+
+    # Stage the strokes, and queue them for processing.
+    await sync_to_async(_queue_upload, thread_sensitive=False)(ip, index, request.body, "json")
+
+    # Acknowledge the upload. An "upload" event is sent to the client once
+    # it has been processed.
+    return JsonResponse({})
+
+async def average(request):
+    """
+    Serve the URL of an image showing the average labels for the current
+    micrograph. If the image hasn't been rendered, it is rendered by a
+    Celery worker. If the render takes longer than PROOF_INTERACTIVE_TIMEOUT
+    seconds, "PENDING" is returned, and an "average" event with the URL is
+    sent to the client once the image is ready.
+    """
+
+    # Get the IP address of the client.
+    ip = _get_ip_addresss(request)
+
     # Get the index of the current micrograph.
     index = request.GET.get("index")
 
     # Index is set to -1 if labelling is complete.
     if int(index) >= 0:
 
-        # Get the name of the current average image.
-        average = request.GET.get("average")
+        # Get the micrograph in the database.
+        micrograph = await Micrograph.objects.only("path", "num_labels").aget(pk=int(index))
 
-        # Initialise response dictionary.
-        response = {}
+        logger.info(f"Serving average for image {index}")
 
-        logger.info(f"Generating average for image {index}")
+        # The URL is versioned by the number of labels, so the image itself
+        # is only rendered once per label count.
+        url = renders.render_url(micrograph, "average")
 
-        # Call the Celery task to generate the average mask. Don't delay if
-        # running locally since we require that this task is run before we can
-        # return a response.
-        if proof_local:
-            response["average"] = create_average_mask(int(index), average)
-        else:
-            response["average"] = create_average_mask.delay(int(index), average)
+        if url is None:
+            return JsonResponse({"average" : "NULL"})
+
+        # When running locally, the image is rendered when it is first
+        # requested.
+        if proof_local or os.path.exists(renders.render_path(micrograph.id, "average",
+                                                             micrograph.num_labels)):
+            return JsonResponse({"average" : url})
+
+        # Render the image in an interactive worker. Wait briefly for it, so
+        # that a quick render is served straight away. Otherwise, the worker
+        # notifies the client when it is done. The wait polls the result
+        # from the event loop, so no thread is held while waiting.
+        result = await sync_to_async(create_average_mask.delay, thread_sensitive=False)(
+                int(index), ip)
+        url = await _wait_for_result(result, settings.PROOF_INTERACTIVE_TIMEOUT)
+
+        if url is not None:
+            return JsonResponse({"average" : url})
 
-        return JsonResponse(response)
+        return JsonResponse({"average" : "PENDING"})
 
     else:
         return JsonResponse({"average" : "NULL"})
 
+async def variance(request):
+    """
+    Serve the URL of an image showing the per-pixel disagreement between
+    the labels for the current micrograph.
+    """
+
+    # Get the index of the current micrograph.
+    index = request.GET.get("index")
+
+    # Index is set to -1 if labelling is complete.
+    if int(index) >= 0:
+
+        # Get the micrograph in the database.
+        micrograph = await Micrograph.objects.only("path", "num_labels").aget(pk=int(index))
+
+        logger.info(f"Serving label variance for image {index}")
+
+        # The URL is versioned by the number of labels, so the image itself
+        # is only rendered once per label count, when it is first requested.
+        url = renders.render_url(micrograph, "variance")
+
+        return JsonResponse({"variance" : url if url else "NULL"})
+
+    else:
+        return JsonResponse({"variance" : "NULL"})
+
+async def events(request):
+    """
+    Stream events to the client as server-sent events, e.g. when its uploads
+    have been processed, or an average mask that it requested is ready.
+    """
+
+    # Get the IP address of the client.
+    ip = _get_ip_addresss(request)
+
+    # The browser sends the ID of the last event it received when it
+    # reconnects.
+    try:
+        last_event_id = int(request.META["HTTP_LAST_EVENT_ID"])
+    except (KeyError, ValueError):
+        last_event_id = None
+
+    # Stream asynchronously when served by an ASGI server. A WSGI server can
+    # only consume a synchronous stream.
+    if isinstance(request, ASGIRequest):
+        stream = stream_events(ip, last_event_id)
+    else:
+        stream = stream_events_sync(ip, last_event_id)
+
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+
+    return response
+
+def render_image(request, kind, index, num_labels):
+    """
+    Serve an image derived from the labels for a micrograph, e.g. the
+    average labels, as computed from a given number of labels. Since the
+    image for a given number of labels never changes, it is served with
+    long-lived caching headers.
+    """
+
+    if kind not in renders.KINDS:
+        raise Http404(f"Unknown render '{kind}'")
+
+    # Get the micrograph in the database.
+    micrograph = get_object_or_404(Micrograph.objects.only("path", "num_labels"), pk=index)
+
+    # Get the cached image, rendering it if necessary.
+    if num_labels == micrograph.num_labels:
+
+        # The entity tag identifies the image by its cache key.
+        etag = f'"{index}-{kind}-{num_labels}"'
+
+        # The client already has this image.
+        if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        path = renders.get_render(micrograph, kind, settings.PROOF_RENDER_CACHE_SIZE)
+
+        # More labels may have arrived while rendering.
+        if path is not None and micrograph.num_labels == num_labels:
+            response = FileResponse(open(path, "rb"), content_type="image/png")
+            response["ETag"] = etag
+            response["Cache-Control"] = "public, max-age=31536000, immutable"
+            return response
+
+    # The image is out of date, so redirect to the current version.
+    url = renders.render_url(micrograph, kind)
+    if url is None:
+        raise Http404("The micrograph has no labels")
+
+    return HttpResponseRedirect("/" + url)
+
+def tile(request, index, level, col, row):
+    """
+    Serve a tile from the pyramid for a micrograph, rendering it if it
+    hasn't been requested before.
+    """
+
+    # Get the micrograph in the database.
+    micrograph = get_object_or_404(Micrograph.objects.only("path"), pk=index)
+
+    # Get the cached tile, rendering it if necessary.
+    path = tiles.get_tile(micrograph.name, level, col, row)
+
+    if path is None:
+        raise Http404("No such tile")
+
+    response = FileResponse(open(path, "rb"), content_type="image/png")
+    response["Cache-Control"] = "public, max-age=86400"
+
+    return response
+
+def variant(request, index, digest, extension):
+    """
+    Serve a compressed variant of a micrograph image. Variants are named by
+    the hash of their contents, so they are served with long-lived,
+    immutable caching headers.
+    """
+
+    if extension not in variants.FORMATS:
+        raise Http404(f"Unknown image format '{extension}'")
+
+    # Get the micrograph in the database.
+    micrograph = get_object_or_404(Micrograph.objects.only("path"), pk=index)
+
+    path = f"{variants.variant_dir(micrograph.name)}/{digest}.{extension}"
+
+    if not os.path.exists(path):
+        raise Http404("No such variant")
+
+    # The entity tag is the content hash.
+    etag = f'"{digest}"'
+
+    # The client already has this image.
+    if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+
+    response = FileResponse(open(path, "rb"), content_type=variants.FORMATS[extension][0])
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+
+    return response
+
+def metrics(request):
+    """
+    Serve the metrics for the Django server and the Celery workers in the
+    Prometheus text exposition format.
+    """
+    return HttpResponse(render_metrics(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
+
 def _get_ip_addresss(request):
     """
     Helper function to get the IP address of the client
@@ -165,3 +501,151 @@ def _get_ip_addresss(request):
         return ip
     else:
         return None
+
+def _get_image_formats(request):
+    """
+    Helper function to get the image formats supported by the client. These
+    are given by the "formats" parameter, since the browser doesn't send its
+    supported image types with a JSON request, as well as any image types
+    listed explicitly in the Accept header.
+    """
+    formats = set(request.GET.get("formats", "").split(","))
+
+    for media_type in request.META.get("HTTP_ACCEPT", "").split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type.startswith("image/"):
+            formats.add(media_type[len("image/"):])
+
+    return formats
+
+def _micrograph_url(micrograph, formats):
+    """
+    Helper function to get the URL of the best variant of a micrograph image
+    in the given formats, falling back to the original PNG.
+    """
+    filename = variants.best_variant(micrograph.name, formats)
+
+    micrograph_formats.labels(filename.split(".")[-1] if filename else "png").inc()
+
+    if filename is None:
+        return micrograph.path
+
+    return variants.variant_url(micrograph, filename)
+
+async def _wait_for_result(result, timeout):
+    """
+    Helper function to wait for the result of a task without blocking a
+    thread, returning None if the task didn't succeed in time.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    # The result backend is read in a worker thread, but only briefly.
+    ready = sync_to_async(result.ready, thread_sensitive=False)
+
+    while not await ready():
+        if loop.time() >= deadline:
+            return None
+        await asyncio.sleep(RESULT_POLL_INTERVAL)
+
+    return result.result if result.successful() else None
+
+def _check_upload_shape(index, data, encoding):
+    """
+    Helper function to check that an upload has one of the shapes accepted
+    for its micrograph, so that it can't be accumulated with labels of a
+    different shape. The shape is read from the header of the upload, so
+    nothing is decoded. Returns an error message, or None if the upload is
+    valid.
+    """
+
+    # Index is set to -1 if labelling is complete.
+    if index < 0:
+        return None
+
+    try:
+        micrograph = Micrograph.objects.only("path").get(pk=index)
+    except Micrograph.DoesNotExist:
+        return "Unknown micrograph."
+
+    try:
+        shape = masks.upload_shape(data, encoding)
+    except ValueError as e:
+        return f"Invalid mask: {e}"
+
+    shapes = masks.upload_shapes(micrograph)
+    if shape not in shapes:
+        return f"Mask shape {shape} doesn't match the micrograph, expected one of {sorted(shapes)}."
+
+    return None
+
+def _queue_upload(ip, index, data, extension, svg_serialized=None):
+    """
+    Helper function to stage an upload so that only a reference to it is
+    passed to the task through the message broker, then call the Celery task
+    to process it. If running locally there is no worker, so the task is run
+    by a background thread instead.
+    """
+    reference = staging.stage_upload(data, extension, svg_serialized)
+
+    if proof_local:
+        future = _processor.submit(_process_upload, ip, index, reference)
+        _processing.add(future)
+        future.add_done_callback(_processing.discard)
+    else:
+        process_micrograph_mask.delay(ip, index, reference)
+
+def _process_upload(ip, index, reference):
+    """
+    Helper function to process an upload in a background thread, logging
+    any failure since there is no caller to report it to.
+    """
+    try:
+        process_micrograph_mask(ip, index, reference)
+    except Exception:
+        logger.exception(f"Failed to process upload '{reference}' for micrograph index {index}")
+
+def wait_for_uploads():
+    """
+    Wait until the uploads that are being processed by background threads,
+    when running locally, have been processed.
+    """
+    futures.wait(list(_processing))
+
+def _assign_micrographs(ip, count):
+    """
+    Helper function to choose and reserve up to count of the highest
+    priority micrographs that haven't been labelled by, or are currently
+    reserved for, the client with the given IP address.
+    """
+    # Get the current time.
+    now = timezone.now()
+
+    # Choose and reserve the micrographs in a single transaction, so that
+    # concurrent requests from the same client can't reserve the same
+    # micrograph twice.
+    with transaction.atomic():
+
+        # Remove all of the reservations that have lapsed, so that they
+        # neither build up nor hide micrographs from their clients.
+        Reservation.objects.filter(expires__lte=now).delete()
+
+        # Get the micrographs that haven't been labelled by, or reserved for,
+        # this IP address. The exclusions are resolved by the indexes on the
+        # label and reservation tables, and only the fields needed to serve
+        # the image, and to rank it, are loaded.
+        candidates = (Micrograph.objects
+                                .exclude(labels__ip_address=ip)
+                                .exclude(reservations__ip_address=ip)
+                                .only("id", "path", "num_labels", "priority"))
+
+        # Choose the highest priority micrographs.
+        micrographs = scheduling.choose_micrographs(candidates, count, now)
+
+        # Reserve the micrographs for the client.
+        expires = now + timedelta(seconds=settings.PROOF_LEASE_TIMEOUT)
+        Reservation.objects.bulk_create(
+            [Reservation(micrograph=micrograph, ip_address=ip, expires=expires)
+                for micrograph in micrographs])
+
+    return micrographs
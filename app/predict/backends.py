@@ -0,0 +1,146 @@
+"""
+Pluggable models for predicting filament maps from micrographs.
+
+A model is a class with a ``name``, a ``version``, and a ``predict`` method
+that maps a batch of micrographs to a batch of filament probability maps.
+Models run on the CPU and are listed in the ``PROOF_PREDICT_MODELS`` setting
+as dotted paths. The version identifies the predictions that a model makes,
+so it must change whenever the model or its parameters do.
+"""
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from scipy import ndimage
+
+import numpy as np
+
+class Model:
+    """
+    The interface for a filament prediction model.
+    """
+
+    # The name of the model, used to select it in requests.
+    name = None
+
+    # The version of the model. Cached predictions are keyed by this.
+    version = None
+
+    def predict(self, batch):
+        """
+        Predict filament maps for a batch of micrographs.
+
+
+        Parameters
+        ----------
+
+        batch : numpy.ndarray
+            A float32 array of shape (N, height, width) holding N grayscale
+            micrographs, scaled to [0, 1].
+
+
+        Returns
+        -------
+
+        probabilities : numpy.ndarray
+            A float32 array of the same shape holding the probability that
+            each pixel is filament.
+        """
+        raise NotImplementedError()
+
+class RidgeFilterModel(Model):
+    """
+    A filter-based model that responds to thin, dark ridges, using a
+    difference of Gaussians tuned to the width of a filament. This needs no
+    training data, so it can be used for pre-labelling and in tests.
+    """
+
+    name = "ridge"
+
+    def __init__(self, sigma=2.0, background_sigma=8.0, gain=4.0):
+        """
+        Constructor.
+
+
+        Parameters
+        ----------
+
+        sigma : float
+            The width of the Gaussian matched to a filament, in pixels.
+
+        background_sigma : float
+            The width of the Gaussian used to estimate the local background,
+            in pixels.
+
+        gain : float
+            The steepness of the mapping from filter response to probability.
+        """
+        self.sigma = sigma
+        self.background_sigma = background_sigma
+        self.gain = gain
+        self.version = f"1-{sigma:g}-{background_sigma:g}-{gain:g}"
+
+    def predict(self, batch):
+        # Filter every micrograph in the batch at once, without smoothing
+        # across the batch axis.
+        batch = np.asarray(batch, dtype=np.float32)
+        response = ndimage.gaussian_filter(batch, (0, self.background_sigma, self.background_sigma)) \
+                 - ndimage.gaussian_filter(batch, (0, self.sigma, self.sigma))
+
+        # Normalise the response of each micrograph.
+        mean = response.mean(axis=(1, 2), keepdims=True)
+        std = response.std(axis=(1, 2), keepdims=True) + 1e-6
+
+        # Map the response to a probability, with pixels one standard
+        # deviation above the mean response at 0.5.
+        z = np.clip(self.gain * ((response - mean) / std - 1), -50, 50)
+
+        return (1 / (1 + np.exp(-z))).astype(np.float32)
+
+# The loaded models, keyed by name.
+_models = None
+
+def get_models():
+    """
+    Return the available models.
+
+
+    Returns
+    -------
+
+    models : dict
+        The model instances, keyed by name. The first model is the default.
+    """
+    global _models
+
+    if _models is None:
+        _models = {}
+        for path in settings.PROOF_PREDICT_MODELS:
+            model = import_string(path)()
+            _models[model.name] = model
+
+    return _models
+
+def get_model(name=None):
+    """
+    Return a model by name.
+
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the model. Defaults to the first available model.
+
+
+    Returns
+    -------
+
+    model : predict.backends.Model, None
+        The model, or None if there is no such model.
+    """
+    models = get_models()
+
+    if name is None:
+        return next(iter(models.values()), None)
+
+    return models.get(name)
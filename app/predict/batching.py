@@ -0,0 +1,169 @@
+"""
+Micro-batching of prediction requests.
+
+Requests for predictions are queued, and a background thread gathers them
+into batches, waiting briefly for more requests to arrive, so that the model
+is run over stacked arrays rather than one micrograph at a time. Requests
+for micrographs of different sizes are batched separately. Any threads in a
+process, e.g. the request threads of the Django server or the threads of a
+Celery worker using the threads pool, share the batcher for each model.
+"""
+
+from concurrent.futures import Future
+
+import logging
+import numpy as np
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """
+    Groups prediction requests for a model into batches.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_delay=0.05):
+        """
+        Constructor.
+
+
+        Parameters
+        ----------
+
+        model : predict.backends.Model
+            The model used to make the predictions.
+
+        max_batch_size : int
+            The maximum number of micrographs in a batch.
+
+        max_delay : float
+            The maximum number of seconds to wait for a batch to fill.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+        Queue a micrograph for prediction.
+
+
+        Parameters
+        ----------
+
+        image : numpy.ndarray
+            A float32 grayscale micrograph, scaled to [0, 1].
+
+
+        Returns
+        -------
+
+        future : concurrent.futures.Future
+            A future that resolves to the predicted filament probabilities.
+        """
+        future = Future()
+        self._queue.put((image, future))
+
+        return future
+
+    def predict(self, image):
+        """
+        Predict the filament probabilities for a micrograph, waiting for the
+        batch containing it to be run.
+
+
+        Parameters
+        ----------
+
+        image : numpy.ndarray
+            A float32 grayscale micrograph, scaled to [0, 1].
+
+
+        Returns
+        -------
+
+        probabilities : numpy.ndarray
+            The predicted filament probabilities.
+        """
+        return self.submit(image).result()
+
+    def _run(self):
+        """
+        Gather requests into batches and run them.
+        """
+        while True:
+            requests = [self._queue.get()]
+
+            # Wait for the batch to fill, up to the maximum delay.
+            deadline = time.monotonic() + self.max_delay
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Run a batch for each size of micrograph.
+            shapes = {}
+            for image, future in requests:
+                shapes.setdefault(image.shape, []).append((image, future))
+
+            for batch in shapes.values():
+                self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        """
+        Run the model over a batch of micrographs of the same size.
+        """
+        try:
+            probabilities = self.model.predict(np.stack([image for image, _ in batch]))
+        except Exception as e:
+            logger.exception(f"Prediction failed for a batch of {len(batch)} micrographs")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), p in zip(batch, probabilities):
+            future.set_result(p)
+
+# The batcher for each model, keyed by name and version.
+_batchers = {}
+_lock = threading.Lock()
+
+def get_batcher(model, max_batch_size=8, max_delay=0.05):
+    """
+    Return the shared batcher for a model, creating it if needed.
+
+
+    Parameters
+    ----------
+
+    model : predict.backends.Model
+        The model.
+
+    max_batch_size : int
+        The maximum number of micrographs in a batch.
+
+    max_delay : float
+        The maximum number of seconds to wait for a batch to fill.
+
+
+    Returns
+    -------
+
+    batcher : predict.batching.MicroBatcher
+        The batcher.
+    """
+    with _lock:
+        key = (model.name, model.version)
+        if key not in _batchers:
+            _batchers[key] = MicroBatcher(model, max_batch_size, max_delay)
+
+        return _batchers[key]
@@ -1,3 +1,35 @@
 from django.db import models
 
-# Create your models here.
+from label.models import Micrograph
+
+class Prediction(models.Model):
+    micrograph = models.ForeignKey(
+            Micrograph,
+            on_delete = models.CASCADE,
+            related_name = "predictions",
+            help_text = "The micrograph that the prediction was made for."
+            )
+    model = models.CharField(
+            max_length = 50,
+            help_text = "The name of the model that made the prediction."
+            )
+    version = models.CharField(
+            max_length = 50,
+            help_text = "The version of the model that made the prediction."
+            )
+    path = models.CharField(
+            max_length = 200,
+            help_text = "The path to the predicted filament probabilities."
+            )
+    created = models.DateTimeField(
+            auto_now_add = True,
+            help_text = "When the prediction was made."
+            )
+
+    class Meta:
+        # A prediction is cached for each (micrograph, model version), and
+        # looked up with a single index lookup.
+        constraints = [
+            models.UniqueConstraint(fields=["micrograph", "model", "version"],
+                                    name="unique_prediction"),
+        ]
@@ -0,0 +1,378 @@
+"""
+Cached filament predictions for micrographs.
+
+Predictions are made through the shared micro-batcher for the model, and
+stored as 8-bit grayscale PNGs of the filament probabilities, with a record
+for each (micrograph, model version). Since a model version always makes the
+same prediction, each prediction is computed once and can be served with
+long-lived HTTP caching. The stored probabilities can be rendered as:
+
+    probability   The grayscale probabilities.
+    overlay       A translucent green overlay, whose opacity is the probability.
+    mask          A binary pre-label in the same format as the label masks.
+
+While a prediction is queued, a marker file is kept next to where it will be
+stored, so that clients polling for the same prediction don't queue it again.
+The marker is removed when the prediction task finishes, and is ignored once
+it is older than PROOF_PREDICT_PENDING_TTL, in case the task was lost.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError
+from io import BytesIO
+from PIL import Image
+
+import numpy as np
+import os
+import time
+import uuid
+
+from label import accumulator, metrics, scheduling
+from label.models import Micrograph
+from .backends import get_model
+from .batching import get_batcher
+from .models import Prediction
+
+# The directory in which the predictions are stored.
+PREDICTION_DIR = "predict/predictions"
+
+# The kinds of image that a prediction can be rendered as.
+KINDS = ["probability", "overlay", "mask"]
+
+def prediction_path(micrograph, model):
+    """
+    Return the path to the prediction of a model for a micrograph.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    model : predict.backends.Model
+        The model.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the predicted filament probabilities.
+    """
+    return f"{PREDICTION_DIR}/{micrograph.name}/{model.name}-{model.version}.png"
+
+def pending_path(micrograph, model):
+    """
+    Return the path to the marker for a queued prediction of a model for a
+    micrograph.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    model : predict.backends.Model
+        The model.
+
+
+    Returns
+    -------
+
+    path : str
+        The path to the marker file.
+    """
+    return f"{PREDICTION_DIR}/{micrograph.name}/{model.name}-{model.version}.pending"
+
+def mark_pending(micrograph, model):
+    """
+    Mark a prediction as queued, unless it is already.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    model : predict.backends.Model
+        The model.
+
+
+    Returns
+    -------
+
+    is_marked : bool
+        Whether the prediction was marked, in which case the caller should
+        queue it. This is False if it was already queued.
+    """
+    path = pending_path(micrograph, model)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Creating the marker is atomic, so only one caller queues the prediction.
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        pass
+
+    # Take over the marker if the task that set it has been lost.
+    try:
+        if time.time() - os.path.getmtime(path) > settings.PROOF_PREDICT_PENDING_TTL:
+            os.utime(path)
+            return True
+    except FileNotFoundError:
+        # The task has just finished, so the prediction can be served.
+        pass
+
+    return False
+
+def clear_pending(micrograph, model):
+    """
+    Remove the marker for a queued prediction.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    model : predict.backends.Model
+        The model.
+    """
+    try:
+        os.remove(pending_path(micrograph, model))
+    except FileNotFoundError:
+        pass
+
+def prediction_url(prediction, kind):
+    """
+    Return the versioned URL of a prediction, relative to the site root.
+
+
+    Parameters
+    ----------
+
+    prediction : predict.models.Prediction
+        The prediction.
+
+    kind : str
+        The kind of image, i.e. "probability", "overlay", or "mask".
+
+
+    Returns
+    -------
+
+    url : str
+        The URL of the prediction image.
+    """
+    return f"predict/predictions/{prediction.micrograph_id}/{prediction.model}/" \
+           f"{prediction.version}/{kind}.png"
+
+def get_cached_prediction(micrograph, model):
+    """
+    Return the cached prediction of a model for a micrograph.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    model : predict.backends.Model
+        The model.
+
+
+    Returns
+    -------
+
+    prediction : predict.models.Prediction, None
+        The prediction, or None if it hasn't been made.
+    """
+    prediction = Prediction.objects.filter(micrograph=micrograph, model=model.name,
+                                           version=model.version).first()
+
+    if prediction is not None and os.path.exists(prediction.path):
+        metrics.cache_requests.labels("prediction", "hit").inc()
+        return prediction
+
+    metrics.cache_requests.labels("prediction", "miss").inc()
+
+    return None
+
+def get_prediction(micrograph, model):
+    """
+    Return the prediction of a model for a micrograph, making it if it isn't
+    already cached.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+    model : predict.backends.Model
+        The model.
+
+
+    Returns
+    -------
+
+    prediction : predict.models.Prediction
+        The prediction.
+    """
+    prediction = get_cached_prediction(micrograph, model)
+
+    if prediction is not None:
+        return prediction
+
+    # Run the model as part of a batch.
+    batcher = get_batcher(model, settings.PROOF_PREDICT_BATCH_SIZE,
+                          settings.PROOF_PREDICT_BATCH_DELAY)
+    probabilities = batcher.predict(load_micrograph(micrograph))
+
+    path = prediction_path(micrograph, model)
+    _write_probabilities(probabilities, path)
+
+    # Record the prediction. Another worker may have made the same prediction
+    # in the meantime, in which case they are identical.
+    try:
+        prediction, _ = Prediction.objects.update_or_create(
+                micrograph=micrograph, model=model.name, version=model.version,
+                defaults={"path" : path})
+    except IntegrityError:
+        prediction = Prediction.objects.get(micrograph=micrograph, model=model.name,
+                                            version=model.version)
+
+    # The uncertainty of the default model's prediction feeds into the
+    # labelling priority.
+    if model is get_model():
+        update_uncertainty(micrograph.id, prediction_uncertainty(probabilities))
+
+    return prediction
+
+def prediction_uncertainty(probabilities):
+    """
+    Compute the uncertainty of a prediction.
+
+
+    Parameters
+    ----------
+
+    probabilities : numpy.ndarray
+        The predicted filament probabilities.
+
+
+    Returns
+    -------
+
+    uncertainty : float
+        The mean of 4 p (1 - p) over the pixels, which is zero when the model
+        is certain and one when every pixel has a probability of 0.5.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    return float(np.mean(4 * probabilities * (1 - probabilities)))
+
+def update_uncertainty(index, uncertainty):
+    """
+    Update the prediction uncertainty, and the labelling priority, of a
+    micrograph.
+
+
+    Parameters
+    ----------
+
+    index : int
+        The index of the micrograph in the Django database.
+
+    uncertainty : float
+        The uncertainty of the prediction for the micrograph.
+    """
+    name = Micrograph.objects.only("path").get(pk=index).name
+
+    # Hold the lock for the micrograph, so that the update is serialised with
+    # the ingestion of labels.
+    with accumulator.lock(name):
+        micrograph = Micrograph.objects.get(pk=index)
+        micrograph.prediction_uncertainty = uncertainty
+        scheduling.update_priority(micrograph)
+        micrograph.save()
+
+def load_micrograph(micrograph):
+    """
+    Load a micrograph as input to a model.
+
+
+    Parameters
+    ----------
+
+    micrograph : label.models.Micrograph
+        The micrograph.
+
+
+    Returns
+    -------
+
+    image : numpy.ndarray
+        The float32 grayscale micrograph, scaled to [0, 1].
+    """
+    image = Image.open(f"label/{micrograph.path}").convert("L")
+    return np.asarray(image, dtype=np.float32) / 255
+
+def render_prediction(prediction, kind):
+    """
+    Render a prediction as a PNG image.
+
+
+    Parameters
+    ----------
+
+    prediction : predict.models.Prediction
+        The prediction.
+
+    kind : str
+        The kind of image, i.e. "probability", "overlay", or "mask".
+
+
+    Returns
+    -------
+
+    data : bytes
+        The PNG image.
+    """
+    probabilities = np.asarray(Image.open(prediction.path))
+
+    if kind == "probability":
+        image = Image.fromarray(probabilities)
+    elif kind == "overlay":
+        overlay = np.zeros(probabilities.shape + (4,), dtype=np.uint8)
+        overlay[..., 1] = 255
+        overlay[..., 3] = probabilities // 2
+        image = Image.fromarray(overlay)
+    elif kind == "mask":
+        # Filament pixels are black, as for the label masks.
+        image = Image.fromarray(probabilities < round(255 * settings.PROOF_PREDICT_THRESHOLD))
+    else:
+        raise ValueError(f"Unknown prediction image '{kind}'")
+
+    data = BytesIO()
+    image.save(data, format="PNG")
+
+    return data.getvalue()
+
+def _write_probabilities(probabilities, path):
+    """
+    Helper function to write predicted probabilities so that they are never
+    seen partially written, even if the same prediction is written by more
+    than one task.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    image = Image.fromarray(np.round(255 * np.clip(probabilities, 0, 1)).astype(np.uint8))
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    image.save(tmp, format="PNG")
+    os.replace(tmp, path)
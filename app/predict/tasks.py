@@ -0,0 +1,42 @@
+import logging
+
+from proof.celery import app
+from label.models import Micrograph
+from . import backends, predictions
+
+logger = logging.getLogger(__name__)
+
+@app.task
+def predict_micrograph(index, model_name=None):
+    """
+    Predict the filament map for a micrograph, unless it is already cached.
+    Run the workers with the threads pool so that concurrent tasks are
+    batched together.
+
+
+    Parameters
+    ----------
+
+    index : int
+        The index of the micrograph in the Django database.
+
+    model_name : str
+        The name of the model. Defaults to the first available model.
+    """
+    model = backends.get_model(model_name)
+
+    if model is None:
+        logger.warning(f"Unknown prediction model '{model_name}'")
+        return
+
+    micrograph = Micrograph.objects.only("path").get(pk=index)
+
+    # The prediction is no longer pending once the task finishes, whether or
+    # not it succeeded, so that a later request can queue it again.
+    try:
+        predictions.get_prediction(micrograph, model)
+    finally:
+        predictions.clear_pending(micrograph, model)
+
+    logger.info(f"Predicted filaments for micrograph {index} with model "
+                f"'{model.name}' version {model.version}")
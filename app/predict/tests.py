@@ -1,3 +1,112 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TransactionTestCase
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import os
+import tempfile
+import unittest
+
+from label import metrics
+from label.models import Micrograph
+from . import batching, views
+from .backends import Model
+
+def setUpModule():
+    # Don't start the metrics heartbeat thread, which would keep writing
+    # snapshots into whichever directory is current, including the app's.
+    patch = mock.patch.dict(metrics._process, heartbeat=mock.Mock())
+    patch.start()
+    unittest.addModuleCleanup(patch.stop)
+
+class ScaleModel(Model):
+    """
+    A model that doubles each pixel, and records the size of each batch.
+    """
+
+    name = "scale"
+    version = "1"
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        return batch * 2
+
+class MicroBatcherTests(SimpleTestCase):
+
+    def test_batches_concurrent_requests(self):
+        model = ScaleModel()
+        batcher = batching.MicroBatcher(model, max_batch_size=4, max_delay=1)
+
+        images = [np.full((4, 4), i, dtype=np.float32) for i in range(4)]
+        futures = [batcher.submit(image) for image in images]
+
+        for image, future in zip(images, futures):
+            np.testing.assert_array_equal(future.result(5), image * 2)
+        self.assertEqual(model.batch_sizes, [4])
+
+    def test_batches_by_shape(self):
+        model = ScaleModel()
+        batcher = batching.MicroBatcher(model, max_batch_size=3, max_delay=1)
+
+        futures = [batcher.submit(np.zeros(shape, dtype=np.float32))
+                   for shape in [(4, 4), (8, 8), (4, 4)]]
+
+        self.assertEqual([future.result(5).shape for future in futures],
+                         [(4, 4), (8, 8), (4, 4)])
+        self.assertEqual(sorted(model.batch_sizes), [1, 2])
+
+    def test_failure(self):
+        model = ScaleModel()
+        batcher = batching.MicroBatcher(model, max_batch_size=1)
+
+        with mock.patch.object(model, "predict", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                batcher.predict(np.zeros((4, 4), dtype=np.float32))
+
+class PredictionViewTests(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+
+        self.micrograph = Micrograph.objects.create(path="static/micrographs/m0.png")
+
+    def test_missing_index(self):
+        response = self.client.get("/predict/prediction")
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_index(self):
+        response = self.client.get("/predict/prediction", {"index" : "abc"})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_micrograph(self):
+        response = self.client.get("/predict/prediction", {"index" : self.micrograph.id + 1})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_model(self):
+        response = self.client.get("/predict/prediction", {"index" : self.micrograph.id,
+                                                           "model" : "unknown"})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_labelling_complete(self):
+        response = self.client.get("/predict/prediction", {"index" : -1})
+
+        self.assertEqual(response.json()["prediction"], "NULL")
+
+    def test_queued_once(self):
+        with mock.patch.object(views, "proof_local", False), \
+             mock.patch.object(views.predict_micrograph, "delay") as delay:
+            for _ in range(3):
+                response = self.client.get("/predict/prediction", {"index" : self.micrograph.id})
+                self.assertEqual(response.json()["prediction"], "PENDING")
+
+        delay.assert_called_once_with(self.micrograph.id, "ridge")
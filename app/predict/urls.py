@@ -0,0 +1,10 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('models', views.models, name='models'),
+    path('prediction', views.prediction, name='prediction'),
+    path('predictions/<int:index>/<str:model>/<str:version>/<str:kind>.png',
+         views.prediction_image, name='prediction_image'),
+]
@@ -1,3 +1,122 @@
-from django.shortcuts import render
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.shortcuts import get_object_or_404
 
-# Create your views here.
+import logging
+
+from label.models import Micrograph
+from . import backends, predictions
+from .models import Prediction
+from .tasks import predict_micrograph
+
+logger = logging.getLogger(__name__)
+
+# Whether we are running locally.
+proof_local = settings.PROOF_LOCAL
+
+def models(request):
+    """
+    Serve the names and versions of the available prediction models.
+    """
+    available = backends.get_models()
+
+    return JsonResponse({"models" : [{"name" : model.name, "version" : model.version}
+                                     for model in available.values()],
+                         "default" : next(iter(available), None)})
+
+async def prediction(request):
+    """
+    Serve the URL of an image of the predicted filaments for a micrograph.
+    The kind of image is given by the "kind" parameter, which defaults to an
+    overlay. If the prediction hasn't been made yet, it is queued and the
+    client should ask again later.
+    """
+
+    # Get the index of the micrograph, the model, and the kind of image.
+    try:
+        index = int(request.GET["index"])
+    except (KeyError, ValueError):
+        return JsonResponse({"error" : "Invalid micrograph index."}, status=400)
+    name = request.GET.get("model")
+    kind = request.GET.get("kind", "overlay")
+
+    # Serve the prediction from a thread of its own, rather than the one
+    # thread shared by synchronous code, so that concurrent requests can be
+    # batched together when running locally.
+    return await sync_to_async(_serve_prediction, thread_sensitive=False)(index, name, kind)
+
+def _serve_prediction(index, name, kind):
+    """
+    Helper function to serve the URL of an image of the predictions of a
+    model for a micrograph.
+    """
+    model = backends.get_model(name)
+
+    if model is None:
+        return JsonResponse({"error" : "Unknown model."}, status=400)
+
+    if kind not in predictions.KINDS:
+        return JsonResponse({"error" : "Unknown kind of prediction image."}, status=400)
+
+    response = {"model" : model.name, "version" : model.version}
+
+    # Index is set to -1 if labelling is complete.
+    if index < 0:
+        response["prediction"] = "NULL"
+        return JsonResponse(response)
+
+    # Get the micrograph in the database.
+    micrograph = get_object_or_404(Micrograph.objects.only("path"), pk=index)
+
+    # Make the prediction now if running locally. Concurrent requests are
+    # batched together.
+    if proof_local:
+        prediction = predictions.get_prediction(micrograph, model)
+    else:
+        prediction = predictions.get_cached_prediction(micrograph, model)
+
+    if prediction is not None:
+        logger.info(f"Serving prediction for image {index}")
+        response["prediction"] = predictions.prediction_url(prediction, kind)
+    else:
+        # Only queue the prediction if it isn't already queued, so that
+        # polling clients don't fill the queue with duplicate tasks.
+        if predictions.mark_pending(micrograph, model):
+            logger.info(f"Queueing prediction for image {index}")
+            predict_micrograph.delay(index, model.name)
+        response["prediction"] = "PENDING"
+
+    return JsonResponse(response)
+
+def prediction_image(request, index, model, version, kind):
+    """
+    Serve an image of the predictions of a model version for a micrograph.
+    Since a model version always makes the same prediction, the image is
+    served with long-lived caching headers.
+    """
+
+    if kind not in predictions.KINDS:
+        raise Http404(f"Unknown prediction image '{kind}'")
+
+    prediction = get_object_or_404(Prediction, micrograph_id=index, model=model, version=version)
+
+    # The entity tag identifies the image by its cache key.
+    etag = f'"{index}-{model}-{version}-{kind}"'
+
+    # The client already has this image.
+    if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+
+    try:
+        data = predictions.render_prediction(prediction, kind)
+    except FileNotFoundError:
+        raise Http404("The prediction has been removed")
+
+    response = HttpResponse(data, content_type="image/png")
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+
+    return response
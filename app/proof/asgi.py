@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'proof.settings')
 
 application = get_asgi_application()
+
+# Serve the static files, as the development server does.
+if settings.DEBUG:
+    application = ASGIStaticFilesHandler(application)
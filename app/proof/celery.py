@@ -15,6 +15,14 @@ app = Celery('proof')
 #   should have a `CELERY_` prefix.
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+
+@app.on_after_configure.connect
+def create_result_directory(sender, source, **kwargs):
+    # The file system result backend needs its directory to exist.
+    backend = source.get('result_backend') or ''
+    if backend.startswith('file://'):
+        os.makedirs(backend[len('file://'):], exist_ok=True)
+
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
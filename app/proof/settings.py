@@ -74,6 +74,7 @@ LOGGING = {
 }
 
 MIDDLEWARE = [
+    'label.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -102,6 +103,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'proof.wsgi.application'
+ASGI_APPLICATION = 'proof.asgi.application'
 
 
 # Database
@@ -111,6 +113,19 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Concurrent writers, e.g. ingestion workers, wait for each other
+        # rather than failing with 'database is locked'. Transactions take
+        # the write lock when they begin, since SQLite can't wait for it
+        # part way through a transaction.
+        'OPTIONS': {
+            'timeout': 30,
+            'transaction_mode': 'IMMEDIATE',
+        },
+        # Migrations are only made when the app is deployed, so the test
+        # database is created directly from the models.
+        'TEST': {
+            'MIGRATE': False,
+        },
     }
 }
 
@@ -148,7 +163,135 @@ USE_L10N = True
 USE_TZ = True
 
 
+# Default primary key field type
+# https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# PROOF labelling
+# Whether proof is being run locally, in which case tasks are run synchronously.
+PROOF_LOCAL = os.getenv('PROOF_LOCAL') != None
+
+# Micrographs served to a client are reserved for this many seconds so that
+# they aren't served to the same client again while they are queued.
+PROOF_LEASE_TIMEOUT = int(os.getenv('PROOF_LEASE_TIMEOUT', 600))
+
+# The maximum number of micrographs that can be requested in a single batch.
+PROOF_MAX_BATCH = int(os.getenv('PROOF_MAX_BATCH', 10))
+
+# Whether label masks are written to disk by a background thread, rather than
+# before the upload task completes.
+PROOF_DEFER_MASKS = os.getenv('PROOF_DEFER_MASKS') != None
+
+# The number of seconds to wait before ingesting an upload, so that uploads
+# for the same micrograph that arrive within the window are batched together.
+PROOF_INGEST_WINDOW = float(os.getenv('PROOF_INGEST_WINDOW', 2))
+
+# The number of seconds after which staged uploads that were never processed
+# are removed.
+PROOF_STAGING_TTL = int(os.getenv('PROOF_STAGING_TTL', 86400))
+
+# The number of micrographs in each shard of the variance computation that is
+# dispatched to the Celery workers.
+PROOF_VARIANCE_SHARD_SIZE = int(os.getenv('PROOF_VARIANCE_SHARD_SIZE', 10))
+
+# The maximum number of rendered label images, e.g. average masks, that are
+# cached on disk.
+PROOF_RENDER_CACHE_SIZE = int(os.getenv('PROOF_RENDER_CACHE_SIZE', 1000))
+
+# The number of seconds after which a cached render that hasn't been used is
+# removed.
+PROOF_RENDER_MAX_AGE = int(os.getenv('PROOF_RENDER_MAX_AGE', 86400))
+
+# Whether labels are accumulated at the full resolution of each micrograph,
+# as given by its tile pyramid, rather than the resolution of the labeller
+# canvas. This must be chosen before any labels are uploaded.
+PROOF_FULL_RESOLUTION_LABELS = os.getenv('PROOF_FULL_RESOLUTION_LABELS') != None
+
+# The maximum number of paths, and of points over all paths, in an upload of
+# vector strokes.
+PROOF_MAX_STROKE_PATHS = int(os.getenv('PROOF_MAX_STROKE_PATHS', 10000))
+PROOF_MAX_STROKE_POINTS = int(os.getenv('PROOF_MAX_STROKE_POINTS', 200000))
+
+# The dotted paths of the filament prediction models, separated by commas. The
+# first model is the default.
+PROOF_PREDICT_MODELS = os.getenv('PROOF_PREDICT_MODELS', 'predict.backends.RidgeFilterModel').split(',')
+
+# The maximum number of micrographs in each batch of predictions.
+PROOF_PREDICT_BATCH_SIZE = int(os.getenv('PROOF_PREDICT_BATCH_SIZE', 8))
+
+# The maximum number of seconds to wait for a batch of predictions to fill.
+PROOF_PREDICT_BATCH_DELAY = float(os.getenv('PROOF_PREDICT_BATCH_DELAY', 0.05))
+
+# The probability above which a predicted pixel is marked as filament in a
+# pre-label mask.
+PROOF_PREDICT_THRESHOLD = float(os.getenv('PROOF_PREDICT_THRESHOLD', 0.5))
+
+# The number of seconds after which a queued prediction that hasn't finished
+# is assumed to be lost, and can be queued again.
+PROOF_PREDICT_PENDING_TTL = float(os.getenv('PROOF_PREDICT_PENDING_TTL', 300))
+
+# The number of labels wanted for each micrograph. Micrographs with fewer
+# labels are given a higher labelling priority.
+PROOF_TARGET_LABELS = int(os.getenv('PROOF_TARGET_LABELS', 5))
+
+# The weights of the label deficit, the label variance, and the uncertainty of
+# the predicted filaments in the labelling priority of a micrograph.
+PROOF_PRIORITY_DEFICIT_WEIGHT = float(os.getenv('PROOF_PRIORITY_DEFICIT_WEIGHT', 1.0))
+PROOF_PRIORITY_VARIANCE_WEIGHT = float(os.getenv('PROOF_PRIORITY_VARIANCE_WEIGHT', 0.5))
+PROOF_PRIORITY_UNCERTAINTY_WEIGHT = float(os.getenv('PROOF_PRIORITY_UNCERTAINTY_WEIGHT', 0.0))
+
+# Micrographs are chosen from a window of this many times the number requested
+# of the highest priority micrographs.
+PROOF_SCHEDULER_WINDOW = int(os.getenv('PROOF_SCHEDULER_WINDOW', 10))
+
+# The fraction of requests that are run under cProfile, with the profiles
+# written to PROOF_PROFILE_DIR. Profiling is disabled by default.
+PROOF_PROFILE_RATE = float(os.getenv('PROOF_PROFILE_RATE', 0.0))
+PROOF_PROFILE_DIR = os.getenv('PROOF_PROFILE_DIR', 'label/profiles')
+
+# The number of seconds between polls for new events to push to the clients,
+# the number of seconds after which an event stream is closed and the client
+# reconnects, and the number of seconds for which events are kept so that
+# they can be resent to reconnecting clients.
+PROOF_EVENT_POLL_INTERVAL = float(os.getenv('PROOF_EVENT_POLL_INTERVAL', 0.5))
+PROOF_EVENT_STREAM_TIMEOUT = int(os.getenv('PROOF_EVENT_STREAM_TIMEOUT', 300))
+PROOF_EVENT_TTL = int(os.getenv('PROOF_EVENT_TTL', 3600))
+
+# The number of seconds that the average view waits for a render by the
+# interactive workers before telling the client to wait for an event.
+PROOF_INTERACTIVE_TIMEOUT = float(os.getenv('PROOF_INTERACTIVE_TIMEOUT', 2.0))
+
+# The directory in which the results of interactive tasks are stored, so that
+# the Django server can wait for them.
+PROOF_RESULT_DIR = os.getenv('PROOF_RESULT_DIR', 'label/task_results')
+
+
+# Celery
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html
+
+# Tasks are routed to a queue by how long a labeller may be waiting for them:
+# renders that a labeller has asked for, ingestion of uploads, and batch jobs,
+# e.g. the periodic reconciliation and clean-ups. Each queue is consumed by
+# its own workers, so batch jobs never hold up interactive requests. Tasks
+# that aren't routed are batch jobs.
+CELERY_TASK_DEFAULT_QUEUE = 'batch'
+CELERY_TASK_ROUTES = {
+    'label.tasks.create_average_mask' : {'queue' : 'interactive'},
+    'predict.tasks.predict_micrograph' : {'queue' : 'interactive'},
+    'label.tasks.process_micrograph_mask' : {'queue' : 'ingest'},
+    'label.tasks.ingest_micrograph_masks' : {'queue' : 'ingest'},
+}
+
+# Results are stored on the shared file system, and only for the tasks that
+# are waited on. They are removed by the beat schedule once they expire.
+CELERY_RESULT_BACKEND = 'file://' + os.path.join(BASE_DIR, PROOF_RESULT_DIR)
+CELERY_RESULT_EXPIRES = 3600
+CELERY_TASK_IGNORE_RESULT = True
@@ -16,7 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from label import views as label_views
+
 urlpatterns = [
     path('label/', include('label.urls')),
+    path('predict/', include('predict.urls')),
     path('admin/', admin.site.urls),
+    path('metrics', label_views.metrics, name='metrics'),
 ]